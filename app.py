@@ -3,59 +3,208 @@ Telegram Web Application
 A modern web interface for Telegram using Telethon with full MTProto API capabilities
 """
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, UploadFile, File, Form, Depends, Header
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, UploadFile, File, Form, Depends, Header, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse, Response
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import APIKeyHeader
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
 from contextlib import asynccontextmanager
 import asyncio
 import os
+import sys
+import threading
 import tempfile
 import shutil
 from pathlib import Path
 from dotenv import load_dotenv
-from telethon import TelegramClient, events, Button
-from telethon.errors import SessionPasswordNeededError
+from telethon import TelegramClient, events, Button, utils
+from telethon.errors import SessionPasswordNeededError, FloodWaitError, FloodPremiumWaitError, SlowModeWaitError, FloodTestPhoneWaitError
 from telethon.tl import types
+from telethon.tl.tlobject import TLObject
 from telethon.tl.types import InputPhoneContact
+from telethon.tl.functions.updates import GetStateRequest, GetDifferenceRequest, GetChannelDifferenceRequest
+from telethon.tl.functions.messages import GetPeerDialogsRequest
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import json
-from datetime import datetime, timedelta
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate, parsedate_to_datetime
 import io
-from collections import defaultdict
+import gzip
+import zlib
+import hashlib
+import heapq
+import sqlite3
+from collections import defaultdict, OrderedDict, deque
+import functools
 import time
 
+try:
+    import brotli
+except ImportError:  # Optional: serve gzip only
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # Optional: no zstd content encoding
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:  # Optional: fall back to the standard json module
+    orjson = None
+
 # Load environment variables
 load_dotenv()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup and shutdown events"""
+    global client
+
     # Startup
+    await load_sync_state()
+    catch_up = None
     try:
         result = await init_client()
         print(f"Telegram client: {result}")
         if result.get("status") == "connected":
             await setup_event_handlers()
+            catch_up = asyncio.create_task(catch_up_missed_updates())
     except Exception as e:
         print(f"Error initializing client: {e}")
+    state_saver = asyncio.create_task(persist_update_state())
+    reminder_scheduler = asyncio.create_task(run_reminder_scheduler())
+
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    await reload_static_assets()
+    asset_watcher = asyncio.create_task(watch_static_assets()) if STATIC_RELOAD_INTERVAL > 0 else None
+    if SLOW_CALLBACK_THRESHOLD_MS > 0:
+        start_slow_callback_detector(SLOW_CALLBACK_THRESHOLD_MS / 1000)
 
     yield
 
     # Shutdown
-    global client
+    if catch_up:
+        catch_up.cancel()
+    state_saver.cancel()
+    reminder_scheduler.cancel()
+    try:
+        if client and client.is_connected() and sync_progress["status"] == "done":
+            await snapshot_update_state()
+        await save_sync_state(clean=True)
+    except Exception as e:
+        print(f"Error saving update state: {e}")
+    lag_monitor.cancel()
+    if asset_watcher:
+        asset_watcher.cancel()
+    slow_callback_state["stop"].set()
+    await run_in_threadpool(close_features_db)
     if client:
         await client.disconnect()
         print("Telegram client disconnected")
 
+# ============================================================================
+# Response Encoding
+# ============================================================================
+
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "text/", "image/svg+xml")
+
+class FastJSONResponse(JSONResponse):
+    """JSON response serialized with orjson when it is installed"""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    """Compress a response body with a fast setting of the given content coding"""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6)
+
+class CompressionMiddleware:
+    """Compress complete JSON/text responses with zstd, brotli or gzip as negotiated.
+
+    Streaming responses (media downloads), responses that already carry a
+    Content-Encoding (precompressed static assets) and bodies below
+    `minimum_size` are passed through untouched.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, threadpool_size: int = 64 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.threadpool_size = threadpool_size
+        self.encodings = [e for e, available in (("zstd", zstandard), ("br", brotli), ("gzip", gzip)) if available]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accepted = _accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        encoding = next((e for e in self.encodings if e in accepted), None)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start["headers"])
+            if (message.get("more_body") or len(body) < self.minimum_size or "content-encoding" in headers
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)):
+                await send(start)
+                await send(message)
+                return
+
+            if len(body) >= self.threadpool_size:
+                compressed = await run_in_threadpool(compress_body, body, encoding)
+            else:
+                compressed = compress_body(body, encoding)
+            if len(compressed) >= len(body):
+                await send(start)
+                await send(message)
+                return
+
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = f"W/{etag}"  # The encoded bytes differ from the identity representation
+            await send(start)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
+
 app = FastAPI(
     title="Telegram Web App - Full API",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
+# Compression middleware for API responses
+if os.getenv("COMPRESSION_ENABLED", "true").lower() == "true":
+    app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")))
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -69,6 +218,12 @@ app.add_middleware(
 client: Optional[TelegramClient] = None
 websocket_connections: List[WebSocket] = []
 
+# WebSocket event stream: every broadcast gets a sequence number and is kept for replay on reconnect
+WS_REPLAY_SIZE = int(os.getenv("WS_REPLAY_SIZE", "1000"))
+WS_STREAM_ID = hashlib.sha256(f"ws:{os.getpid()}:{time.time()}".encode()).hexdigest()[:8]
+ws_event_state: Dict[str, int] = {"seq": 0}
+ws_replay_buffer: deque = deque(maxlen=WS_REPLAY_SIZE)  # (seq, event)
+
 # Security settings
 API_KEYS = os.getenv("API_KEYS", "").split(",") if os.getenv("API_KEYS") else []
 API_KEY_ENABLED = os.getenv("API_KEY_ENABLED", "false").lower() == "true"
@@ -78,14 +233,95 @@ RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))
 IP_WHITELIST = os.getenv("IP_WHITELIST", "").split(",") if os.getenv("IP_WHITELIST") else []
 IP_WHITELIST_ENABLED = os.getenv("IP_WHITELIST_ENABLED", "false").lower() == "true"
 
+# Profiling settings (admin-only, disabled by default)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+ADMIN_API_KEYS = os.getenv("ADMIN_API_KEYS", "").split(",") if os.getenv("ADMIN_API_KEYS") else []
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+SLOW_CALLBACK_THRESHOLD_MS = float(os.getenv("SLOW_CALLBACK_THRESHOLD_MS", "0"))  # 0 disables the detector
+
+# Conditional GET settings: validators are trusted for at most this many seconds
+CONDITIONAL_GET_WINDOW = int(os.getenv("CONDITIONAL_GET_WINDOW", "300"))
+# Change log settings: entries kept per chat for delta sync
+CHANGE_LOG_SIZE = int(os.getenv("CHANGE_LOG_SIZE", "1000"))
+# Update state persistence: catch up on missed updates after a restart
+SYNC_STATE_FILE = os.getenv("SYNC_STATE_FILE", "data/sync_state.json")
+SYNC_STATE_INTERVAL = float(os.getenv("SYNC_STATE_INTERVAL", "60"))
+DISPATCHED_UPDATES_SIZE = 10000  # Recent updates remembered so catch-up and live handlers don't both dispatch one
+
+# Chat export settings
+EXPORT_FRAME_MESSAGES = int(os.getenv("EXPORT_FRAME_MESSAGES", "500"))  # Messages per flushed compressed chunk
+EXPORT_USE_TAKEOUT = os.getenv("EXPORT_USE_TAKEOUT", "true").lower() == "true"
+export_takeout_lock = asyncio.Lock()  # Telegram allows one takeout session at a time
+
+# Static asset settings
+STATIC_RELOAD_INTERVAL = float(os.getenv("STATIC_RELOAD_INTERVAL", "2"))  # 0 disables reloading on file change
+
+# Response cache settings
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+
 # Rate limiting storage
 rate_limit_store: Dict[str, List[float]] = defaultdict(list)
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
-# Custom features storage (in production, use a database)
-templates_store: Dict[str, Dict] = {}
-reminders_store: List[Dict] = []
-tags_store: Dict[str, List[str]] = {}  # message_id -> [tags]
+# Custom features storage: templates, reminders and tags live in SQLite
+FEATURES_DB_PATH = os.getenv("FEATURES_DB_PATH", "data/features.db")
+LEGACY_FEATURES_FILE = os.getenv("LEGACY_FEATURES_FILE", "data/features.json")  # Imported once if present
+features_db: Dict[str, Any] = {"conn": None}
+features_db_lock = threading.Lock()
+
+# Single-flight storage: call key -> in-flight task shared by identical calls
+inflight_calls: Dict[str, asyncio.Task] = {}
+singleflight_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"calls": 0, "collapsed": 0})
+
+# Change tracking: a global sequence bumped by every event that changes chat data
+BOOT_ID = hashlib.sha256(f"{os.getpid()}:{time.time()}".encode()).hexdigest()[:8]
+change_state: Dict[str, Any] = {
+    "seq": 0,
+    "unscoped_seq": 0,  # Deletions Telegram reports without a chat (private chats and basic groups)
+    "dialogs_seq": 0,
+    "dialogs_modified": time.time(),
+    "base_seq": 0,  # Version of chats with no change recorded since startup
+    "floor": 0  # Tokens below this missed changes (update gap) and must resync
+}
+chat_versions: Dict[int, int] = {}  # peer id -> seq of last change
+chat_modified: Dict[int, float] = {}  # peer id -> time of last change
+# Change logs: peer id -> deque of (seq, kind, message ids); None holds unscoped deletions
+chat_change_logs: Dict[Optional[int], deque] = defaultdict(lambda: deque(maxlen=CHANGE_LOG_SIZE))
+chat_log_floor: Dict[Optional[int], int] = {}  # peer id -> highest seq dropped from its log
+
+# Telegram update state: account pts/qts/date/seq and channel id -> pts
+update_state: Dict[str, Any] = {"account": None, "channels": {}}
+sync_progress: Dict[str, Any] = {
+    "status": "idle",
+    "resumed": False,  # Change tokens from before the restart are still valid
+    "started_at": None,
+    "finished_at": None,
+    "pts_start": None,
+    "pts": None,
+    "pts_target": None,
+    "updates_applied": 0,
+    "channels_total": 0,
+    "channels_done": 0,
+    "channels_skipped": 0,
+    "gap": False,
+    "error": None
+}
+# Recently dispatched updates: ("new" | "edited", peer id, message id[, edit date]) or ("deleted", peer id, message id)
+dispatched_updates: "OrderedDict[tuple, None]" = OrderedDict()
+
+# Response cache storage: key -> (expires_at, value, tags)
+response_cache: "OrderedDict[str, tuple]" = OrderedDict()
+cache_tag_index: Dict[str, set] = defaultdict(set)  # tag -> {cache keys}
+cache_generation = 0
+cache_stats: Dict[str, int] = {
+    "hits": 0,
+    "misses": 0,
+    "coalesced": 0,
+    "invalidations": 0,
+    "evictions": 0
+}
 
 # ============================================================================
 # Pydantic Models
@@ -187,33 +423,499 @@ async def get_entity_safe(identifier: str):
     try:
         # Try as integer ID first
         if identifier.isdigit() or (identifier.startswith('-') and identifier[1:].isdigit()):
-            return await client.get_entity(int(identifier))
+            return await client_call("get_entity", int(identifier))
         # Try as username
         elif identifier.startswith('@'):
-            return await client.get_entity(identifier)
+            return await client_call("get_entity", identifier)
         # Try as phone number
         elif identifier.startswith('+'):
-            return await client.get_entity(identifier)
+            return await client_call("get_entity", identifier)
         else:
             # Try as integer
-            return await client.get_entity(int(identifier))
+            return await client_call("get_entity", int(identifier))
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Entity not found: {str(e)}")
 
+def _copy_to_temp_file(fileobj, suffix: str) -> str:
+    """Copy a file object into a new temporary file and return its path (run in the thread pool)"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+        shutil.copyfileobj(fileobj, tmp_file)
+        return tmp_file.name
+
+async def save_upload_to_temp(file: UploadFile) -> str:
+    """Save an uploaded file to a temporary path without blocking the event loop"""
+    return await run_in_threadpool(_copy_to_temp_file, file.file, Path(file.filename).suffix)
+
+async def remove_temp_file(path: str):
+    """Delete a temporary file without blocking the event loop"""
+    try:
+        await run_in_threadpool(os.unlink, path)
+    except OSError:
+        pass
+
 async def broadcast_to_websockets(data: dict):
     """Broadcast data to all connected WebSocket clients"""
+    ws_event_state["seq"] += 1
+    seq = ws_event_state["seq"]
+    data = {**data, "seq": seq, "cursor": f"{WS_STREAM_ID}:{seq}"}
+    ws_replay_buffer.append((seq, data))
+
+    start = time.perf_counter()
+    websocket_broadcasts_pending.inc()
     disconnected = []
-    for ws in websocket_connections:
-        try:
-            await ws.send_json(data)
-        except:
-            disconnected.append(ws)
+    try:
+        for ws in websocket_connections:
+            try:
+                await ws.send_json(data)
+            except:
+                disconnected.append(ws)
+    finally:
+        websocket_broadcasts_pending.dec()
+        websocket_broadcast_duration.observe(time.perf_counter() - start)
 
     # Remove disconnected clients
     for ws in disconnected:
+        websocket_send_failures_total.inc()
         if ws in websocket_connections:
             websocket_connections.remove(ws)
 
+# ============================================================================
+# Single-Flight Request Coalescing
+# ============================================================================
+
+async def single_flight(key: str, factory, group: str = "default"):
+    """Run factory() once for all concurrent callers sharing the same key.
+
+    The call runs in its own task so a caller disconnecting does not cancel
+    the result other callers are waiting for.
+    """
+    task = inflight_calls.get(key)
+    if task is None:
+        singleflight_stats[group]["calls"] += 1
+        task = asyncio.ensure_future(factory())
+        inflight_calls[key] = task
+
+        def _done(t: asyncio.Task):
+            if inflight_calls.get(key) is t:
+                del inflight_calls[key]
+            if not t.cancelled():
+                t.exception()  # Mark as retrieved when every caller went away
+
+        task.add_done_callback(_done)
+    else:
+        singleflight_stats[group]["collapsed"] += 1
+    return await asyncio.shield(task)
+
+def _call_key(value: Any) -> str:
+    """Build a stable key fragment for a Telethon call argument"""
+    if isinstance(value, types.Message):
+        return f"msg:{value.chat_id}:{value.id}"
+    if isinstance(value, TLObject):
+        try:
+            return f"peer:{utils.get_peer_id(value)}"
+        except (TypeError, ValueError):
+            return f"{type(value).__name__}:{getattr(value, 'id', id(value))}"
+    if isinstance(value, type):
+        return value.__name__
+    return repr(value)
+
+async def client_call(method: str, *args, **kwargs):
+    """Call a Telethon client method, sharing one RPC between identical in-flight calls"""
+    key_parts = [_call_key(arg) for arg in args]
+    key_parts += [f"{name}={_call_key(value)}" for name, value in sorted(kwargs.items())]
+    key = f"{method}({','.join(key_parts)})"
+    return await single_flight(key, lambda: getattr(client, method)(*args, **kwargs), group=method)
+
+# ============================================================================
+# Response Cache
+# ============================================================================
+
+def _cache_drop(key: str):
+    """Remove a cache entry and its tag index references"""
+    entry = response_cache.pop(key, None)
+    if entry:
+        for tag in entry[2]:
+            keys = cache_tag_index.get(tag)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del cache_tag_index[tag]
+
+def _cache_store(key: str, value: Any, ttl: float, tags: List[str]):
+    """Store a value in the cache, evicting the least recently used entries"""
+    _cache_drop(key)
+    response_cache[key] = (time.monotonic() + ttl, value, tags)
+    for tag in tags:
+        cache_tag_index[tag].add(key)
+    while len(response_cache) > CACHE_MAX_ENTRIES:
+        oldest = next(iter(response_cache))
+        _cache_drop(oldest)
+        cache_stats["evictions"] += 1
+
+def invalidate_cache(*tags: str):
+    """Invalidate all cached responses carrying any of the given tags"""
+    global cache_generation
+    cache_generation += 1
+    for tag in tags:
+        for key in list(cache_tag_index.get(tag, ())):
+            _cache_drop(key)
+            cache_stats["invalidations"] += 1
+
+def cached_response(route: str, ttl: float, tags: Optional[List[str]] = None):
+    """Cache a read-only route's response for `ttl` seconds.
+
+    Concurrent identical requests share a single upstream call. `tags` are
+    format strings over the route arguments (e.g. "chat:{chat_id}") used by
+    invalidate_cache() when events or writes change the underlying data.
+    """
+    tag_formats = [route] + list(tags or [])
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(**kwargs):
+            if not CACHE_ENABLED:
+                return await func(**kwargs)
+
+            key = f"{route}:{json.dumps(kwargs, sort_keys=True, default=str)}"
+            entry = response_cache.get(key)
+            if entry:
+                if entry[0] > time.monotonic():
+                    response_cache.move_to_end(key)
+                    cache_stats["hits"] += 1
+                    return entry[1]
+                _cache_drop(key)
+
+            # Another request is already fetching this - share its result
+            flight_key = f"cache:{key}"
+            if flight_key in inflight_calls:
+                cache_stats["coalesced"] += 1
+            else:
+                cache_stats["misses"] += 1
+
+            async def fetch():
+                generation = cache_generation
+                value = await func(**kwargs)
+                # Don't store results fetched while an invalidation happened
+                if generation == cache_generation:
+                    _cache_store(key, value, ttl, [t.format(**kwargs) for t in tag_formats])
+                return value
+
+            return await single_flight(flight_key, fetch, group=f"route:{route}")
+
+        return wrapper
+
+    return decorator
+
+# ============================================================================
+# Change Tracking & Conditional GET
+# ============================================================================
+
+def _is_channel_peer(peer_id: int) -> bool:
+    """Channels and supergroups have marked ids below -1000000000000"""
+    return peer_id <= -1000000000000
+
+def note_chat_changed(chat_id: Optional[int], kind: Optional[str] = None, ids: List[int] = (), messages: bool = True) -> int:
+    """Record that a chat's messages (or only its dialog entry) changed; returns the new sequence number
+
+    kind is "new", "edited" or "deleted" and, with ids, is appended to the
+    chat's change log for delta sync.
+    """
+    change_state["seq"] += 1
+    seq = change_state["seq"]
+    now = time.time()
+    if kind and ids:
+        log = chat_change_logs[chat_id]
+        if len(log) == log.maxlen:
+            chat_log_floor[chat_id] = log[0][0]
+        log.append((seq, kind, list(ids)))
+    if messages:
+        if chat_id is None:
+            change_state["unscoped_seq"] = seq
+        else:
+            chat_versions[chat_id] = seq
+            chat_modified[chat_id] = now
+    change_state["dialogs_seq"] = seq
+    change_state["dialogs_modified"] = now
+    return seq
+
+def change_token(seq: int) -> str:
+    """Opaque delta sync token; only valid for this server run"""
+    return f"{BOOT_ID}:{seq}"
+
+def parse_change_token(token: str) -> int:
+    """Return the sequence number of a token, raising 410 if it was issued by another server run"""
+    boot_id, _, seq = token.partition(":")
+    if not seq.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid change token")
+    if boot_id != BOOT_ID:
+        raise HTTPException(status_code=410, detail="Change token expired (server restarted); reload the chat")
+    return int(seq)
+
+def collect_changes(peer_id: int, since: int) -> Dict[str, List[int]]:
+    """Fold a chat's change log after `since` into the final new/edited/deleted message ids"""
+    logs = [chat_change_logs.get(peer_id, ())]
+    if not _is_channel_peer(peer_id):
+        logs.append(chat_change_logs.get(None, ()))
+
+    entries = sorted((entry for log in logs for entry in log if entry[0] > since), key=lambda entry: entry[0])
+    new, edited, deleted = {}, {}, {}
+    for _, kind, ids in entries:
+        for message_id in ids:
+            if kind == "new":
+                new[message_id] = True
+                deleted.pop(message_id, None)
+            elif kind == "edited":
+                if message_id not in new:
+                    edited[message_id] = True
+            elif kind == "deleted":
+                new.pop(message_id, None)
+                edited.pop(message_id, None)
+                deleted[message_id] = True
+
+    return {"new": sorted(new), "edited": sorted(edited), "deleted": sorted(deleted)}
+
+def chat_version(peer_id: int) -> Tuple[int, float]:
+    """Current (version, last modified time) of a chat's messages"""
+    version = chat_versions.get(peer_id, change_state["base_seq"])
+    modified = chat_modified.get(peer_id, 0.0)
+    if not _is_channel_peer(peer_id) and change_state["unscoped_seq"] > version:
+        version = change_state["unscoped_seq"]
+        modified = max(modified, change_state["dialogs_modified"])
+    return version, modified
+
+def check_not_modified(request: Request, version: int, modified: float) -> Tuple[Optional[Response], Dict[str, str]]:
+    """Build validators for a resource and return a 304 response if the client's copy is current.
+
+    Validators change with the data version and, as a safety net against
+    missed updates, at least every CONDITIONAL_GET_WINDOW seconds.
+    """
+    window = int(time.time() // CONDITIONAL_GET_WINDOW)
+    variant = hashlib.sha256(request.url.query.encode()).hexdigest()[:8]
+    etag = f'W/"{BOOT_ID}.{window}.{version}.{variant}"'
+    last_modified = int(max(modified, window * CONDITIONAL_GET_WINDOW))
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": "private, no-cache"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        not_modified = etag.removeprefix("W/") in candidates or "*" in candidates
+    elif request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+            not_modified = last_modified <= since
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+
+    return (Response(status_code=304, headers=headers) if not_modified else None), headers
+
+# ============================================================================
+# Metrics
+# ============================================================================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+
+def _format_labels(labels: tuple, values: tuple) -> str:
+    """Format a Prometheus label set"""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in zip(labels, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = defaultdict(float)
+        metrics_registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[tuple(labels[name] for name in self.labels)] += amount
+
+    def sync(self, total: float, **labels):
+        """Mirror a running total that is counted elsewhere"""
+        self.values[tuple(labels[name] for name in self.labels)] = total
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, value
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[tuple(labels[name] for name in self.labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram:
+    """Cumulative histogram with optional labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values: Dict[tuple, List[float]] = {}  # labels -> [bucket counts..., sum, count]
+        metrics_registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def samples(self):
+        for key, data in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, data):
+                yield f"{self.name}_bucket", key + (bound,), count
+            yield f"{self.name}_bucket", key + ("+Inf",), data[-1]
+            yield f"{self.name}_sum", key, data[-2]
+            yield f"{self.name}_count", key, data[-1]
+
+def _format_sample(value: float) -> str:
+    """Format a sample value without losing precision on large totals"""
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def render_metrics() -> str:
+    """Render all registered metrics in the Prometheus text format"""
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, key, value in metric.samples():
+            labels = metric.labels + ("le",) if name.endswith("_bucket") else metric.labels
+            lines.append(f"{name}{_format_labels(labels, key)} {_format_sample(value)}")
+    return "\n".join(lines) + "\n"
+
+metrics_registry: List[Any] = []
+
+http_requests_total = Counter("http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+rpc_requests_total = Counter("telegram_rpc_requests_total", "Telegram RPC calls by method and outcome", ("method", "status"))
+rpc_duration = Histogram("telegram_rpc_duration_seconds", "Telegram RPC latency by method", ("method",))
+flood_waits_total = Counter("telegram_flood_waits_total", "FloodWait errors by method", ("method",))
+flood_wait_seconds_total = Counter("telegram_flood_wait_seconds_total", "Seconds Telegram asked us to wait by method", ("method",))
+websocket_connections_gauge = Gauge("websocket_connections", "Open WebSocket connections")
+websocket_broadcasts_pending = Gauge("websocket_broadcasts_pending", "Broadcasts currently being delivered to WebSocket clients")
+websocket_broadcast_duration = Histogram("websocket_broadcast_duration_seconds", "Time to deliver one event to all WebSocket clients")
+websocket_send_failures_total = Counter("websocket_send_failures_total", "WebSocket sends that failed and dropped the connection")
+cache_events_total = Counter("response_cache_events_total", "Response cache lookups and maintenance events", ("event",))
+cache_hit_ratio = Gauge("response_cache_hit_ratio", "Fraction of cached route lookups served without a new Telegram call")
+cache_entries = Gauge("response_cache_entries", "Entries currently held in the response cache")
+singleflight_total = Counter("singleflight_calls_total", "Coalesced call groups by method and outcome", ("method", "outcome"))
+transfer_bytes_total = Counter("telegram_transfer_bytes_total", "Bytes downloaded from or uploaded to Telegram", ("direction", "endpoint"))
+transfer_duration = Histogram("telegram_transfer_duration_seconds", "Duration of media downloads and uploads", ("direction",))
+transfer_throughput = Histogram("telegram_transfer_throughput_bytes_per_second", "Media transfer throughput", ("direction",), THROUGHPUT_BUCKETS)
+
+def record_transfer(direction: str, endpoint: str, nbytes: int, seconds: float):
+    """Record bytes and throughput of a media download or upload"""
+    transfer_bytes_total.inc(nbytes, direction=direction, endpoint=endpoint)
+    transfer_duration.observe(seconds, direction=direction)
+    if seconds > 0:
+        transfer_throughput.observe(nbytes / seconds, direction=direction)
+
+def _collect_state_metrics():
+    """Copy point-in-time state (cache, single-flight, connections) into gauges"""
+    websocket_connections_gauge.set(len(websocket_connections))
+    for event, value in cache_stats.items():
+        cache_events_total.sync(value, event=event)
+    lookups = cache_stats["hits"] + cache_stats["misses"] + cache_stats["coalesced"]
+    cache_hit_ratio.set((cache_stats["hits"] + cache_stats["coalesced"]) / lookups if lookups else 0)
+    cache_entries.set(len(response_cache))
+    for method, group in singleflight_stats.items():
+        singleflight_total.sync(group["calls"], method=method, outcome="executed")
+        singleflight_total.sync(group["collapsed"], method=method, outcome="collapsed")
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """Count requests and time them per route template"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", "unmatched")
+        http_requests_total.inc(method=request.method, route=route_path, status=status)
+        http_request_duration.observe(time.perf_counter() - start, method=request.method, route=route_path)
+
+FLOOD_WAIT_ERRORS = (FloodWaitError, FloodPremiumWaitError, SlowModeWaitError, FloodTestPhoneWaitError)
+
+class InstrumentedTelegramClient(TelegramClient):
+    """TelegramClient that records per-RPC latency and FloodWait metrics
+
+    Telethon sleeps through short flood waits inside its own _call, where they
+    can't be counted and show up as RPC latency. Its handler reads
+    flood_sleep_threshold, so that reads 0 here and the configured threshold
+    lives in flood_retry_threshold; _call does the sleeping and retrying.
+    """
+
+    @property
+    def flood_sleep_threshold(self):
+        return 0
+
+    @flood_sleep_threshold.setter
+    def flood_sleep_threshold(self, value):
+        # Same clamping as Telethon's own setter
+        self.flood_retry_threshold = min(value or 0, 24 * 60 * 60)
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        if flood_sleep_threshold is None:
+            flood_sleep_threshold = self.flood_retry_threshold
+        method = "batch" if utils.is_list_like(request) else type(request).__name__
+
+        while True:
+            start = time.perf_counter()
+            status = "ok"
+            wait_seconds = 0
+            try:
+                return await super()._call(sender, request, ordered=ordered, flood_sleep_threshold=0)
+            except FLOOD_WAIT_ERRORS as e:
+                status = "flood_wait"
+                flood_waits_total.inc(method=method)
+                flood_wait_seconds_total.inc(e.seconds, method=method)
+                if e.seconds > flood_sleep_threshold:
+                    raise
+                wait_seconds = e.seconds
+                print(f"FloodWait on {method}: sleeping {wait_seconds}s")
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                rpc_requests_total.inc(method=method, status=status)
+                rpc_duration.observe(time.perf_counter() - start, method=method)
+            await asyncio.sleep(wait_seconds)
+
 # ============================================================================
 # Client Initialization
 # ============================================================================
@@ -232,7 +934,7 @@ async def init_client():
     # Store session files in data directory
     os.makedirs("data", exist_ok=True)
     session_name = f"data/telegram_session_{phone.replace('+', '')}"
-    client = TelegramClient(session_name, int(api_id), api_hash)
+    client = InstrumentedTelegramClient(session_name, int(api_id), api_hash)
     await client.connect()
 
     if not await client.is_user_authorized():
@@ -240,6 +942,65 @@ async def init_client():
 
     return {"status": "connected", "message": "Successfully connected to Telegram"}
 
+def first_dispatch(key: tuple) -> bool:
+    """Remember an update; False if it was already dispatched (live and replayed by catch-up)"""
+    if key in dispatched_updates:
+        return False
+    dispatched_updates[key] = None
+    if len(dispatched_updates) > DISPATCHED_UPDATES_SIZE:
+        dispatched_updates.popitem(last=False)
+    return True
+
+async def handle_new_message(message):
+    """Record and broadcast a new message (live or replayed by catch-up)"""
+    if not first_dispatch(("new", message.chat_id, message.id)):
+        return
+    note_chat_changed(message.chat_id, "new", [message.id])
+    message_data = {
+        "type": "new_message",
+        "chat_id": str(message.chat_id),
+        "message": {
+            "id": message.id,
+            "text": message.text or "",
+            "date": message.date.isoformat() if message.date else None,
+            "sender_id": message.sender_id if hasattr(message, 'sender_id') else None,
+            "is_out": message.out if hasattr(message, 'out') else False,
+            "grouped_id": getattr(message, 'grouped_id', None),  # Shared by the messages of an album
+            **describe_media(message, message.chat_id)
+        }
+    }
+    await broadcast_to_websockets(message_data)
+
+async def handle_message_edited(message):
+    """Record and broadcast an edited message (live or replayed by catch-up)"""
+    edit_date = message.edit_date.timestamp() if getattr(message, 'edit_date', None) else None
+    if not first_dispatch(("edited", message.chat_id, message.id, edit_date)):
+        return
+    note_chat_changed(message.chat_id, "edited", [message.id])
+    message_data = {
+        "type": "message_edited",
+        "chat_id": str(message.chat_id),
+        "message": {
+            "id": message.id,
+            "text": message.text or "",
+            "date": message.date.isoformat() if message.date else None
+        }
+    }
+    await broadcast_to_websockets(message_data)
+
+async def handle_messages_deleted(chat_id: Optional[int], deleted_ids: List[int]):
+    """Record and broadcast deleted messages; chat_id is None when Telegram doesn't say which chat"""
+    deleted_ids = [message_id for message_id in deleted_ids if first_dispatch(("deleted", chat_id, message_id))]
+    if not deleted_ids:
+        return
+    note_chat_changed(chat_id, "deleted", deleted_ids)
+    message_data = {
+        "type": "message_deleted",
+        "chat_id": str(chat_id),
+        "deleted_ids": deleted_ids
+    }
+    await broadcast_to_websockets(message_data)
+
 async def setup_event_handlers():
     """Setup Telegram event handlers for real-time updates"""
     if not client or not client.is_connected():
@@ -249,18 +1010,7 @@ async def setup_event_handlers():
     async def new_message_handler(event):
         """Handle new messages"""
         try:
-            message_data = {
-                "type": "new_message",
-                "chat_id": str(event.chat_id),
-                "message": {
-                    "id": event.message.id,
-                    "text": event.message.text or "",
-                    "date": event.message.date.isoformat() if event.message.date else None,
-                    "sender_id": event.message.sender_id if hasattr(event.message, 'sender_id') else None,
-                    "is_out": event.message.out if hasattr(event.message, 'out') else False
-                }
-            }
-            await broadcast_to_websockets(message_data)
+            await handle_new_message(event.message)
         except Exception as e:
             print(f"Error in new_message_handler: {e}")
 
@@ -268,16 +1018,7 @@ async def setup_event_handlers():
     async def message_edited_handler(event):
         """Handle edited messages"""
         try:
-            message_data = {
-                "type": "message_edited",
-                "chat_id": str(event.chat_id),
-                "message": {
-                    "id": event.message.id,
-                    "text": event.message.text or "",
-                    "date": event.message.date.isoformat() if event.message.date else None
-                }
-            }
-            await broadcast_to_websockets(message_data)
+            await handle_message_edited(event.message)
         except Exception as e:
             print(f"Error in message_edited_handler: {e}")
 
@@ -285,12 +1026,7 @@ async def setup_event_handlers():
     async def message_deleted_handler(event):
         """Handle deleted messages"""
         try:
-            message_data = {
-                "type": "message_deleted",
-                "chat_id": str(event.chat_id),
-                "deleted_ids": event.deleted_ids
-            }
-            await broadcast_to_websockets(message_data)
+            await handle_messages_deleted(event.chat_id, event.deleted_ids)
         except Exception as e:
             print(f"Error in message_deleted_handler: {e}")
 
@@ -298,6 +1034,8 @@ async def setup_event_handlers():
     async def chat_action_handler(event):
         """Handle chat actions (user joined, left, etc.)"""
         try:
+            invalidate_cache(f"chat:{event.chat_id}")
+            note_chat_changed(event.chat_id)
             action_data = {
                 "type": "chat_action",
                 "chat_id": str(event.chat_id),
@@ -307,33 +1045,440 @@ async def setup_event_handlers():
         except Exception as e:
             print(f"Error in chat_action_handler: {e}")
 
+    @client.on(events.MessageRead)
+    async def message_read_handler(event):
+        """Track read receipts - they change unread counts in the dialog list"""
+        try:
+            note_chat_changed(event.chat_id, messages=False)
+        except Exception as e:
+            print(f"Error in message_read_handler: {e}")
+
+    @client.on(events.Raw([types.UpdateNewChannelMessage, types.UpdateEditChannelMessage, types.UpdateDeleteChannelMessages]))
+    async def channel_pts_handler(update):
+        """Track each channel's pts so catch-up can resume its update stream after a restart"""
+        channel_id = getattr(update, "channel_id", None) or getattr(getattr(update.message, "peer_id", None), "channel_id", None)
+        if channel_id and update.pts > update_state["channels"].get(channel_id, 0):
+            update_state["channels"][channel_id] = update.pts
+
+# ============================================================================
+# Update Sync
+# ============================================================================
+
+def _read_sync_state() -> Optional[Dict]:
+    """Read the persisted sync state (run in the thread pool)"""
+    if not os.path.exists(SYNC_STATE_FILE):
+        return None
+    with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_sync_state(payload: Dict):
+    """Atomically replace the persisted sync state (run in the thread pool)"""
+    os.makedirs(os.path.dirname(SYNC_STATE_FILE) or ".", exist_ok=True)
+    tmp_path = f"{SYNC_STATE_FILE}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, SYNC_STATE_FILE)
+
+async def save_sync_state(clean: bool = False):
+    """Persist update state and change logs; `clean` marks an orderly shutdown"""
+    payload = {
+        "epoch": BOOT_ID,
+        "seq": change_state["seq"],
+        "clean": clean,
+        "account": update_state["account"],
+        "channels": {str(channel_id): pts for channel_id, pts in update_state["channels"].items()},
+        "change_logs": {
+            "unscoped" if peer_id is None else str(peer_id): list(log) for peer_id, log in chat_change_logs.items()
+        },
+        "log_floor": {"unscoped" if peer_id is None else str(peer_id): floor for peer_id, floor in chat_log_floor.items()},
+        "saved_at": time.time()
+    }
+    await run_in_threadpool(_write_sync_state, payload)
+
+async def load_sync_state():
+    """Restore update state at startup; change tokens stay valid only after a clean shutdown"""
+    global BOOT_ID
+    try:
+        saved = await run_in_threadpool(_read_sync_state)
+    except (OSError, ValueError) as e:
+        print(f"Could not read {SYNC_STATE_FILE}: {e}")
+        saved = None
+    if not saved:
+        return
+
+    update_state["account"] = saved.get("account")
+    update_state["channels"] = {int(channel_id): pts for channel_id, pts in saved.get("channels", {}).items()}
+
+    if saved.get("clean") and saved.get("epoch"):
+        BOOT_ID = saved["epoch"]
+        change_state["seq"] = change_state["base_seq"] = change_state["dialogs_seq"] = saved.get("seq", 0)
+        for key, entries in saved.get("change_logs", {}).items():
+            chat_change_logs[None if key == "unscoped" else int(key)].extend(tuple(entry) for entry in entries)
+        for key, floor in saved.get("log_floor", {}).items():
+            chat_log_floor[None if key == "unscoped" else int(key)] = floor
+        sync_progress["resumed"] = True
+
+    # Until the next clean shutdown, a crash must not reuse this epoch
+    await save_sync_state(clean=False)
+
+async def snapshot_update_state():
+    """Record the account's current pts/qts/date/seq"""
+    state = await client(GetStateRequest())
+    update_state["account"] = {"pts": state.pts, "qts": state.qts, "date": int(state.date.timestamp()), "seq": state.seq}
+
+def invalidate_change_tokens(peer_id: Optional[int] = None):
+    """Force clients to resync after an update gap, for one chat or (peer_id None) all chats"""
+    change_state["seq"] += 1
+    if peer_id is None:
+        change_state["floor"] = change_state["base_seq"] = change_state["dialogs_seq"] = change_state["seq"]
+        chat_versions.clear()
+    else:
+        chat_log_floor[peer_id] = change_state["seq"]
+        chat_versions[peer_id] = change_state["seq"]
+    sync_progress["gap"] = True
+
+REPLAYED_MESSAGE_UPDATES = (types.UpdateNewMessage, types.UpdateNewChannelMessage,
+                            types.UpdateEditMessage, types.UpdateEditChannelMessage)
+
+async def _fetch_replayed_messages(updates: list, entities: Dict[int, Any]) -> Dict[tuple, Any]:
+    """Load the messages of replayed updates through the client, as the live handlers receive them"""
+    wanted: Dict[int, List[int]] = defaultdict(list)
+    for update in updates:
+        if isinstance(update, REPLAYED_MESSAGE_UPDATES) and isinstance(update.message, (types.Message, types.MessageService)):
+            wanted[utils.get_peer_id(update.message.peer_id)].append(update.message.id)
+
+    messages = {}
+    for peer_id, message_ids in wanted.items():
+        entity = entities.get(peer_id) or await client.get_input_entity(peer_id)
+        for start in range(0, len(message_ids), 100):
+            for message in await client.get_messages(entity, ids=message_ids[start:start + 100]):
+                if message:  # Deleted since; its deletion is replayed too
+                    messages[(peer_id, message.id)] = message
+    return messages
+
+async def dispatch_replayed_update(update, messages: Dict[tuple, Any]) -> bool:
+    """Feed an update from getDifference through the live event handlers"""
+    if isinstance(update, REPLAYED_MESSAGE_UPDATES):
+        if not isinstance(update.message, (types.Message, types.MessageService)):
+            return False
+        message = messages.get((utils.get_peer_id(update.message.peer_id), update.message.id))
+        if message is None:
+            return False
+        if isinstance(update, (types.UpdateNewMessage, types.UpdateNewChannelMessage)):
+            await handle_new_message(message)
+        else:
+            await handle_message_edited(message)
+    elif isinstance(update, types.UpdateDeleteMessages):
+        await handle_messages_deleted(None, update.messages)
+    elif isinstance(update, types.UpdateDeleteChannelMessages):
+        await handle_messages_deleted(utils.get_peer_id(types.PeerChannel(update.channel_id)), update.messages)
+    elif isinstance(update, (types.UpdateReadHistoryInbox, types.UpdateReadHistoryOutbox)):
+        note_chat_changed(utils.get_peer_id(update.peer), messages=False)
+    elif isinstance(update, types.UpdateReadChannelInbox):
+        note_chat_changed(utils.get_peer_id(types.PeerChannel(update.channel_id)), messages=False)
+    else:
+        return False
+    sync_progress["updates_applied"] += 1
+    return True
+
+async def _replay_difference(diff):
+    """Dispatch the messages and updates of a (channel) difference"""
+    entities = {utils.get_peer_id(entity): entity for entity in diff.users + diff.chats}
+    updates = [types.UpdateNewMessage(message, 0, 0) for message in diff.new_messages] + list(diff.other_updates)
+    messages = await _fetch_replayed_messages(updates, entities)
+    for update in updates:
+        await dispatch_replayed_update(update, messages)
+
+async def _catch_up_account() -> Dict[int, Optional[int]]:
+    """Replay account-wide updates (private chats and basic groups) since the saved state
+
+    Returns the channels Telegram reported as too long to include (channel id -> pts, if given);
+    their missed updates have to be fetched with getChannelDifference.
+    """
+    account = update_state["account"]
+    channels_too_long: Dict[int, Optional[int]] = {}
+    sync_progress["pts_start"] = sync_progress["pts"] = account["pts"]
+    sync_progress["pts_target"] = (await client(GetStateRequest())).pts
+
+    while True:
+        diff = await client(GetDifferenceRequest(
+            pts=account["pts"],
+            date=datetime.fromtimestamp(account["date"], tz=timezone.utc),
+            qts=account["qts"]
+        ))
+
+        if isinstance(diff, types.updates.DifferenceEmpty):
+            account.update(date=int(diff.date.timestamp()), seq=diff.seq)
+            break
+        if isinstance(diff, types.updates.DifferenceTooLong):
+            # Too much happened to replay; clients must reload
+            invalidate_change_tokens()
+            account["pts"] = diff.pts
+            sync_progress["pts"] = diff.pts
+            continue
+
+        for update in diff.other_updates:
+            if isinstance(update, types.UpdateChannelTooLong):
+                channels_too_long[update.channel_id] = update.pts
+        await _replay_difference(diff)
+        state = diff.state if isinstance(diff, types.updates.Difference) else diff.intermediate_state
+        account.update(pts=state.pts, qts=state.qts, date=int(state.date.timestamp()), seq=state.seq)
+        sync_progress["pts"] = state.pts
+        if isinstance(diff, types.updates.Difference):
+            break
+    return channels_too_long
+
+async def _seed_channel_pts(channel_id: int, pts: Optional[int]):
+    """Start tracking a channel with missed updates that had no saved pts"""
+    peer_id = utils.get_peer_id(types.PeerChannel(channel_id))
+    if pts is None:
+        input_channel = await client.get_input_entity(types.PeerChannel(channel_id))
+        dialogs = await client(GetPeerDialogsRequest([types.InputDialogPeer(input_channel)]))
+        pts = dialogs.dialogs[0].pts
+    # Without a saved pts there's no telling what was missed before it
+    invalidate_change_tokens(peer_id)
+    update_state["channels"][channel_id] = pts
+
+async def _catch_up_channel(channel_id: int):
+    """Replay one channel's updates since its saved pts"""
+    input_channel = await client.get_input_entity(types.PeerChannel(channel_id))
+    peer_id = utils.get_peer_id(types.PeerChannel(channel_id))
+
+    while True:
+        diff = await client(GetChannelDifferenceRequest(
+            channel=input_channel,
+            filter=types.ChannelMessagesFilterEmpty(),
+            pts=update_state["channels"][channel_id],
+            limit=100,
+            force=True
+        ))
+
+        if isinstance(diff, types.updates.ChannelDifferenceTooLong):
+            invalidate_change_tokens(peer_id)
+            update_state["channels"][channel_id] = diff.dialog.pts
+            return
+        if isinstance(diff, types.updates.ChannelDifference):
+            await _replay_difference(diff)
+        update_state["channels"][channel_id] = max(diff.pts, update_state["channels"].get(channel_id, 0))
+        if diff.final:
+            return
+
+async def catch_up_missed_updates():
+    """Replay updates that happened while the server was down through the live handlers"""
+    sync_progress.update(status="running", started_at=time.time(), error=None)
+    try:
+        channels_too_long = {}
+        if update_state["account"] is None:
+            # First run: nothing to catch up on, start tracking from now
+            await snapshot_update_state()
+        else:
+            channels_too_long = await _catch_up_account()
+
+        for channel_id, pts in channels_too_long.items():
+            if channel_id not in update_state["channels"]:
+                try:
+                    await _seed_channel_pts(channel_id, pts)
+                except Exception as e:
+                    print(f"Catch-up could not start tracking channel {channel_id}: {e}")
+
+        channel_ids = list(update_state["channels"])
+        sync_progress["channels_total"] = len(channel_ids)
+        for channel_id in channel_ids:
+            try:
+                await _catch_up_channel(channel_id)
+                sync_progress["channels_done"] += 1
+            except Exception as e:
+                sync_progress["channels_skipped"] += 1
+                print(f"Catch-up skipped channel {channel_id}: {e}")
+
+        sync_progress.update(status="done", finished_at=time.time())
+        await save_sync_state()
+        print(f"Catch-up complete: {sync_progress['updates_applied']} updates applied")
+    except asyncio.CancelledError:
+        sync_progress["status"] = "cancelled"
+        raise
+    except Exception as e:
+        sync_progress.update(status="failed", finished_at=time.time(), error=str(e))
+        print(f"Error catching up on missed updates: {e}")
+
+async def persist_update_state():
+    """Periodically snapshot the update state so a crash replays at most SYNC_STATE_INTERVAL of updates"""
+    while True:
+        await asyncio.sleep(SYNC_STATE_INTERVAL)
+        if sync_progress["status"] != "done" or not client or not client.is_connected():
+            continue
+        try:
+            await snapshot_update_state()
+            await save_sync_state()
+        except Exception as e:
+            print(f"Error saving update state: {e}")
+
+# ============================================================================
+# Static Assets
+# ============================================================================
+
+# filename -> (media type, compress)
+STATIC_ASSETS = {
+    "index.html": ("text/html; charset=utf-8", True),
+    "manifest.json": ("application/json", True),
+    "sw.js": ("application/javascript", True),
+    "asset-manifest.json": ("application/json", True),
+    "icon-192.png": ("image/png", False),
+    "icon-512.png": ("image/png", False),
+}
+
+# Immutable URLs written by update_version.py: /assets/<name>.<content hash><ext>
+HASHED_ASSET_PATTERN = re.compile(r"^(?P<stem>[\w.-]+)\.(?P<hash>[0-9a-f]{8,64})(?P<ext>\.\w+)$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# filename -> {"mtime", "hash", "etag", "media_type", "variants": {encoding: bytes}}
+static_assets: Dict[str, Dict[str, Any]] = {}
+
+def _build_static_asset(filename: str) -> Optional[Dict[str, Any]]:
+    """Read an asset and precompute its ETag and compressed variants (run in the thread pool)"""
+    media_type, compress = STATIC_ASSETS[filename]
+    try:
+        mtime = os.stat(filename).st_mtime
+        with open(filename, "rb") as f:
+            body = f.read()
+    except FileNotFoundError:
+        return None
+
+    variants = {"identity": body}
+    if compress:
+        gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(gzipped) < len(body):
+            variants["gzip"] = gzipped
+        if brotli:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                variants["br"] = compressed
+
+    digest = hashlib.sha256(body).hexdigest()
+    return {
+        "mtime": mtime,
+        "hash": digest,
+        "etag": digest[:20],
+        "media_type": media_type,
+        "variants": variants
+    }
+
+def _changed_static_assets() -> List[str]:
+    """List assets whose file changed since they were loaded (run in the thread pool)"""
+    changed = []
+    for filename in STATIC_ASSETS:
+        try:
+            mtime = os.stat(filename).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        current = static_assets.get(filename)
+        if (current["mtime"] if current else None) != mtime:
+            changed.append(filename)
+    return changed
+
+async def reload_static_assets(filenames: Optional[List[str]] = None):
+    """(Re)load static assets into memory"""
+    for filename in filenames or list(STATIC_ASSETS):
+        asset = await run_in_threadpool(_build_static_asset, filename)
+        if asset:
+            static_assets[filename] = asset
+        else:
+            static_assets.pop(filename, None)
+
+async def watch_static_assets():
+    """Reload static assets when their files change on disk"""
+    while True:
+        await asyncio.sleep(STATIC_RELOAD_INTERVAL)
+        try:
+            changed = await run_in_threadpool(_changed_static_assets)
+            if changed:
+                await reload_static_assets(changed)
+                print(f"Reloaded static assets: {', '.join(changed)}")
+        except Exception as e:
+            print(f"Error reloading static assets: {e}")
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    """Parse an Accept-Encoding header into the set of acceptable codings"""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if coding:
+            accepted.add(coding.lower())
+    return accepted
+
+async def serve_static_asset(request: Request, filename: str, cache_control: str = "no-cache") -> Optional[Response]:
+    """Serve an in-memory asset with content negotiation and ETag revalidation"""
+    if filename not in static_assets:
+        await reload_static_assets([filename])
+    asset = static_assets.get(filename)
+    if not asset:
+        return None
+
+    accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+    encoding = next((e for e in ("br", "gzip") if e in accepted and e in asset["variants"]), "identity")
+    etag = f'"{asset["etag"]}"' if encoding == "identity" else f'"{asset["etag"]}-{encoding}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+
+    # Any representation of the same content is still valid for the client
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or asset["etag"] in if_none_match:
+        return Response(status_code=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=asset["variants"][encoding], media_type=asset["media_type"], headers=headers)
+
 # ============================================================================
 # Basic Routes
 # ============================================================================
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
+async def read_root(request: Request):
     """Serve the main HTML page"""
-    with open("index.html", "r", encoding="utf-8") as f:
-        return f.read()
+    return await serve_static_asset(request, "index.html")
 
 @app.get("/manifest.json")
-async def get_manifest():
+async def get_manifest(request: Request):
     """Serve PWA manifest"""
-    with open("manifest.json", "r", encoding="utf-8") as f:
-        return JSONResponse(content=json.load(f))
+    return await serve_static_asset(request, "manifest.json")
 
 @app.get("/sw.js")
-async def get_service_worker():
+async def get_service_worker(request: Request):
     """Serve service worker"""
-    with open("sw.js", "r", encoding="utf-8") as f:
-        return Response(content=f.read(), media_type="application/javascript")
+    return await serve_static_asset(request, "sw.js")
+
+@app.get("/asset-manifest.json")
+async def get_asset_manifest(request: Request):
+    """Serve the content-hashed asset manifest generated by update_version.py"""
+    response = await serve_static_asset(request, "asset-manifest.json")
+    if not response:
+        raise HTTPException(status_code=404, detail="Asset manifest not built - run update_version.py")
+    return response
+
+@app.get("/assets/{asset_name}")
+async def get_hashed_asset(asset_name: str, request: Request):
+    """Serve a content-hashed asset URL with long-lived immutable caching"""
+    match = HASHED_ASSET_PATTERN.match(asset_name)
+    filename = f"{match.group('stem')}{match.group('ext')}" if match else None
+    if filename not in STATIC_ASSETS or filename == "asset-manifest.json":
+        raise HTTPException(status_code=404, detail="Asset not found")
+
+    if filename not in static_assets:
+        await reload_static_assets([filename])
+    asset = static_assets.get(filename)
+    # Only serve the exact content the hash names; stale URLs must not be cached forever
+    if not asset or not asset["hash"].startswith(match.group("hash")):
+        raise HTTPException(status_code=404, detail="Asset version not found")
+    return await serve_static_asset(request, filename, cache_control=IMMUTABLE_CACHE_CONTROL)
 
 @app.get("/icon-192.png")
-async def get_icon_192():
+async def get_icon_192(request: Request):
     """Serve 192x192 icon - returns placeholder if not found"""
-    if os.path.exists("icon-192.png"):
-        return FileResponse("icon-192.png", media_type="image/png")
+    response = await serve_static_asset(request, "icon-192.png")
+    if response:
+        return response
     else:
         # Return a simple SVG placeholder
         svg = '''<svg xmlns="http://www.w3.org/2000/svg" width="192" height="192" viewBox="0 0 192 192">
@@ -343,10 +1488,11 @@ async def get_icon_192():
         return Response(content=svg, media_type="image/svg+xml")
 
 @app.get("/icon-512.png")
-async def get_icon_512():
+async def get_icon_512(request: Request):
     """Serve 512x512 icon - returns placeholder if not found"""
-    if os.path.exists("icon-512.png"):
-        return FileResponse("icon-512.png", media_type="image/png")
+    response = await serve_static_asset(request, "icon-512.png")
+    if response:
+        return response
     else:
         # Return a simple SVG placeholder
         svg = '''<svg xmlns="http://www.w3.org/2000/svg" width="512" height="512" viewBox="0 0 512 512">
@@ -381,6 +1527,47 @@ async def get_status():
     else:
         return {"status": "disconnected", "message": "Not connected to Telegram"}
 
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Get response cache statistics"""
+    lookups = cache_stats["hits"] + cache_stats["misses"] + cache_stats["coalesced"]
+    return {
+        "enabled": CACHE_ENABLED,
+        "entries": len(response_cache),
+        "max_entries": CACHE_MAX_ENTRIES,
+        "hit_ratio": round((cache_stats["hits"] + cache_stats["coalesced"]) / lookups, 4) if lookups else 0.0,
+        **cache_stats
+    }
+
+@app.get("/api/singleflight/stats")
+async def get_singleflight_stats():
+    """Get request coalescing statistics per Telethon method"""
+    calls = sum(group["calls"] for group in singleflight_stats.values())
+    collapsed = sum(group["collapsed"] for group in singleflight_stats.values())
+    return {
+        "in_flight": len(inflight_calls),
+        "calls": calls,
+        "collapsed": collapsed,
+        "methods": {name: dict(group) for name, group in sorted(singleflight_stats.items())}
+    }
+
+@app.get("/api/sync/status")
+async def get_sync_status():
+    """Get progress of the catch-up on updates missed while the server was down"""
+    progress = dict(sync_progress)
+    if progress["pts_target"] is not None and progress["pts_start"] is not None:
+        span = progress["pts_target"] - progress["pts_start"]
+        progress["account_progress"] = round(min(1.0, (progress["pts"] - progress["pts_start"]) / span), 4) if span > 0 else 1.0
+    progress["account_state"] = update_state["account"]
+    progress["tracked_channels"] = len(update_state["channels"])
+    return progress
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Expose metrics in the Prometheus text format"""
+    _collect_state_metrics()
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.post("/api/authenticate")
 async def authenticate(request: Request):
     """Authenticate with code"""
@@ -401,7 +1588,7 @@ async def authenticate(request: Request):
         # Store session files in data directory
         os.makedirs("data", exist_ok=True)
         session_name = f"data/telegram_session_{phone.replace('+', '')}"
-        client = TelegramClient(session_name, int(api_id), api_hash)
+        client = InstrumentedTelegramClient(session_name, int(api_id), api_hash)
         await client.connect()
 
         try:
@@ -413,6 +1600,8 @@ async def authenticate(request: Request):
 
         me = await client.get_me()
         await setup_event_handlers()
+        if sync_progress["status"] != "running":
+            asyncio.create_task(catch_up_missed_updates())
 
         return {
             "status": "success",
@@ -430,10 +1619,15 @@ async def authenticate(request: Request):
 # ============================================================================
 
 @app.get("/api/chats")
-async def get_chats(limit: int = 50):
+async def get_chats(request: Request, response: Response, limit: int = 50):
     """Get list of chats"""
     check_client_connected()
 
+    not_modified, validators = check_not_modified(request, change_state["dialogs_seq"], change_state["dialogs_modified"])
+    if not_modified:
+        return not_modified
+    response.headers.update(validators)
+
     try:
         dialogs = await client.get_dialogs(limit=limit)
         chats = []
@@ -452,6 +1646,7 @@ async def get_chats(limit: int = 50):
             if dialog.message:
                 chat_info["last_message"] = dialog.message.text[:100] if dialog.message.text else None
                 chat_info["last_message_date"] = dialog.message.date.isoformat() if dialog.message.date else None
+                chat_info["last_message_id"] = dialog.message.id
 
             chats.append(chat_info)
 
@@ -460,6 +1655,7 @@ async def get_chats(limit: int = 50):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/chats/{chat_id}")
+@cached_response("chat", ttl=300, tags=["chat:{chat_id}"])
 async def get_chat_info(chat_id: str):
     """Get detailed chat information"""
     check_client_connected()
@@ -540,6 +1736,7 @@ async def edit_chat(chat_id: str, request: EditChatRequest):
             if isinstance(entity, types.Channel):
                 await client.edit_admin(entity, about=request.about)
 
+        invalidate_cache(f"chat:{chat_id}")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -553,15 +1750,16 @@ async def set_chat_photo(chat_id: str, file: UploadFile = File(...)):
         entity = await get_entity_safe(chat_id)
 
         # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp_file:
-            shutil.copyfileobj(file.file, tmp_file)
-            tmp_path = tmp_file.name
+        tmp_path = await save_upload_to_temp(file)
 
         try:
+            upload_start = time.perf_counter()
             await client.edit_photo(entity, tmp_path)
+            record_transfer("upload", "chat-photo", os.path.getsize(tmp_path), time.perf_counter() - upload_start)
+            invalidate_cache(f"chat:{chat_id}")
             return {"status": "success"}
         finally:
-            os.unlink(tmp_path)
+            await remove_temp_file(tmp_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -602,6 +1800,7 @@ async def add_members(chat_id: str, request: AddMembersRequest):
             user_entities.append(user_entity)
 
         await client.add_participants(entity, user_entities)
+        invalidate_cache(f"chat:{chat_id}")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -620,11 +1819,13 @@ async def remove_members(chat_id: str, request: RemoveMembersRequest):
             user_entities.append(user_entity)
 
         await client.delete_participants(entity, user_entities)
+        invalidate_cache(f"chat:{chat_id}")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/chats/{chat_id}/invite-link")
+@cached_response("invite-link", ttl=600, tags=["chat:{chat_id}"])
 async def get_invite_link(chat_id: str):
     """Get or create invite link"""
     check_client_connected()
@@ -643,124 +1844,287 @@ async def get_invite_link(chat_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Export formats: format -> (media type, file extension)
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "zstd": ("application/zstd", "ndjson.zst"),
+    "gzip": ("application/gzip", "ndjson.gz"),
+}
+
+def _export_compressor(export_format: str):
+    """Return (compress, flush) for an export format; flush(final) ends a chunk, or the stream when final"""
+    if export_format == "zstd":
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        return compressor.compress, lambda final: compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+    if export_format == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress, lambda final: compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return (lambda data: data), (lambda final: b"")
+
+def _ndjson_line(record: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(record) + b"\n"
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+def media_manifest(msg, chat_id) -> Optional[Dict[str, Any]]:
+    """Where and what to download for a message's file; media_id is stable, so it can key a file store"""
+    file_id = media_file_id(msg)
+    if file_id is None:
+        return None
+    return {
+        "media_id": file_id,
+        "size": msg.file.size,
+        "mime_type": msg.file.mime_type,
+        "file_name": msg.file.name,
+        "url": f"/api/files/download/{chat_id}/{msg.id}"
+    }
+
+@asynccontextmanager
+async def export_session(use_takeout: bool):
+    """Yield (client, is_takeout): a takeout session when Telegram grants one, the regular client otherwise"""
+    session = None
+    if use_takeout and not export_takeout_lock.locked():
+        await export_takeout_lock.acquire()
+        takeout = client.takeout(users=True, chats=True, megagroups=True, channels=True)
+        try:
+            session = await takeout.__aenter__()
+        except Exception as e:
+            # E.g. TakeoutInitDelayError until the user approves the export in another session
+            export_takeout_lock.release()
+            print(f"Takeout session unavailable, exporting without it: {e}")
+
+    if session is None:
+        yield client, False
+        return
+
+    try:
+        yield session, True
+    except BaseException as e:
+        # Finishing with an exception tells Telegram the takeout did not succeed
+        await takeout.__aexit__(type(e), e, e.__traceback__)
+        raise
+    else:
+        await takeout.__aexit__(None, None, None)
+    finally:
+        export_takeout_lock.release()
+
+@app.get("/api/chats/{chat_id}/export")
+async def export_chat(chat_id: str, after_id: int = 0, format: str = "ndjson", media: bool = False,
+                      takeout: bool = EXPORT_USE_TAKEOUT):
+    """Stream a chat's whole history, oldest first, as NDJSON (optionally zstd or gzip compressed)"""
+    check_client_connected()
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if format == "zstd" and zstandard is None:
+        raise HTTPException(status_code=400, detail="zstd export needs the zstandard package")
+
+    entity = await get_entity_safe(chat_id)
+    peer_id = utils.get_peer_id(entity)
+    media_type, extension = EXPORT_FORMATS[format]
+
+    async def generate():
+        compress, flush = _export_compressor(format)
+        buffered = []
+        exported = 0
+        async with export_session(takeout) as (session, is_takeout):
+            print(f"Exporting chat {peer_id} after message {after_id}{' (takeout)' if is_takeout else ''}")
+            # The entity is resolved once; takeout sessions may skip the delays between history requests
+            async for msg in session.iter_messages(entity, reverse=True, offset_id=after_id,
+                                                   wait_time=0 if is_takeout else None):
+                record = serialize_message(msg, chat_id)
+                if media and msg.media:
+                    record["media_manifest"] = media_manifest(msg, chat_id)
+                buffered.append(compress(_ndjson_line(record)))
+                exported += 1
+                if exported % EXPORT_FRAME_MESSAGES == 0:
+                    buffered.append(flush(False))
+                    yield b"".join(buffered)
+                    buffered = []
+        buffered.append(flush(True))
+        yield b"".join(buffered)
+        print(f"Exported {exported} messages from chat {peer_id}")
+
+    headers = {"Content-Disposition": f'attachment; filename="chat_{peer_id}_after_{after_id}.{extension}"'}
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
 # ============================================================================
 # Message Management
 # ============================================================================
 
+LINK_URL_PATTERN = re.compile(r'https?://[^\s<>"{}|\\^`\[\]]+[^\s<>"{}|\\^`\[\].,;:!?]')
+
+def media_file_id(msg) -> Optional[str]:
+    """Stable ID of a message's photo or document file, e.g. "document:5123..."; None without one"""
+    media = getattr(msg, 'photo', None) or getattr(msg, 'document', None)
+    if media is None or msg.file is None:
+        return None
+    return f"{'photo' if isinstance(media, types.Photo) else 'document'}:{media.id}"
+
+def describe_media(msg, chat_id) -> Dict[str, Any]:
+    """Media fields of a message as returned by the messages API and the event stream"""
+    if not msg.media:
+        return {"has_media": False}
+
+    media_data = {"has_media": True, "media_type": type(msg.media).__name__}
+
+    # Get media details based on media type
+    media = msg.media
+
+    # Check for photo
+    if isinstance(media, types.MessageMediaPhoto):
+        media_data["media_category"] = "photo"
+    # Check for document (which can be video, audio, image, or file)
+    elif isinstance(media, types.MessageMediaDocument):
+        doc = media.document
+        media_data["mime_type"] = getattr(doc, 'mime_type', None) or ""
+
+        # Get file name from attributes
+        file_name = None
+        if hasattr(doc, 'attributes'):
+            for attr in doc.attributes:
+                if isinstance(attr, types.DocumentAttributeFilename):
+                    file_name = attr.file_name
+                    break
+                elif isinstance(attr, types.DocumentAttributeAudio):
+                    if hasattr(attr, 'title') and attr.title:
+                        file_name = f"{attr.title}.mp3"
+                    break
+
+        media_data["file_name"] = file_name
+
+        # Determine category based on mime type and attributes
+        if media_data["mime_type"].startswith('video/'):
+            media_data["media_category"] = "video"
+        elif media_data["mime_type"].startswith('audio/') or media_data["mime_type"] == 'audio/ogg':
+            media_data["media_category"] = "audio"
+        elif media_data["mime_type"].startswith('image/'):
+            media_data["media_category"] = "image"
+        else:
+            media_data["media_category"] = "document"
+
+        # Check for video note (circular video)
+        if hasattr(doc, 'attributes'):
+            for attr in doc.attributes:
+                if isinstance(attr, types.DocumentAttributeVideo):
+                    if hasattr(attr, 'round_message') and attr.round_message:
+                        media_data["media_category"] = "video_note"
+                    break
+    # Check for geo location
+    elif isinstance(media, types.MessageMediaGeo):
+        media_data["media_category"] = "location"
+    # Check for contact
+    elif isinstance(media, types.MessageMediaContact):
+        media_data["media_category"] = "contact"
+    # Check for poll
+    elif isinstance(media, types.MessageMediaPoll):
+        media_data["media_category"] = "poll"
+    # Check for webpage/link preview
+    elif isinstance(media, types.MessageMediaWebPage):
+        media_data["media_category"] = "webpage"
+        webpage = media.webpage
+        if isinstance(webpage, types.WebPage):
+            media_data["webpage_url"] = webpage.url
+            media_data["webpage_title"] = getattr(webpage, 'title', None) or ""
+            media_data["webpage_description"] = getattr(webpage, 'description', None) or ""
+            media_data["webpage_site_name"] = getattr(webpage, 'site_name', None) or ""
+
+            # Get thumbnail if available
+            if hasattr(webpage, 'photo') and webpage.photo:
+                media_data["webpage_thumb_url"] = f"/api/files/preview/{chat_id}/{msg.id}?thumb=true"
+            else:
+                media_data["webpage_thumb_url"] = None
+    else:
+        media_data["media_category"] = "unknown"
+
+    # Identify the file itself (the same across chats it's forwarded to), so clients can skip files they have
+    file_id = media_file_id(msg)
+    if file_id:
+        media_data["media_id"] = file_id
+        media_data["file_size"] = msg.file.size
+
+    # Store message ID for media download
+    media_data["media_message_id"] = msg.id
+
+    return media_data
+
+def serialize_message(msg, chat_id) -> Dict[str, Any]:
+    """A message as returned by the messages API and the chat export"""
+    message_data = {
+        "id": msg.id,
+        "text": msg.text or "",
+        "date": msg.date.isoformat() if msg.date else None,
+        "sender_id": msg.sender_id if hasattr(msg, 'sender_id') else None,
+        "is_out": msg.out if hasattr(msg, 'out') else False,
+        "is_reply": msg.is_reply if hasattr(msg, 'is_reply') else False,
+        "reply_to_msg_id": msg.reply_to.reply_to_msg_id if hasattr(msg, 'reply_to') and msg.reply_to else None
+    }
+
+    message_data.update(describe_media(msg, chat_id))
+
+    # Detect URLs in message text for link previews (even without webpage media)
+    urls = re.findall(LINK_URL_PATTERN, message_data.get("text", ""))
+    if urls and not message_data.get("has_media"):
+        # Found URL in text, mark for link preview
+        message_data["has_link"] = True
+        message_data["link_url"] = urls[0]  # Use first URL found
+    else:
+        message_data["has_link"] = False
+
+    return message_data
+
 @app.get("/api/messages/{chat_id}")
-async def get_messages(chat_id: str, limit: int = 20, offset_id: int = 0):
+async def get_messages(chat_id: str, request: Request, response: Response, limit: int = 20, offset_id: int = 0,
+                       reverse: bool = False, ids: Optional[str] = None):
     """Get messages from a chat"""
     check_client_connected()
 
+    try:
+        message_ids = [int(message_id) for message_id in ids.split(",") if message_id.strip()] if ids else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated message IDs")
+
     try:
         entity = await get_entity_safe(chat_id)
-        messages = await client.get_messages(entity, limit=limit, offset_id=offset_id)
 
-        message_list = []
-        for msg in messages:
-            message_data = {
-                "id": msg.id,
-                "text": msg.text or "",
-                "date": msg.date.isoformat() if msg.date else None,
-                "sender_id": msg.sender_id if hasattr(msg, 'sender_id') else None,
-                "is_out": msg.out if hasattr(msg, 'out') else False,
-                "is_reply": msg.is_reply if hasattr(msg, 'is_reply') else False,
-                "reply_to_msg_id": msg.reply_to.reply_to_msg_id if hasattr(msg, 'reply_to') and msg.reply_to else None
-            }
+        not_modified, validators = check_not_modified(request, *chat_version(utils.get_peer_id(entity)))
+        if not_modified:
+            return not_modified
+        response.headers.update(validators)
 
-            # Add media info if present
-            if msg.media:
-                message_data["has_media"] = True
-                message_data["media_type"] = type(msg.media).__name__
-
-                # Get media details based on media type
-                media = msg.media
-
-                # Check for photo
-                if isinstance(media, types.MessageMediaPhoto):
-                    message_data["media_category"] = "photo"
-                # Check for document (which can be video, audio, image, or file)
-                elif isinstance(media, types.MessageMediaDocument):
-                    doc = media.document
-                    message_data["mime_type"] = getattr(doc, 'mime_type', None) or ""
-
-                    # Get file name from attributes
-                    file_name = None
-                    if hasattr(doc, 'attributes'):
-                        for attr in doc.attributes:
-                            if isinstance(attr, types.DocumentAttributeFilename):
-                                file_name = attr.file_name
-                                break
-                            elif isinstance(attr, types.DocumentAttributeAudio):
-                                if hasattr(attr, 'title') and attr.title:
-                                    file_name = f"{attr.title}.mp3"
-                                break
+        if message_ids:
+            # Specific messages, e.g. to re-fetch edited ones; IDs that no longer exist are left out
+            messages = [msg for msg in await client_call("get_messages", entity, ids=message_ids) if msg]
+        else:
+            messages = await client_call("get_messages", entity, limit=limit, offset_id=offset_id, reverse=reverse)
 
-                    message_data["file_name"] = file_name
-
-                    # Determine category based on mime type and attributes
-                    if message_data["mime_type"].startswith('video/'):
-                        message_data["media_category"] = "video"
-                    elif message_data["mime_type"].startswith('audio/') or message_data["mime_type"] == 'audio/ogg':
-                        message_data["media_category"] = "audio"
-                    elif message_data["mime_type"].startswith('image/'):
-                        message_data["media_category"] = "image"
-                    else:
-                        message_data["media_category"] = "document"
-
-                    # Check for video note (circular video)
-                    if hasattr(doc, 'attributes'):
-                        for attr in doc.attributes:
-                            if isinstance(attr, types.DocumentAttributeVideo):
-                                if hasattr(attr, 'round_message') and attr.round_message:
-                                    message_data["media_category"] = "video_note"
-                                break
-                # Check for geo location
-                elif isinstance(media, types.MessageMediaGeo):
-                    message_data["media_category"] = "location"
-                # Check for contact
-                elif isinstance(media, types.MessageMediaContact):
-                    message_data["media_category"] = "contact"
-                # Check for poll
-                elif isinstance(media, types.MessageMediaPoll):
-                    message_data["media_category"] = "poll"
-                # Check for webpage/link preview
-                elif isinstance(media, types.MessageMediaWebPage):
-                    message_data["media_category"] = "webpage"
-                    webpage = media.webpage
-                    if isinstance(webpage, types.WebPage):
-                        message_data["webpage_url"] = webpage.url
-                        message_data["webpage_title"] = getattr(webpage, 'title', None) or ""
-                        message_data["webpage_description"] = getattr(webpage, 'description', None) or ""
-                        message_data["webpage_site_name"] = getattr(webpage, 'site_name', None) or ""
-
-                        # Get thumbnail if available
-                        if hasattr(webpage, 'photo') and webpage.photo:
-                            message_data["webpage_thumb_url"] = f"/api/files/preview/{chat_id}/{msg.id}?thumb=true"
-                        else:
-                            message_data["webpage_thumb_url"] = None
-                else:
-                    message_data["media_category"] = "unknown"
+        return {"messages": [serialize_message(msg, chat_id) for msg in messages]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-                # Store message ID for media download
-                message_data["media_message_id"] = msg.id
-            else:
-                message_data["has_media"] = False
-
-            # Detect URLs in message text for link previews (even without webpage media)
-            import re
-            url_pattern = r'https?://[^\s<>"{}|\\^`\[\]]+[^\s<>"{}|\\^`\[\].,;:!?]'
-            urls = re.findall(url_pattern, message_data.get("text", ""))
-            if urls and not message_data.get("has_media"):
-                # Found URL in text, mark for link preview
-                message_data["has_link"] = True
-                message_data["link_url"] = urls[0]  # Use first URL found
-            else:
-                message_data["has_link"] = False
+@app.get("/api/messages/{chat_id}/changes")
+async def get_message_changes(chat_id: str, since: Optional[str] = None):
+    """Get IDs of messages added, edited or deleted in a chat since a change token"""
+    check_client_connected()
+
+    entity = await get_entity_safe(chat_id)
+    peer_id = utils.get_peer_id(entity)
+    current = change_state["seq"]
+
+    if since is None:
+        return {"new": [], "edited": [], "deleted": [], "next": change_token(current)}
 
-            message_list.append(message_data)
+    since_seq = parse_change_token(since)
+    floors = [change_state["floor"], chat_log_floor.get(peer_id, 0)]
+    if not _is_channel_peer(peer_id):
+        floors.append(chat_log_floor.get(None, 0))
+    if since_seq < max(floors):
+        raise HTTPException(status_code=410, detail="Change token too old; reload the chat")
 
-        return {"messages": message_list}
+    try:
+        changes = collect_changes(peer_id, since_seq)
+        return {**changes, "next": change_token(current)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -784,6 +2148,8 @@ async def send_message(request: MessageRequest):
             kwargs['schedule'] = schedule_time
 
         message = await client.send_message(entity, request.message, **kwargs)
+        if not request.schedule:
+            note_chat_changed(utils.get_peer_id(entity), "new", [message.id])
 
         return {
             "status": "success",
@@ -809,9 +2175,7 @@ async def send_media(
         entity = await get_entity_safe(chat_id)
 
         # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp_file:
-            shutil.copyfileobj(file.file, tmp_file)
-            tmp_path = tmp_file.name
+        tmp_path = await save_upload_to_temp(file)
 
         try:
             kwargs = {}
@@ -822,7 +2186,10 @@ async def send_media(
             if video_note:
                 kwargs['video_note'] = True
 
+            upload_start = time.perf_counter()
             message = await client.send_file(entity, tmp_path, **kwargs)
+            note_chat_changed(utils.get_peer_id(entity), "new", [message.id])
+            record_transfer("upload", "send-media", os.path.getsize(tmp_path), time.perf_counter() - upload_start)
 
             return {
                 "status": "success",
@@ -831,7 +2198,7 @@ async def send_media(
                 "has_media": True
             }
         finally:
-            os.unlink(tmp_path)
+            await remove_temp_file(tmp_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -850,6 +2217,7 @@ async def send_location(request: LocationRequest):
         )
 
         message = await client.send_file(entity, file=location, caption=request.caption)
+        note_chat_changed(utils.get_peer_id(entity), "new", [message.id])
 
         return {
             "status": "success",
@@ -871,6 +2239,7 @@ async def send_contact(request: ContactMessageRequest):
             first_name=request.first_name,
             last_name=request.last_name
         )
+        note_chat_changed(utils.get_peer_id(entity), "new", [message.id])
 
         return {
             "status": "success",
@@ -887,6 +2256,7 @@ async def edit_message(request: EditMessageRequest):
     try:
         entity = await get_entity_safe(request.chat_id)
         message = await client.edit_message(entity, request.message_id, request.text)
+        note_chat_changed(utils.get_peer_id(entity), "edited", [message.id])
 
         return {
             "status": "success",
@@ -904,6 +2274,7 @@ async def delete_messages(request: DeleteMessageRequest):
     try:
         entity = await get_entity_safe(request.chat_id)
         await client.delete_messages(entity, request.message_ids, revoke=request.revoke)
+        note_chat_changed(utils.get_peer_id(entity), "deleted", request.message_ids)
 
         return {"status": "success", "deleted_count": len(request.message_ids)}
     except Exception as e:
@@ -918,9 +2289,13 @@ async def forward_messages(request: ForwardMessageRequest):
         from_entity = await get_entity_safe(request.from_chat_id)
         to_entity = await get_entity_safe(request.to_chat_id)
 
-        await client.forward_messages(to_entity, request.message_ids, from_peer=from_entity)
+        forwarded = await client.forward_messages(to_entity, request.message_ids, from_peer=from_entity)
+        note_chat_changed(utils.get_peer_id(to_entity), "new", [message.id for message in forwarded if message])
 
         return {"status": "success", "forwarded_count": len(request.message_ids)}
+    except FloodWaitError as e:
+        # Longer than the client's flood_sleep_threshold; let the caller schedule the retry
+        raise HTTPException(status_code=429, detail=f"Flood wait of {e.seconds}s", headers={"Retry-After": str(e.seconds)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -936,6 +2311,7 @@ async def pin_message(request: PinMessageRequest):
             await client.unpin_message(entity, request.message_id)
         else:
             await client.pin_message(entity, request.message_id)
+        note_chat_changed(utils.get_peer_id(entity), "edited", [request.message_id])
 
         return {"status": "success"}
     except Exception as e:
@@ -949,6 +2325,7 @@ async def react_to_message(request: ReactionRequest):
     try:
         entity = await get_entity_safe(request.chat_id)
         await client.send_reaction(entity, request.message_id, reaction=request.reaction)
+        note_chat_changed(utils.get_peer_id(entity), "edited", [request.message_id])
 
         return {"status": "success"}
     except Exception as e:
@@ -962,6 +2339,7 @@ async def mark_read(chat_id: str, message_id: Optional[int] = None):
     try:
         entity = await get_entity_safe(chat_id)
         await client.send_read_acknowledge(entity, max_id=message_id)
+        note_chat_changed(utils.get_peer_id(entity), messages=False)
 
         return {"status": "success"}
     except Exception as e:
@@ -978,7 +2356,7 @@ async def download_media(chat_id: str, message_id: int):
 
     try:
         entity = await get_entity_safe(chat_id)
-        messages = await client.get_messages(entity, ids=message_id)
+        messages = await client_call("get_messages", entity, ids=message_id)
 
         if not messages:
             raise HTTPException(status_code=404, detail="Message not found or has no media")
@@ -1044,30 +2422,30 @@ async def download_media(chat_id: str, message_id: int):
         try:
             # For very large files (>50MB), use temporary file
             if file_size and file_size > 50 * 1024 * 1024:  # 50MB
-                import tempfile
-                import os
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f"_{filename}")
+                temp_file = await run_in_threadpool(tempfile.NamedTemporaryFile, delete=False, suffix=f"_{filename}")
                 temp_path = temp_file.name
-                temp_file.close()
+                await run_in_threadpool(temp_file.close)
 
                 # Download to file
+                download_start = time.perf_counter()
                 await client.download_media(message, file=temp_path)
+                record_transfer("download", "download", os.path.getsize(temp_path), time.perf_counter() - download_start)
 
                 # Stream from file
                 async def generate():
                     """Stream file from disk in chunks"""
                     chunk_size = 1024 * 1024  # 1MB chunks
-                    with open(temp_path, 'rb') as f:
+                    f = await run_in_threadpool(open, temp_path, 'rb')
+                    try:
                         while True:
-                            chunk = f.read(chunk_size)
+                            chunk = await run_in_threadpool(f.read, chunk_size)
                             if not chunk:
                                 break
                             yield chunk
-                    # Clean up temp file
-                    try:
-                        os.unlink(temp_path)
-                    except:
-                        pass
+                    finally:
+                        await run_in_threadpool(f.close)
+                        # Clean up temp file
+                        await remove_temp_file(temp_path)
 
                 headers = {
                     "Content-Disposition": f'attachment; filename="{filename}"',
@@ -1084,7 +2462,9 @@ async def download_media(chat_id: str, message_id: int):
                 )
             else:
                 # For smaller files, download to memory
-                file_bytes = await client.download_media(message, file=bytes)
+                download_start = time.perf_counter()
+                file_bytes = await client_call("download_media", message, file=bytes)
+                record_transfer("download", "download", len(file_bytes or b""), time.perf_counter() - download_start)
 
                 # Stream in chunks for better memory management
                 async def generate():
@@ -1111,11 +2491,7 @@ async def download_media(chat_id: str, message_id: int):
         except Exception as download_error:
             # Clean up temp file on error
             if temp_file:
-                try:
-                    import os
-                    os.unlink(temp_file.name)
-                except:
-                    pass
+                await remove_temp_file(temp_file.name)
             raise download_error
     except HTTPException:
         raise
@@ -1132,7 +2508,7 @@ async def preview_media(chat_id: str, message_id: int):
 
     try:
         entity = await get_entity_safe(chat_id)
-        messages = await client.get_messages(entity, ids=message_id)
+        messages = await client_call("get_messages", entity, ids=message_id)
 
         if not messages:
             raise HTTPException(status_code=404, detail="Message not found")
@@ -1155,7 +2531,9 @@ async def preview_media(chat_id: str, message_id: int):
             if isinstance(webpage, types.WebPage) and hasattr(webpage, 'photo') and webpage.photo:
                 # Download webpage photo thumbnail
                 try:
-                    file_bytes = await client.download_media(webpage.photo, file=bytes, thumb=True)
+                    download_start = time.perf_counter()
+                    file_bytes = await client_call("download_media", webpage.photo, file=bytes, thumb=True)
+                    record_transfer("download", "preview", len(file_bytes or b""), time.perf_counter() - download_start)
                     if not file_bytes:
                         raise HTTPException(status_code=500, detail="Failed to download webpage thumbnail")
                     return Response(
@@ -1173,7 +2551,9 @@ async def preview_media(chat_id: str, message_id: int):
 
         # Download to memory
         try:
-            file_bytes = await client.download_media(message, file=bytes)
+            download_start = time.perf_counter()
+            file_bytes = await client_call("download_media", message, file=bytes)
+            record_transfer("download", "preview", len(file_bytes or b""), time.perf_counter() - download_start)
             if not file_bytes:
                 raise HTTPException(status_code=500, detail="Failed to download media")
         except Exception as download_error:
@@ -1233,7 +2613,7 @@ async def search_messages(request: SearchRequest):
         if request.chat_id:
             entity = await get_entity_safe(request.chat_id)
 
-        messages = await client.get_messages(entity, search=request.query, limit=request.limit)
+        messages = await client_call("get_messages", entity, search=request.query, limit=request.limit)
 
         message_list = []
         for msg in messages:
@@ -1253,6 +2633,7 @@ async def search_messages(request: SearchRequest):
 # ============================================================================
 
 @app.get("/api/contacts")
+@cached_response("contacts", ttl=120)
 async def get_contacts():
     """Get contacts list"""
     check_client_connected()
@@ -1322,6 +2703,7 @@ async def add_contact(request: ContactRequest):
             )
             await client.import_contacts([contact])
 
+        invalidate_cache("contacts")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1334,11 +2716,13 @@ async def delete_contact(user_id: str):
     try:
         user = await get_entity_safe(user_id)
         await client.delete_contacts([user])
+        invalidate_cache("contacts", f"user:{user_id}")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/blocked-users", name="get_blocked_users")
+@cached_response("blocked-users", ttl=120)
 async def get_blocked_users():
     """Get blocked users list - MUST be defined before /api/users/{user_id}"""
     check_client_connected()
@@ -1372,6 +2756,7 @@ async def get_blocked_users():
         raise HTTPException(status_code=500, detail=error_msg)
 
 @app.get("/api/users/{user_id}")
+@cached_response("user", ttl=300, tags=["user:{user_id}"])
 async def get_user_info(user_id: str):
     """Get user information"""
     check_client_connected()
@@ -1394,6 +2779,7 @@ async def get_user_info(user_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/users/{user_id}/photos")
+@cached_response("user-photos", ttl=600, tags=["user:{user_id}"])
 async def get_user_photos(user_id: str, limit: int = 10):
     """Get user profile photos"""
     check_client_connected()
@@ -1421,6 +2807,7 @@ async def block_user(user_id: str):
     try:
         user = await get_entity_safe(user_id)
         await client.block(user)
+        invalidate_cache("blocked-users", f"user:{user_id}")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1433,6 +2820,7 @@ async def unblock_user(user_id: str):
     try:
         user = await get_entity_safe(user_id)
         await client.unblock(user)
+        invalidate_cache("blocked-users", f"user:{user_id}")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1442,6 +2830,7 @@ async def unblock_user(user_id: str):
 # ============================================================================
 
 @app.get("/api/account")
+@cached_response("account", ttl=60)
 async def get_account_info():
     """Get own account information"""
     check_client_connected()
@@ -1477,6 +2866,7 @@ async def update_profile(request: UpdateProfileRequest):
             kwargs['about'] = request.about
 
         await client.update_profile(**kwargs)
+        invalidate_cache("account", "user")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1488,15 +2878,16 @@ async def update_profile_photo(file: UploadFile = File(...)):
 
     try:
         # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp_file:
-            shutil.copyfileobj(file.file, tmp_file)
-            tmp_path = tmp_file.name
+        tmp_path = await save_upload_to_temp(file)
 
         try:
+            upload_start = time.perf_counter()
             await client.upload_profile_photo(tmp_path)
+            record_transfer("upload", "profile-photo", os.path.getsize(tmp_path), time.perf_counter() - upload_start)
+            invalidate_cache("account", "user-photos")
             return {"status": "success"}
         finally:
-            os.unlink(tmp_path)
+            await remove_temp_file(tmp_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1509,6 +2900,7 @@ async def delete_profile_photo():
         photos = await client.get_profile_photos('me')
         if photos:
             await client.delete_photos(photos)
+        invalidate_cache("account", "user-photos")
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1554,124 +2946,859 @@ def security_dependencies(request: Request):
     check_rate_limit(request)
     return True
 
+# ============================================================================
+# Debugging & Profiling
+# ============================================================================
+
+profile_state = {"running": False}
+slow_callback_state: Dict[str, Any] = {"last_beat": 0.0, "blocked_stack": None, "stop": threading.Event()}
+event_loop_lag = Histogram("event_loop_lag_seconds", "How late the event loop woke a periodic timer", buckets=LOOP_LAG_BUCKETS)
+slow_callbacks_total = Counter("event_loop_slow_callbacks_total", "Event loop steps that blocked longer than the slow callback threshold")
+
+def verify_admin_key(api_key: Optional[str] = Header(None, alias="X-API-Key")):
+    """Allow access to debug endpoints only when profiling is enabled and an admin key is given"""
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not api_key:
+        raise HTTPException(status_code=401, detail="Admin API key required")
+    if api_key not in ADMIN_API_KEYS:
+        raise HTTPException(status_code=403, detail="Invalid admin API key")
+    return True
+
+def _format_stack(frame) -> List[str]:
+    """Format a frame chain root-first as `function (file:line)` entries"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _sample_stacks(thread_id: int, seconds: float, interval: float) -> Dict[str, int]:
+    """Periodically sample a thread's stack and count identical collapsed stacks"""
+    counts: Dict[str, int] = defaultdict(int)
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            counts[";".join(_format_stack(frame))] += 1
+        del frame
+        time.sleep(interval)
+    return counts
+
+async def _loop_heartbeat(threshold: float):
+    """Tick on the event loop and report how long each blocking step held it"""
+    interval = threshold / 4
+    while not slow_callback_state["stop"].is_set():
+        expected = time.monotonic() + interval
+        slow_callback_state["last_beat"] = expected
+        await asyncio.sleep(interval)
+        blocked = time.monotonic() - expected
+        if blocked > threshold:
+            slow_callbacks_total.inc()
+            stack = slow_callback_state["blocked_stack"] or ["<stack not captured>"]
+            print(f"Slow callback: event loop blocked for {blocked * 1000:.1f}ms in:")
+            print("    " + "\n    ".join(stack[-15:]))
+        slow_callback_state["blocked_stack"] = None
+
+def _loop_watchdog(thread_id: int, threshold: float):
+    """Capture the event loop's stack while a step is blocking it"""
+    stop = slow_callback_state["stop"]
+    while not stop.wait(threshold / 4):
+        if slow_callback_state["blocked_stack"] is None and time.monotonic() - slow_callback_state["last_beat"] > threshold:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                slow_callback_state["blocked_stack"] = _format_stack(frame)
+            del frame
+
+async def monitor_event_loop_lag(interval: float = 0.05):
+    """Record how late a periodic timer fires; any blocking step shows up as lag"""
+    while True:
+        expected = time.monotonic() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, time.monotonic() - expected))
+
+def start_slow_callback_detector(threshold: float):
+    """Start logging event loop steps that block longer than `threshold` seconds"""
+    slow_callback_state["stop"].clear()
+    slow_callback_state["last_beat"] = time.monotonic()
+    asyncio.ensure_future(_loop_heartbeat(threshold))
+    threading.Thread(
+        target=_loop_watchdog,
+        args=(threading.get_ident(), threshold),
+        name="slow-callback-watchdog",
+        daemon=True
+    ).start()
+    print(f"Slow callback detector enabled (threshold {threshold * 1000:.0f}ms)")
+
+@app.get("/debug/profile", response_class=PlainTextResponse)
+async def profile_event_loop(seconds: float = 30, interval: Optional[float] = None, _: bool = Depends(verify_admin_key)):
+    """Sample the event loop thread and return a flamegraph-compatible collapsed-stack profile"""
+    if seconds <= 0 or seconds > PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS}")
+    if profile_state["running"]:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    profile_state["running"] = True
+    try:
+        counts = await run_in_threadpool(
+            _sample_stacks, threading.get_ident(), seconds, interval or PROFILE_SAMPLE_INTERVAL
+        )
+    finally:
+        profile_state["running"] = False
+
+    body = "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+    filename = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.collapsed"
+    return PlainTextResponse(body, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# ============================================================================
+# Feature Storage
+# ============================================================================
+
+# Schema migrations, applied in order; PRAGMA user_version records how many have run
+FEATURES_DB_MIGRATIONS = [
+    """
+    CREATE TABLE templates (
+        name TEXT PRIMARY KEY,
+        content TEXT NOT NULL,
+        created TEXT NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE TABLE reminders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT NOT NULL,
+        message_id INTEGER NOT NULL,
+        reminder_time TEXT NOT NULL,
+        note TEXT,
+        created TEXT NOT NULL
+    );
+    CREATE INDEX idx_reminders_due ON reminders (reminder_time);
+
+    CREATE TABLE message_tags (
+        message_id INTEGER NOT NULL,
+        tag TEXT NOT NULL,
+        PRIMARY KEY (message_id, tag)
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_message_tags_tag ON message_tags (tag, message_id);
+    """,
+    # Tags keyed by (chat_id, message_id); chat_id 0 holds tags added without a chat.
+    # tag_postings is the inverted index (tag -> messages in key order); tag_counts is kept by triggers.
+    """
+    CREATE TABLE tag_postings (
+        tag TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        PRIMARY KEY (tag, chat_id, message_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_tag_postings_message ON tag_postings (chat_id, message_id, tag);
+
+    CREATE TABLE tag_counts (
+        tag TEXT PRIMARY KEY,
+        count INTEGER NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER tag_postings_insert AFTER INSERT ON tag_postings BEGIN
+        INSERT INTO tag_counts (tag, count) VALUES (NEW.tag, 1)
+            ON CONFLICT (tag) DO UPDATE SET count = count + 1;
+    END;
+    CREATE TRIGGER tag_postings_delete AFTER DELETE ON tag_postings BEGIN
+        UPDATE tag_counts SET count = count - 1 WHERE tag = OLD.tag;
+        DELETE FROM tag_counts WHERE tag = OLD.tag AND count <= 0;
+    END;
+
+    INSERT INTO tag_postings (tag, chat_id, message_id) SELECT tag, 0, message_id FROM message_tags;
+    DROP TABLE message_tags;
+    """,
+    # Reminder delivery: due_at is the parsed reminder_time (naive times are UTC)
+    """
+    ALTER TABLE reminders ADD COLUMN due_at REAL;
+    ALTER TABLE reminders ADD COLUMN delivery TEXT NOT NULL DEFAULT 'websocket';
+    ALTER TABLE reminders ADD COLUMN status TEXT NOT NULL DEFAULT 'pending';
+    ALTER TABLE reminders ADD COLUMN fired_at TEXT;
+    ALTER TABLE reminders ADD COLUMN error TEXT;
+    UPDATE reminders SET due_at = CAST(strftime('%s', reminder_time) AS REAL);
+    UPDATE reminders SET status = 'failed', error = 'Invalid reminder_time' WHERE due_at IS NULL;
+    DROP INDEX idx_reminders_due;
+    CREATE INDEX idx_reminders_due ON reminders (status, due_at, id);
+    """,
+]
+
+def _migrate_features_db(conn: sqlite3.Connection):
+    """Bring the schema up to date, one transaction per migration"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(FEATURES_DB_MIGRATIONS[version:], start=version + 1):
+        # executescript() commits implicitly, so the transaction is managed in the script itself
+        conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+        print(f"Features database migrated to version {number}")
+
+def _legacy_reminder_row(reminder: Dict) -> tuple:
+    """Reminders row for a legacy reminder; like migration 3, an unparseable time is kept but marked failed"""
+    # The old store accepted any reminder_time string
+    reminder_time = str(reminder.get("reminder_time") or "")
+    try:
+        due_at, status, error = parse_reminder_time(reminder_time), "pending", None
+    except ValueError:
+        due_at, status, error = None, "failed", "Invalid reminder_time"
+    # SQLite rowids start at 1; the in-memory list numbered reminders from 0
+    return (reminder["id"] + 1, reminder["chat_id"], reminder["message_id"], reminder_time, due_at, status, error,
+            reminder.get("note"), reminder.get("created") or datetime.now().isoformat())
+
+def _import_legacy_features(conn: sqlite3.Connection, path: str):
+    """Import templates/reminders/tags dumped in the old in-memory shapes:
+    {"templates": {name: {content, created}}, "reminders": [{id, chat_id, ...}], "tags": {message_id: [tags]}}
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        legacy = json.load(f)
+
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO templates (name, content, created) VALUES (?, ?, ?)",
+            [(name, t["content"], t.get("created") or datetime.now().isoformat())
+             for name, t in legacy.get("templates", {}).items()]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO reminders (id, chat_id, message_id, reminder_time, due_at, status, error, note, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [_legacy_reminder_row(r) for r in legacy.get("reminders", [])]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO tag_postings (tag, chat_id, message_id) VALUES (?, 0, ?)",
+            [(tag, int(message_id)) for message_id, tags in legacy.get("tags", {}).items() for tag in tags]
+        )
+
+    os.replace(path, f"{path}.imported")
+    print(f"Imported legacy features from {path}")
+
+def open_features_db() -> sqlite3.Connection:
+    """Open (and migrate) the features database on first use; call with features_db_lock held"""
+    if features_db["conn"] is None:
+        os.makedirs(os.path.dirname(FEATURES_DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(FEATURES_DB_PATH, check_same_thread=False, isolation_level="DEFERRED")
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        _migrate_features_db(conn)
+        if os.path.exists(LEGACY_FEATURES_FILE):
+            _import_legacy_features(conn, LEGACY_FEATURES_FILE)
+        features_db["conn"] = conn
+    return features_db["conn"]
+
+def _run_features_db(func, *args):
+    """Run func(conn, *args) in a transaction (run in the thread pool)"""
+    with features_db_lock:
+        conn = open_features_db()
+        with conn:
+            return func(conn, *args)
+
+async def features_db_call(func, *args):
+    """Run a database function off the event loop; writes are committed atomically or rolled back"""
+    return await run_in_threadpool(_run_features_db, func, *args)
+
+def close_features_db():
+    """Close the features database"""
+    with features_db_lock:
+        if features_db["conn"] is not None:
+            features_db["conn"].close()
+            features_db["conn"] = None
+
+def _db_save_template(conn: sqlite3.Connection, name: str, content: str, created: str):
+    conn.execute(
+        "INSERT INTO templates (name, content, created) VALUES (?, ?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET content = excluded.content, created = excluded.created",
+        (name, content, created)
+    )
+
+def _db_list_templates(conn: sqlite3.Connection) -> List[str]:
+    return [row["name"] for row in conn.execute("SELECT name FROM templates ORDER BY name")]
+
+def _db_get_template(conn: sqlite3.Connection, name: str) -> Optional[Dict]:
+    row = conn.execute("SELECT content, created FROM templates WHERE name = ?", (name,)).fetchone()
+    return dict(row) if row else None
+
+REMINDER_COLUMNS = "id, chat_id, message_id, reminder_time, note, delivery, status, fired_at, error, created"
+
+def _db_add_reminder(conn: sqlite3.Connection, chat_id: str, message_id: int, reminder_time: str, due_at: float,
+                     note: Optional[str], delivery: str, created: str) -> int:
+    cursor = conn.execute(
+        "INSERT INTO reminders (chat_id, message_id, reminder_time, due_at, note, delivery, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (chat_id, message_id, reminder_time, due_at, note, delivery, created)
+    )
+    return cursor.lastrowid
+
+def _db_list_reminders(conn: sqlite3.Connection, status: Optional[str], after: Optional[Tuple[float, int]], limit: int) -> List[Dict]:
+    sql = f"SELECT {REMINDER_COLUMNS}, due_at FROM reminders WHERE 1 = 1"
+    params: List[Any] = []
+    if status:
+        sql += " AND status = ?"
+        params.append(status)
+    if after:
+        sql += " AND (due_at, id) > (?, ?)"
+        params.extend(after)
+    sql += " ORDER BY due_at, id LIMIT ?"
+    params.append(limit)
+    return [dict(row) for row in conn.execute(sql, params)]
+
+def _db_pending_reminders(conn: sqlite3.Connection) -> List[Tuple[float, int]]:
+    return [(row["due_at"], row["id"]) for row in conn.execute("SELECT due_at, id FROM reminders WHERE status = 'pending'")]
+
+def _db_get_pending_reminders(conn: sqlite3.Connection, reminder_ids: List[int]) -> List[Dict]:
+    placeholders = ", ".join("?" * len(reminder_ids))
+    return [dict(row) for row in conn.execute(
+        f"SELECT {REMINDER_COLUMNS} FROM reminders WHERE id IN ({placeholders}) AND status = 'pending'", reminder_ids
+    )]
+
+def _db_finish_reminder(conn: sqlite3.Connection, reminder_id: int, status: str, fired_at: str, error: Optional[str]):
+    conn.execute("UPDATE reminders SET status = ?, fired_at = ?, error = ? WHERE id = ?", (status, fired_at, error, reminder_id))
+
+def _db_delete_reminder(conn: sqlite3.Connection, reminder_id: int) -> bool:
+    return conn.execute("DELETE FROM reminders WHERE id = ?", (reminder_id,)).rowcount > 0
+
+def _db_add_tags(conn: sqlite3.Connection, chat_id: int, message_id: int, tags: List[str]) -> List[str]:
+    conn.executemany(
+        "INSERT OR IGNORE INTO tag_postings (tag, chat_id, message_id) VALUES (?, ?, ?)",
+        [(tag, chat_id, message_id) for tag in tags]
+    )
+    return _db_get_tags(conn, chat_id, message_id)
+
+def _db_remove_tags(conn: sqlite3.Connection, chat_id: int, message_id: int, tags: List[str]) -> List[str]:
+    conn.executemany(
+        "DELETE FROM tag_postings WHERE tag = ? AND chat_id = ? AND message_id = ?",
+        [(tag, chat_id, message_id) for tag in tags]
+    )
+    return _db_get_tags(conn, chat_id, message_id)
+
+def _db_get_tags(conn: sqlite3.Connection, chat_id: int, message_id: int) -> List[str]:
+    return [row["tag"] for row in conn.execute(
+        "SELECT tag FROM tag_postings WHERE chat_id = ? AND message_id = ? ORDER BY tag", (chat_id, message_id)
+    )]
+
+def _db_tag_counts(conn: sqlite3.Connection) -> Dict[str, int]:
+    return {row["tag"]: row["count"] for row in conn.execute("SELECT tag, count FROM tag_counts ORDER BY tag")}
+
+def _db_query_tags(conn: sqlite3.Connection, all_tags: List[str], any_tags: List[str], none_tags: List[str],
+                   chat_id: Optional[int], before: Optional[Tuple[int, int]], limit: int) -> List[Tuple[int, int]]:
+    """Find (chat_id, message_id) pairs tagged with every `all` tag, at least one `any` tag and no `none` tag.
+
+    Results are in descending (chat_id, message_id) order starting below `before`,
+    read straight off the postings index so each page costs O(limit * log n).
+    """
+    scope, scope_params = "", []
+    if chat_id is not None:
+        scope += " AND chat_id = ?"
+        scope_params.append(chat_id)
+    if before is not None:
+        scope += " AND (chat_id, message_id) < (?, ?)"
+        scope_params.extend(before)
+
+    def in_list(tags):
+        return ", ".join("?" * len(tags))
+
+    if all_tags:
+        # Drive from the rarest required tag and probe the others by primary key
+        counts = {tag: 0 for tag in all_tags}
+        for row in conn.execute(f"SELECT tag, count FROM tag_counts WHERE tag IN ({in_list(all_tags)})", all_tags):
+            counts[row["tag"]] = row["count"]
+        driver = min(all_tags, key=lambda tag: counts[tag])
+        if counts[driver] == 0:
+            return []
+
+        sql = f"SELECT chat_id, message_id FROM tag_postings p WHERE tag = ?{scope}"
+        params = [driver, *scope_params]
+        for tag in all_tags:
+            if tag != driver:
+                sql += " AND EXISTS (SELECT 1 FROM tag_postings WHERE tag = ? AND chat_id = p.chat_id AND message_id = p.message_id)"
+                params.append(tag)
+        if any_tags:
+            sql += f" AND EXISTS (SELECT 1 FROM tag_postings WHERE tag IN ({in_list(any_tags)}) AND chat_id = p.chat_id AND message_id = p.message_id)"
+            params.extend(any_tags)
+        if none_tags:
+            sql += f" AND NOT EXISTS (SELECT 1 FROM tag_postings WHERE tag IN ({in_list(none_tags)}) AND chat_id = p.chat_id AND message_id = p.message_id)"
+            params.extend(none_tags)
+    else:
+        # Union of the postings lists minus the excluded ones; SQLite merges the ordered lists
+        branch = f"SELECT chat_id, message_id FROM tag_postings WHERE tag = ?{scope}"
+        sql = " UNION ".join([branch] * len(any_tags)) + "".join(f" EXCEPT {branch}" for _ in none_tags)
+        params = [param for tag in any_tags + none_tags for param in (tag, *scope_params)]
+
+    sql += " ORDER BY chat_id DESC, message_id DESC LIMIT ?"
+    params.append(limit)
+    return [(row[0], row[1]) for row in conn.execute(sql, params)]
+
+# ============================================================================
+# Reminder Scheduler
+# ============================================================================
+
+REMINDER_DELIVERY_MODES = ("websocket", "telegram", "both")
+
+# Min-heap of (due_at, reminder id); deleted reminders are skipped when they reach the top
+reminder_heap: List[Tuple[float, int]] = []
+reminder_state: Dict[str, Any] = {"wakeup": None, "fired": 0, "failed": 0}
+reminder_tasks: set = set()
+reminder_semaphore = asyncio.Semaphore(int(os.getenv("REMINDER_CONCURRENCY", "8")))
+
+def parse_reminder_time(value: str) -> float:
+    """Parse an ISO datetime into a Unix timestamp; times without an offset are UTC"""
+    due = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if due.tzinfo is None:
+        due = due.replace(tzinfo=timezone.utc)
+    return due.timestamp()
+
+def schedule_reminder(due_at: float, reminder_id: int):
+    """Add a reminder to the heap, waking the scheduler if it is now the earliest"""
+    heapq.heappush(reminder_heap, (due_at, reminder_id))
+    if reminder_heap[0][1] == reminder_id and reminder_state["wakeup"] is not None:
+        reminder_state["wakeup"].set()
+
+async def deliver_reminder(reminder: Dict):
+    """Deliver one reminder over WebSocket and/or to Saved Messages, then record the outcome"""
+    async with reminder_semaphore:
+        errors = []
+        if reminder["delivery"] in ("websocket", "both"):
+            await broadcast_to_websockets({"type": "reminder", "reminder": reminder})
+        if reminder["delivery"] in ("telegram", "both"):
+            try:
+                check_client_connected()
+                entity = await get_entity_safe(reminder["chat_id"])
+                await client.send_message("me", f"⏰ Reminder: {reminder['note'] or ''}".strip())
+                await client.forward_messages("me", reminder["message_id"], from_peer=entity)
+            except Exception as e:
+                errors.append(f"telegram: {getattr(e, 'detail', e)}")
+
+        status = "failed" if errors and reminder["delivery"] == "telegram" else "fired"
+        reminder_state[status] += 1
+        await features_db_call(_db_finish_reminder, reminder["id"], status, datetime.now().isoformat(), "; ".join(errors) or None)
+
+async def fire_due_reminders(reminder_ids: List[int]):
+    """Deliver reminders that are due and still pending"""
+    try:
+        reminders = await features_db_call(_db_get_pending_reminders, reminder_ids)
+        await asyncio.gather(*(deliver_reminder(reminder) for reminder in reminders))
+    except Exception as e:
+        print(f"Error firing reminders {reminder_ids}: {e}")
+
+async def run_reminder_scheduler():
+    """Sleep until the earliest reminder is due (or a new earlier one is added), then fire it.
+
+    Pending reminders are loaded from the database at startup, so those that
+    came due while the server was down fire immediately.
+    """
+    wakeup = reminder_state["wakeup"] = asyncio.Event()
+    pending = await features_db_call(_db_pending_reminders)
+    # Merge: reminders created while the read was in flight are already in the heap (and maybe in `pending`)
+    scheduled = {reminder_id for _, reminder_id in reminder_heap}
+    reminder_heap.extend(entry for entry in pending if entry[1] not in scheduled)
+    heapq.heapify(reminder_heap)
+    print(f"Reminder scheduler: {len(reminder_heap)} pending reminders")
+
+    while True:
+        if not reminder_heap:
+            await wakeup.wait()
+            wakeup.clear()
+            continue
+
+        delay = reminder_heap[0][0] - time.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            continue
+
+        due_ids = []
+        now = time.time()
+        while reminder_heap and reminder_heap[0][0] <= now and len(due_ids) < 500:
+            due_ids.append(heapq.heappop(reminder_heap)[1])
+        task = asyncio.create_task(fire_due_reminders(due_ids))
+        reminder_tasks.add(task)
+        task.add_done_callback(reminder_tasks.discard)
+
 # ============================================================================
 # Custom Features: Templates, Reminders, Tags
 # ============================================================================
 
 class TemplateRequest(BaseModel):
     name: str
-    content: str
+    content: str  # {variable} or {variable|default}; {{ and }} for literal braces
+
+class TemplateSendRequest(BaseModel):
+    variables: Dict[str, str] = {}
+
+class TemplateRecipient(BaseModel):
+    chat_id: str
+    variables: Dict[str, str] = {}
+
+class BulkTemplateSendRequest(BaseModel):
+    recipients: List[TemplateRecipient]
+    variables: Dict[str, str] = {}  # Shared by all recipients; per-recipient variables win
+    concurrency: int = 5
+    dry_run: bool = False  # Render only, don't send
 
 class ReminderRequest(BaseModel):
     chat_id: str
     message_id: int
     reminder_time: str  # ISO datetime
     note: Optional[str] = None
+    delivery: str = "websocket"  # websocket, telegram (to Saved Messages) or both
 
 class TagRequest(BaseModel):
     message_id: int
     tags: List[str]
+    chat_id: Optional[str] = None  # Tags without a chat are kept apart from every chat's tags
+
+TEMPLATE_VARIABLE_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+class TemplateSyntaxError(ValueError):
+    pass
+
+class CompiledTemplate:
+    """A template parsed once into literal strings and (variable, default) slots"""
+
+    __slots__ = ("parts", "variables")
+
+    def __init__(self, parts: List[Any]):
+        self.parts = tuple(parts)
+        self.variables = sorted({part[0] for part in parts if isinstance(part, tuple)})
+
+    def render(self, values: Dict[str, str]) -> str:
+        """Substitute variables; raises KeyError listing variables with neither a value nor a default"""
+        rendered = []
+        missing = []
+        for part in self.parts:
+            if part.__class__ is str:
+                rendered.append(part)
+                continue
+            value = values.get(part[0], part[1])
+            if value is None:
+                missing.append(part[0])
+            else:
+                rendered.append(value)
+        if missing:
+            raise KeyError(", ".join(sorted(set(missing))))
+        return "".join(rendered)
+
+def compile_template(content: str) -> CompiledTemplate:
+    """Parse template content into a CompiledTemplate, raising TemplateSyntaxError on bad placeholders"""
+    parts: List[Any] = []
+    literal: List[str] = []
+    i = 0
+    while i < len(content):
+        char = content[i]
+        if char in "{}" and content[i + 1:i + 2] == char:
+            literal.append(char)
+            i += 2
+            continue
+        if char == "}":
+            raise TemplateSyntaxError(f"Unmatched '}}' at position {i}")
+        if char != "{":
+            literal.append(char)
+            i += 1
+            continue
+
+        end = content.find("}", i)
+        if end == -1:
+            raise TemplateSyntaxError(f"Unclosed '{{' at position {i}")
+        name, has_default, default = content[i + 1:end].partition("|")
+        name = name.strip()
+        if not TEMPLATE_VARIABLE_PATTERN.fullmatch(name):
+            raise TemplateSyntaxError(f"Invalid variable name '{name}' at position {i}")
+        if literal:
+            parts.append("".join(literal))
+            literal = []
+        parts.append((name, default if has_default else None))
+        i = end + 1
+    if literal:
+        parts.append("".join(literal))
+    return CompiledTemplate(parts)
+
+# Template name -> compiled template; filled on create and on first use after a restart
+compiled_templates: Dict[str, CompiledTemplate] = {}
+
+async def get_compiled_template(name: str) -> CompiledTemplate:
+    """Return a template's compiled form, loading and compiling it only on a cache miss"""
+    compiled = compiled_templates.get(name)
+    if compiled is None:
+        template = await features_db_call(_db_get_template, name)
+        if template is None:
+            raise HTTPException(status_code=404, detail="Template not found")
+        try:
+            compiled = compiled_templates[name] = compile_template(template["content"])
+        except TemplateSyntaxError as e:
+            raise HTTPException(status_code=400, detail=f"Template syntax error: {e}")
+    return compiled
+
+def recipient_variables(entity) -> Dict[str, str]:
+    """Built-in variables describing a recipient and the send time; unknown fields are left out so defaults apply"""
+    now = datetime.now()
+    variables = {
+        "name": utils.get_display_name(entity),
+        "chat_title": getattr(entity, "title", None) or utils.get_display_name(entity),
+        "first_name": getattr(entity, "first_name", None),
+        "last_name": getattr(entity, "last_name", None),
+        "username": getattr(entity, "username", None),
+        "date": now.date().isoformat(),
+        "time": now.strftime("%H:%M"),
+        "datetime": now.isoformat(timespec="minutes")
+    }
+    return {key: value for key, value in variables.items() if value}
+
+def render_template(compiled: CompiledTemplate, entity, *variable_sets: Dict[str, str]) -> str:
+    """Render for one recipient; later variable sets override earlier ones and the built-ins"""
+    values = recipient_variables(entity)
+    for variables in variable_sets:
+        values.update(variables)
+    try:
+        return compiled.render(values)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Missing template variables: {e.args[0]}")
 
 @app.post("/api/templates")
 async def create_template(template: TemplateRequest, request: Request):
-    """Create a message template"""
+    """Create or update a message template"""
     check_client_connected()
     check_rate_limit(request)
-    templates_store[template.name] = {"content": template.content, "created": datetime.now().isoformat()}
-    return {"status": "success", "template": template.name}
+    try:
+        compiled = compile_template(template.content)
+    except TemplateSyntaxError as e:
+        raise HTTPException(status_code=400, detail=f"Template syntax error: {e}")
+    await features_db_call(_db_save_template, template.name, template.content, datetime.now().isoformat())
+    compiled_templates[template.name] = compiled
+    return {"status": "success", "template": template.name, "variables": compiled.variables}
 
 @app.get("/api/templates")
 async def list_templates(request: Request):
     """List all templates"""
     check_rate_limit(request)
-    return {"templates": list(templates_store.keys())}
+    return {"templates": await features_db_call(_db_list_templates)}
 
 @app.get("/api/templates/{name}")
 async def get_template(name: str, request: Request):
     """Get a template by name"""
     check_rate_limit(request)
-    if name not in templates_store:
+    template = await features_db_call(_db_get_template, name)
+    if template is None:
         raise HTTPException(status_code=404, detail="Template not found")
-    return templates_store[name]
+    return template
 
 @app.post("/api/templates/{name}/send")
-async def send_template(name: str, chat_id: str, request: Request):
-    """Send a template message"""
+async def send_template(name: str, chat_id: str, request: Request, body: Optional[TemplateSendRequest] = None):
+    """Render a template for a chat and send it"""
     check_client_connected()
     check_rate_limit(request)
-    if name not in templates_store:
-        raise HTTPException(status_code=404, detail="Template not found")
-    template = templates_store[name]
+    compiled = await get_compiled_template(name)
     entity = await get_entity_safe(chat_id)
-    message = await client.send_message(entity, template["content"])
+    text = render_template(compiled, entity, body.variables if body else {})
+    message = await client.send_message(entity, text)
+    note_chat_changed(utils.get_peer_id(entity), "new", [message.id])
     return {"status": "success", "message_id": message.id}
 
+@app.post("/api/templates/{name}/send-bulk")
+async def send_template_bulk(name: str, bulk: BulkTemplateSendRequest, request: Request):
+    """Render a template for many recipients and send the messages concurrently"""
+    check_client_connected()
+    check_rate_limit(request)
+    compiled = await get_compiled_template(name)
+    semaphore = asyncio.Semaphore(max(1, min(bulk.concurrency, 20)))
+
+    async def deliver(recipient: TemplateRecipient) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                entity = await get_entity_safe(recipient.chat_id)
+                text = render_template(compiled, entity, bulk.variables, recipient.variables)
+                if bulk.dry_run:
+                    return {"chat_id": recipient.chat_id, "status": "rendered", "text": text}
+                message = await client.send_message(entity, text)
+                note_chat_changed(utils.get_peer_id(entity), "new", [message.id])
+                return {"chat_id": recipient.chat_id, "status": "sent", "message_id": message.id}
+            except HTTPException as e:
+                return {"chat_id": recipient.chat_id, "status": "error", "error": e.detail}
+            except Exception as e:
+                return {"chat_id": recipient.chat_id, "status": "error", "error": str(e)}
+
+    results = await asyncio.gather(*(deliver(recipient) for recipient in bulk.recipients))
+    return {
+        "status": "success",
+        "sent": sum(1 for result in results if result["status"] == "sent"),
+        "failed": sum(1 for result in results if result["status"] == "error"),
+        "results": results
+    }
+
 @app.post("/api/reminders")
 async def create_reminder(reminder: ReminderRequest, request: Request):
     """Create a message reminder"""
     check_client_connected()
     check_rate_limit(request)
-    reminder_data = {
-        "id": len(reminders_store),
-        "chat_id": reminder.chat_id,
-        "message_id": reminder.message_id,
-        "reminder_time": reminder.reminder_time,
-        "note": reminder.note,
-        "created": datetime.now().isoformat()
-    }
-    reminders_store.append(reminder_data)
-    return {"status": "success", "reminder_id": reminder_data["id"]}
+    if reminder.delivery not in REMINDER_DELIVERY_MODES:
+        raise HTTPException(status_code=400, detail=f"delivery must be one of {', '.join(REMINDER_DELIVERY_MODES)}")
+    try:
+        due_at = parse_reminder_time(reminder.reminder_time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="reminder_time must be an ISO datetime")
+
+    reminder_id = await features_db_call(
+        _db_add_reminder, reminder.chat_id, reminder.message_id, reminder.reminder_time, due_at,
+        reminder.note, reminder.delivery, datetime.now().isoformat()
+    )
+    schedule_reminder(due_at, reminder_id)
+    return {"status": "success", "reminder_id": reminder_id}
 
 @app.get("/api/reminders")
-async def list_reminders(request: Request):
-    """List all reminders"""
+async def list_reminders(request: Request, status: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None):
+    """List reminders by due time, optionally filtered by status (pending, fired, failed)"""
     check_rate_limit(request)
-    return {"reminders": reminders_store}
+    limit = max(1, min(limit, 1000))
+    after = None
+    if cursor:
+        try:
+            due_at, reminder_id = cursor.split(":")
+            after = (float(due_at), int(reminder_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    rows = await features_db_call(_db_list_reminders, status, after, limit)
+    next_cursor = f"{rows[-1]['due_at']}:{rows[-1]['id']}" if len(rows) == limit else None
+    for row in rows:
+        row.pop("due_at")
+    return {"reminders": rows, "next_cursor": next_cursor}
+
+@app.delete("/api/reminders/{reminder_id}")
+async def delete_reminder(reminder_id: int, request: Request):
+    """Delete a reminder; a pending one will not fire"""
+    check_rate_limit(request)
+    if not await features_db_call(_db_delete_reminder, reminder_id):
+        raise HTTPException(status_code=404, detail="Reminder not found")
+    return {"status": "success"}
+
+async def resolve_tag_chat(chat_id: Optional[str]) -> int:
+    """Map a chat identifier to the peer id tags are keyed by (0 for tags without a chat)"""
+    if not chat_id:
+        return 0
+    if chat_id.lstrip('-').isdigit():
+        return int(chat_id)
+    check_client_connected()
+    return utils.get_peer_id(await get_entity_safe(chat_id))
+
+def _split_tags(value: Optional[str]) -> List[str]:
+    return [tag.strip() for tag in value.split(",") if tag.strip()] if value else []
 
 @app.post("/api/messages/{message_id}/tags")
 async def add_tags(message_id: int, request_tag: TagRequest, http_request: Request):
     """Add tags to a message"""
     check_rate_limit(http_request)
-    msg_key = str(message_id)
-    if msg_key not in tags_store:
-        tags_store[msg_key] = []
-    tags_store[msg_key].extend(request_tag.tags)
-    tags_store[msg_key] = list(set(tags_store[msg_key]))  # Remove duplicates
-    return {"status": "success", "tags": tags_store[msg_key]}
+    chat_key = await resolve_tag_chat(request_tag.chat_id)
+    tags = await features_db_call(_db_add_tags, chat_key, message_id, request_tag.tags)
+    return {"status": "success", "tags": tags}
+
+@app.delete("/api/messages/{message_id}/tags")
+async def remove_tags(message_id: int, tags: str, request: Request, chat_id: Optional[str] = None):
+    """Remove comma-separated tags from a message"""
+    check_rate_limit(request)
+    chat_key = await resolve_tag_chat(chat_id)
+    remaining = await features_db_call(_db_remove_tags, chat_key, message_id, _split_tags(tags))
+    return {"status": "success", "tags": remaining}
 
 @app.get("/api/messages/{message_id}/tags")
-async def get_tags(message_id: int, request: Request):
+async def get_tags(message_id: int, request: Request, chat_id: Optional[str] = None):
     """Get tags for a message"""
     check_rate_limit(request)
-    msg_key = str(message_id)
-    return {"tags": tags_store.get(msg_key, [])}
+    chat_key = await resolve_tag_chat(chat_id)
+    return {"tags": await features_db_call(_db_get_tags, chat_key, message_id)}
 
 @app.get("/api/tags")
 async def list_all_tags(request: Request):
-    """List all tags"""
+    """List all tags with the number of messages carrying each"""
+    check_rate_limit(request)
+    counts = await features_db_call(_db_tag_counts)
+    return {"tags": list(counts), "counts": counts}
+
+@app.get("/api/tags/search")
+async def search_tags(
+    request: Request,
+    all_of: Optional[str] = Query(None, alias="all"),
+    any_of: Optional[str] = Query(None, alias="any"),
+    none_of: Optional[str] = Query(None, alias="none"),
+    chat_id: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None
+):
+    """Find messages by tag: comma-separated `all` (AND), `any` (OR) and `none` (NOT) lists"""
     check_rate_limit(request)
-    all_tags = set()
-    for tags in tags_store.values():
-        all_tags.update(tags)
-    return {"tags": sorted(list(all_tags))}
+    all_tags, any_tags, none_tags = _split_tags(all_of), _split_tags(any_of), _split_tags(none_of)
+    if not all_tags and not any_tags:
+        raise HTTPException(status_code=400, detail="Give at least one tag in 'all' or 'any'")
+    limit = max(1, min(limit, 500))
+
+    before = None
+    if cursor:
+        try:
+            cursor_chat, cursor_message = cursor.split(":")
+            before = (int(cursor_chat), int(cursor_message))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    chat_key = await resolve_tag_chat(chat_id) if chat_id else None
+
+    rows = await features_db_call(_db_query_tags, all_tags, any_tags, none_tags, chat_key, before, limit)
+    return {
+        "results": [{"chat_id": str(chat), "message_id": message_id} for chat, message_id in rows],
+        "next_cursor": f"{rows[-1][0]}:{rows[-1][1]}" if len(rows) == limit else None
+    }
 
 # ============================================================================
 # WebSocket for Real-time Updates
 # ============================================================================
 
+async def replay_websocket_events(websocket: WebSocket, since: Optional[str]):
+    """Send buffered events after the client's cursor, then register the socket for live events.
+
+    Returns without registering if the cursor can't be served; the client is
+    told to resync instead.
+    """
+    last_seq = ws_event_state["seq"]
+    if since:
+        stream_id, _, seq = since.partition(":")
+        oldest = ws_replay_buffer[0][0] if ws_replay_buffer else ws_event_state["seq"] + 1
+        if stream_id == WS_STREAM_ID and seq.isdigit() and int(seq) >= oldest - 1:
+            last_seq = int(seq)
+        elif stream_id != WS_STREAM_ID and oldest == 1:
+            # Server restarted but still holds every event since (including its catch-up)
+            last_seq = 0
+        else:
+            await websocket.send_json({
+                "type": "resync_required",
+                "reason": "cursor_expired" if stream_id == WS_STREAM_ID else "server_restarted",
+                "cursor": f"{WS_STREAM_ID}:{ws_event_state['seq']}"
+            })
+            last_seq = ws_event_state["seq"]
+
+    # Events broadcast while we replay land in the buffer, so loop until caught up;
+    # registering happens with no await after the last check, so nothing is lost or reordered
+    while last_seq < ws_event_state["seq"]:
+        if not ws_replay_buffer or ws_replay_buffer[0][0] > last_seq + 1:
+            # Events were evicted while this client was being replayed to (or WS_REPLAY_SIZE is 0)
+            await websocket.send_json({"type": "resync_required", "reason": "cursor_expired", "cursor": f"{WS_STREAM_ID}:{ws_event_state['seq']}"})
+            break
+        pending = [event for seq, event in ws_replay_buffer if seq > last_seq]
+        for event in pending:
+            await websocket.send_json(event)
+        last_seq = pending[-1]["seq"] if pending else ws_event_state["seq"]
+    websocket_connections.append(websocket)
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time updates"""
+async def websocket_endpoint(websocket: WebSocket, since: Optional[str] = None):
+    """WebSocket endpoint for real-time updates; pass ?since=<cursor> to resume after a reconnect"""
     await websocket.accept()
-    websocket_connections.append(websocket)
 
     try:
         # Send initial connection message
         await websocket.send_json({
             "type": "connected",
             "status": "success",
-            "message": "WebSocket connected"
+            "message": "WebSocket connected",
+            "cursor": f"{WS_STREAM_ID}:{ws_event_state['seq']}"
         })
+        await replay_websocket_events(websocket, since)
 
         # Keep connection alive
         while True:
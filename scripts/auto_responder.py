@@ -2,22 +2,43 @@
 """
 Auto-Responder Script
 Automatically responds to messages based on keywords or patterns.
+Runs the reply, tag and webhook actions of the rules in RULES_FILE (see
+rule_engine.py); without a rules file, RESPONSE_RULES below is used.
+Listens to the /ws event stream and reacts to new_message events only, so the
+work scales with incoming traffic instead of the number of chats. The stream
+cursor is advanced after every event, saved with the handled messages (see
+dedup_state.py) and passed back as /ws?since=<cursor> on reconnect, so no
+message is missed while the connection is down.
+
+A message counts as handled only once all its actions succeeded. When one
+fails, the cursor stays before the message and the responder reconnects with
+backoff, so the replay retries the failed actions (actions that already
+succeeded aren't repeated). After MAX_ACTION_ATTEMPTS tries it gives up on the
+message and moves on.
 """
 
-import requests
-import time
+import asyncio
 import json
 import os
-from typing import Dict, List
+
+import requests
+import websockets
 from dotenv import load_dotenv
 
+from dedup_state import DedupState
+from rule_engine import RuleEngine, legacy_rules
+
 load_dotenv()
 
 API_URL = os.getenv("API_URL", "http://localhost:8001")
+WS_URL = os.getenv("WS_URL", API_URL.replace("http", "ws", 1) + "/ws")
 API_KEY = os.getenv("API_KEY", None)  # Optional API key
-CHECK_INTERVAL = 5  # Check every 5 seconds
+STATE_FILE = os.getenv("RESPONDER_STATE_FILE", "auto_responder_state.json")
+RULES_FILE = os.getenv("RULES_FILE", "rules.json")
+MAX_RECONNECT_DELAY = 60
+MAX_ACTION_ATTEMPTS = 3
 
-# Response rules: keyword -> response message
+# Response rules used when there is no rules file: keyword -> response message
 RESPONSE_RULES = {
     "help": "Here's how I can help you:\n- Type 'info' for information\n- Type 'contact' for contact details",
     "info": "This is an automated Telegram client with full API access.",
@@ -26,8 +47,19 @@ RESPONSE_RULES = {
     "hi": "Hi there! What can I do for you?",
 }
 
-# Track processed messages to avoid duplicate responses
-processed_messages = set()
+# Whole-word matching, so "hi" doesn't fire on "this"; the forwarder runs the forward actions
+rule_engine = RuleEngine(RULES_FILE, fallback=legacy_rules(response_rules=RESPONSE_RULES))
+ACTION_TYPES = ("reply", "tag", "webhook")
+
+# Stream cursor and handled messages, so replayed events and restarts don't answer twice
+dedup = DedupState(STATE_FILE)
+# Messages whose actions failed: (chat ID, message ID) -> attempts so far and indexes of actions that succeeded
+retries = {}
+reconnect_state = {"delay": 1}  # Seconds to wait before the next reconnect; reset once events are handled
+
+
+class ActionsFailed(Exception):
+    """Some actions of a message failed; replay from before it to retry them"""
 
 
 def get_headers():
@@ -38,32 +70,10 @@ def get_headers():
     return headers
 
 
-def get_chats():
-    """Get list of all chats"""
-    try:
-        response = requests.get(f"{API_URL}/api/chats", headers=get_headers(), timeout=10)
-        if response.status_code == 200:
-            return response.json().get("chats", [])
-        return []
-    except Exception as e:
-        print(f"Error getting chats: {e}")
-        return []
-
-
-def get_messages(chat_id: str, limit: int = 10):
-    """Get recent messages from a chat"""
-    try:
-        response = requests.get(
-            f"{API_URL}/api/messages/{chat_id}?limit={limit}",
-            headers=get_headers(),
-            timeout=10
-        )
-        if response.status_code == 200:
-            return response.json().get("messages", [])
-        return []
-    except Exception as e:
-        print(f"Error getting messages: {e}")
-        return []
+def save_cursor(cursor: str):
+    """Save the last processed stream cursor along with the handled messages"""
+    dedup.cursor = cursor
+    dedup.save()
 
 
 def send_message(chat_id: str, message: str):
@@ -81,85 +91,159 @@ def send_message(chat_id: str, message: str):
         return False
 
 
-def should_respond(message_text: str) -> tuple[bool, str]:
-    """Check if we should respond and what to respond with"""
-    if not message_text:
-        return False, ""
-
-    message_lower = message_text.lower().strip()
-
-    # Check for exact keyword matches
-    for keyword, response in RESPONSE_RULES.items():
-        if message_lower == keyword or message_lower.startswith(f"{keyword} "):
-            return True, response
-
-    # Check for keyword in message
-    for keyword, response in RESPONSE_RULES.items():
-        if keyword in message_lower:
-            return True, response
-
-    return False, ""
-
+def tag_message(chat_id: str, message_id: int, tags: list):
+    """Tag a message"""
+    try:
+        response = requests.post(
+            f"{API_URL}/api/messages/{message_id}/tags",
+            headers=get_headers(),
+            json={"chat_id": chat_id, "message_id": message_id, "tags": tags},
+            timeout=10
+        )
+        return response.status_code == 200
+    except Exception as e:
+        print(f"Error tagging message: {e}")
+        return False
 
-def process_chat(chat_id: str):
-    """Process messages in a chat and respond if needed"""
-    messages = get_messages(chat_id, limit=5)
 
-    for msg in messages:
-        msg_id = msg.get("id")
-        msg_key = f"{chat_id}_{msg_id}"
+def call_webhook(url: str, rule_id: str, chat_id: str, message: dict):
+    """POST the matched message to a webhook"""
+    try:
+        response = requests.post(
+            url,
+            json={"rule": rule_id, "chat_id": chat_id, "message": message},
+            timeout=10
+        )
+        return response.status_code < 300
+    except Exception as e:
+        print(f"Error calling webhook: {e}")
+        return False
 
-        # Skip if already processed
-        if msg_key in processed_messages:
-            continue
 
-        # Skip outgoing messages (from us)
-        if msg.get("is_out"):
-            processed_messages.add(msg_key)
+def should_respond(message_text: str, chat_id: str = None) -> tuple[bool, str]:
+    """Check if we should respond to an incoming text message and what to respond with"""
+    replies = rule_engine.actions_for(chat_id, {"text": message_text}, ["reply"])
+    if not replies:
+        return False, ""
+    return True, replies[0][1]["text"]
+
+
+async def run_action(rule, action: dict, chat_id: str, msg: dict) -> bool:
+    """Run one reply / tag / webhook action; requests is blocking, so keep the event stream flowing"""
+    if action["type"] == "reply":
+        return await asyncio.to_thread(send_message, chat_id, action["text"])
+    if action["type"] == "tag":
+        return await asyncio.to_thread(tag_message, chat_id, msg.get("id"), action["tags"])
+    return await asyncio.to_thread(call_webhook, action["url"], rule.rule_id, chat_id, msg)
+
+
+async def handle_new_message(event: dict) -> bool:
+    """Run the matching rule actions for a new message; False if any failed and should be retried"""
+    chat_id = event.get("chat_id")
+    msg = event.get("message", {})
+    msg_id = msg.get("id")
+
+    # Skip messages already handled
+    if not msg_id or dedup.seen(chat_id, msg_id):
+        return True
+
+    key = (chat_id, msg_id)
+    retry = retries.setdefault(key, {"attempts": 0, "done": set()})
+    retry["attempts"] += 1
+    failed = False
+    for index, (rule, action) in enumerate(rule_engine.actions_for(chat_id, msg, ACTION_TYPES)):
+        if index in retry["done"]:
             continue
-
-        # Check if we should respond
-        message_text = msg.get("text", "")
-        should, response = should_respond(message_text)
-
-        if should:
-            print(f"Responding to message in chat {chat_id}: {message_text[:50]}...")
-            if send_message(chat_id, response):
-                processed_messages.add(msg_key)
-                print(f"✓ Sent response: {response[:50]}...")
-            else:
-                print(f"✗ Failed to send response")
+        print(f"Rule {rule.rule_id}: {action['type']} for message {msg.get('id')} in chat {chat_id}: {msg.get('text', '')[:50]}...")
+        if await run_action(rule, action, chat_id, msg):
+            print(f"✓ {action['type']} done")
+            retry["done"].add(index)
+        else:
+            print(f"✗ {action['type']} failed")
+            failed = True
+
+    if failed and retry["attempts"] < MAX_ACTION_ATTEMPTS:
+        return False
+    if failed:
+        print(f"✗ Giving up on message {msg_id} in chat {chat_id} after {MAX_ACTION_ATTEMPTS} attempts")
+    del retries[key]
+    dedup.mark(chat_id, msg_id)
+    return True
+
+
+async def handle_event(event: dict, cursor):
+    """Handle one stream event; return the cursor to resume from"""
+    event_type = event.get("type")
+
+    if event_type == "connected":
+        if cursor is None:
+            cursor = event["cursor"]
+            save_cursor(cursor)
+        return cursor
+    if event_type == "resync_required":
+        # Events were dropped from the server's replay buffer; continue from now
+        print(f"⚠️  Missed events ({event.get('reason')}), continuing from the current position")
+        save_cursor(event["cursor"])
+        return event["cursor"]
+    if "cursor" not in event:
+        return cursor  # ping / echo
+
+    if event_type == "new_message" and not await handle_new_message(event):
+        # Keep the cursor before this message so the replay after reconnecting retries it
+        raise ActionsFailed(f"actions for message {event['message'].get('id')} in chat {event.get('chat_id')} failed")
+    save_cursor(event["cursor"])
+    return event["cursor"]
+
+
+async def consume_events(cursor):
+    """Connect to the event stream, resuming after `cursor`, and handle events until disconnected"""
+    url = f"{WS_URL}?since={cursor}" if cursor else WS_URL
+    async with websockets.connect(url) as ws:
+        print(f"✓ Connected to {WS_URL}" + (f" (resuming after {cursor})" if cursor else ""))
+        async for raw in ws:
+            try:
+                handled = await handle_event(json.loads(raw), cursor)
+                if handled != cursor:
+                    # Events are flowing again; the next disconnect starts the backoff over
+                    reconnect_state["delay"] = 1
+                cursor = handled
+            except ActionsFailed:
+                raise
+            except Exception as e:
+                # One bad event mustn't stop the responder
+                print(f"⚠️  Skipping event that could not be handled ({e}): {str(raw)[:100]}")
+
+
+async def run():
+    """Consume the event stream forever, reconnecting with backoff"""
+    autosave = asyncio.create_task(dedup.autosave())
+    try:
+        while True:
+            try:
+                await consume_events(dedup.cursor)
+                reconnect_state["delay"] = 1
+            except (OSError, websockets.WebSocketException) as e:
+                print(f"Connection lost: {e}; reconnecting in {reconnect_state['delay']}s")
+            except ActionsFailed as e:
+                print(f"⚠️  {e}; retrying in {reconnect_state['delay']}s")
+            await asyncio.sleep(reconnect_state["delay"])
+            reconnect_state["delay"] = min(reconnect_state["delay"] * 2, MAX_RECONNECT_DELAY)
+    finally:
+        autosave.cancel()
+        dedup.save(force=True)
 
 
 def main():
     """Main loop"""
     print("🤖 Auto-Responder Started")
-    print(f"API URL: {API_URL}")
-    print(f"Response Rules: {len(RESPONSE_RULES)} keywords")
-    print(f"Check Interval: {CHECK_INTERVAL} seconds")
+    print(f"Event stream: {WS_URL}")
+    print(f"Rules: {len(rule_engine.ruleset.rules)} from {rule_engine.ruleset.source}")
     print("-" * 50)
 
-    while True:
-        try:
-            chats = get_chats()
-            print(f"Checking {len(chats)} chats...")
-
-            for chat in chats:
-                chat_id = str(chat.get("id"))
-                process_chat(chat_id)
-
-            # Clean up old processed messages (keep last 1000)
-            if len(processed_messages) > 1000:
-                processed_messages.clear()
-
-            time.sleep(CHECK_INTERVAL)
-
-        except KeyboardInterrupt:
-            print("\n\n👋 Auto-Responder Stopped")
-            break
-        except Exception as e:
-            print(f"Error in main loop: {e}")
-            time.sleep(CHECK_INTERVAL)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("\n\n👋 Auto-Responder Stopped")
 
 
 if __name__ == "__main__":
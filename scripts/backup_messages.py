@@ -1,21 +1,462 @@
 #!/usr/bin/env python3
 """
 Message Backup Script
-Backs up all messages from chats to JSON files.
+Backs up messages from chats to compressed NDJSON files, incrementally.
+
+Each chat has one backup stream (see backup_stream.py) that every run appends
+to: the first run fetches the whole history, oldest first; later runs fetch
+only messages newer than the last one backed up. Messages are streamed into
+the compressor page by page, so memory use doesn't grow with the chat. Every
+CHECKPOINT_PAGES pages the current frame is closed and synced and the chat's
+position is saved in BACKUP_DIR/backup_state.json, so an interrupted run
+resumes from the last checkpoint instead of starting over.
+
+Edits and deletions of already backed-up messages come from the server's
+change log (/api/messages/{chat_id}/changes): edited messages are fetched
+again and appended as new versions, deletions as {"id": ..., "deleted": true}
+records. The change log only covers what the server saw while it was running;
+when it can't cover the gap since the last run (HTTP 410) that is reported and
+tracking restarts.
+
+BACKUP_CONCURRENCY chats are backed up at a time. All of them share one
+limiter that paces requests to BACKUP_RATE per second and, on a flood wait,
+holds every chat back for as long as Telegram asked. Connection errors, 5xx
+responses and flood waits are retried with exponential backoff; a chat that
+still fails is skipped and retried on the next run.
+
+With --media (or BACKUP_MEDIA=true) photos and files are downloaded too, into
+a content-addressed store in BACKUP_DIR/media (see media_store.py) shared by
+all chats and runs, so a file forwarded to ten chats is downloaded and stored
+once. Each message record gets a "media_ref" with the file's SHA-256, size and
+path. BACKUP_MEDIA_CONCURRENCY downloads run at a time through the same
+limiter. Files over BACKUP_MEDIA_MAX_SIZE_MB are skipped. Once a run has
+downloaded BACKUP_MEDIA_BUDGET_MB, further downloads wait for the next run.
+Media skipped because of the budget or a failed download is retried on later
+runs, and the updated record is appended as a new version of the message.
+
+Usage:
+    python backup_messages.py            # Through the API server (API_URL)
+    python backup_messages.py --media    # Also back up photos and files
+    python backup_messages.py --direct   # Straight through Telethon with the
+                                         # session from scripts/auth_cli.py;
+                                         # stop the API server first, and note
+                                         # edits aren't tracked in this mode
 """
 
 import requests
+import asyncio
 import json
 import os
+import random
+import sys
+import time
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from backup_stream import BackupWriter, DEFAULT_CODEC
+from media_store import HashingFile, MediaStore
 
 load_dotenv()
 
 API_URL = os.getenv("API_URL", "http://localhost:8001")
 API_KEY = os.getenv("API_KEY", None)
 BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_CODEC = os.getenv("BACKUP_CODEC", DEFAULT_CODEC)  # zstd or gzip
+BACKUP_CONCURRENCY = int(os.getenv("BACKUP_CONCURRENCY", "4"))  # Chats backed up at the same time
+BACKUP_RATE = float(os.getenv("BACKUP_RATE", "10"))  # Requests per second across all chats
+STATE_FILE = os.path.join(BACKUP_DIR, "backup_state.json")
+PAGE_SIZE = 100
+CHECKPOINT_PAGES = 10  # Pages per compressed frame and state checkpoint
+MAX_RETRIES = 5
+MAX_BACKOFF = 60
+PROGRESS_INTERVAL = 15  # Seconds between overall progress lines
+
+# Media backup settings
+BACKUP_MEDIA = os.getenv("BACKUP_MEDIA", "false").lower() == "true"
+MEDIA_DIR = os.path.join(BACKUP_DIR, "media")
+MEDIA_CONCURRENCY = int(os.getenv("BACKUP_MEDIA_CONCURRENCY", "4"))  # Downloads at the same time across all chats
+MEDIA_MAX_SIZE = int(float(os.getenv("BACKUP_MEDIA_MAX_SIZE_MB", "50")) * 1024 * 1024)  # Larger files are skipped
+MEDIA_BUDGET = int(float(os.getenv("BACKUP_MEDIA_BUDGET_MB", "0")) * 1024 * 1024)  # Bytes per run; 0 = no limit
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+class ChangeLogGap(Exception):
+    """The server can no longer list changes since the saved token"""
+
+
+class TransientError(Exception):
+    """A failure worth retrying"""
+
+
+class MediaBudgetExceeded(Exception):
+    """The run's download budget has no room for a file"""
+
+
+class FloodLimiter:
+    """Request pacing shared by all chats, paused for everyone during a flood wait"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait for this request's turn"""
+        async with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_slot, self.paused_until)
+            self.next_slot = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def flood_wait(self, seconds: float):
+        """Hold back every request for `seconds`"""
+        until = time.monotonic() + seconds
+        if until > self.paused_until:
+            self.paused_until = until
+            print(f"⏳ Flood wait: pausing all chats for {seconds:.0f}s")
+
+    async def call(self, func, *args):
+        """Run a request through the limiter, retrying transient failures with exponential backoff"""
+        for attempt in range(MAX_RETRIES + 1):
+            await self.acquire()
+            try:
+                return await func(*args)
+            except TransientError as e:
+                error = e
+            if attempt == MAX_RETRIES:
+                raise RuntimeError(f"failed after {MAX_RETRIES + 1} attempts: {error}")
+            await asyncio.sleep(min(2 ** attempt, MAX_BACKOFF) * (0.5 + random.random() / 2))
+
+
+class ApiSource:
+    """Messages from the API server over one pooled HTTP session"""
+
+    supports_changes = True
+
+    def __init__(self, limiter: FloodLimiter):
+        self.limiter = limiter
+        self.session = requests.Session()
+        # Keep a connection per concurrent chat alive instead of reconnecting for every page
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=BACKUP_CONCURRENCY * 2 + MEDIA_CONCURRENCY)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(get_headers())
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        self.session.close()
+
+    async def _get(self, path: str, params: Optional[Dict]) -> Dict:
+        try:
+            response = await asyncio.to_thread(self.session.get, f"{API_URL}{path}", params=params, timeout=30)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise TransientError(str(e) or type(e).__name__)
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code == 410:
+            raise ChangeLogGap(response.json().get("detail", "gone"))
+        self._raise_for_status(response)
+
+    def _raise_for_status(self, response):
+        if response.status_code == 429:
+            self.limiter.flood_wait(float(response.headers.get("Retry-After", 5)))
+            raise TransientError("flood wait")
+        if response.status_code >= 500:
+            raise TransientError(f"HTTP {response.status_code}")
+        response.raise_for_status()
+
+    async def get(self, path: str, params: Optional[Dict] = None) -> Dict:
+        return await self.limiter.call(self._get, path, params)
+
+    async def chats(self) -> List[Dict]:
+        return (await self.get("/api/chats", {"limit": 1000})).get("chats", [])
+
+    async def page(self, chat_id: str, after_id: int) -> List[Dict]:
+        """Up to PAGE_SIZE messages newer than after_id, oldest first"""
+        params = {"limit": PAGE_SIZE, "offset_id": after_id, "reverse": "true"}
+        return (await self.get(f"/api/messages/{chat_id}", params)).get("messages", [])
+
+    async def messages_by_id(self, chat_id: str, message_ids: List[int]) -> List[Dict]:
+        params = {"ids": ",".join(map(str, message_ids))}
+        return (await self.get(f"/api/messages/{chat_id}", params)).get("messages", [])
+
+    async def changes(self, chat_id: str, since: Optional[str] = None) -> Dict:
+        return await self.get(f"/api/messages/{chat_id}/changes", {"since": since} if since else None)
+
+    async def _download(self, chat_id: str, message_id: int, out: HashingFile) -> bool:
+        out.reset()
+        url = f"{API_URL}/api/files/download/{chat_id}/{message_id}"
+        try:
+            response = await asyncio.to_thread(self.session.get, url, stream=True, timeout=60)
+            with response:
+                if response.status_code == 404:
+                    return False
+                self._raise_for_status(response)
+                await asyncio.to_thread(copy_response, response, out)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            raise TransientError(str(e) or type(e).__name__)
+        return True
+
+    async def download(self, chat_id: str, message_id: int, out: HashingFile) -> bool:
+        """Download a message's media into out; False if the message or its media is gone"""
+        return await self.limiter.call(self._download, chat_id, message_id, out)
+
+
+class DirectSource:
+    """Messages straight from Telegram through an in-process Telethon client"""
+
+    supports_changes = False  # The change log lives in the API server
+
+    def __init__(self, limiter: FloodLimiter):
+        self.limiter = limiter
+        self.client = None
+        self.entities = {}
+        self.media_messages: Dict[str, Dict] = {}  # chat ID -> {message ID: message} of the last page, to download from
+
+    async def start(self):
+        from telethon import TelegramClient
+
+        api_id = os.getenv("TELEGRAM_API_ID")
+        api_hash = os.getenv("TELEGRAM_API_HASH")
+        phone = os.getenv("TELEGRAM_PHONE_NUMBER")
+        if not all([api_id, api_hash, phone]):
+            raise RuntimeError("Missing Telegram credentials in .env file")
+
+        session_name = f"data/telegram_session_{phone.replace('+', '')}"
+        self.client = TelegramClient(session_name, int(api_id), api_hash)
+        # Surface every flood wait so the shared limiter can hold back all chats
+        self.client.flood_sleep_threshold = 0
+        await self.client.connect()
+        if not await self.client.is_user_authorized():
+            raise RuntimeError("Not authorized; run scripts/auth_cli.py first")
+
+    async def close(self):
+        if self.client:
+            await self.client.disconnect()
+
+    async def run(self, request):
+        """Run request(), a coroutine function using the client, through the limiter"""
+        from telethon.errors import FloodWaitError, ServerError
+
+        async def attempt():
+            try:
+                return await request()
+            except FloodWaitError as e:
+                self.limiter.flood_wait(e.seconds)
+                raise TransientError("flood wait")
+            except (ServerError, ConnectionError, asyncio.TimeoutError) as e:
+                raise TransientError(str(e) or type(e).__name__)
+
+        return await self.limiter.call(attempt)
+
+    async def call(self, method: str, *args, **kwargs):
+        """Call a client method through the limiter"""
+        return await self.run(lambda: getattr(self.client, method)(*args, **kwargs))
+
+    async def chats(self) -> List[Dict]:
+        chats = []
+        for dialog in await self.call("get_dialogs", limit=1000):
+            self.entities[str(dialog.id)] = dialog.input_entity
+            chats.append({
+                "id": str(dialog.id),
+                "name": dialog.name,
+                "last_message_id": dialog.message.id if dialog.message else None,
+            })
+        return chats
+
+    async def page(self, chat_id: str, after_id: int) -> List[Dict]:
+        """Up to PAGE_SIZE messages newer than after_id, oldest first"""
+        messages = await self.call("get_messages", self.entities[chat_id],
+                                   limit=PAGE_SIZE, offset_id=after_id, reverse=True)
+        self.media_messages[chat_id] = {message.id: message for message in messages if message.file}
+        return [serialize_message(message) for message in messages]
+
+    async def messages_by_id(self, chat_id: str, message_ids: List[int]) -> List[Dict]:
+        messages = [message for message in await self.call("get_messages", self.entities[chat_id], ids=message_ids)
+                    if message]
+        self.media_messages[chat_id] = {message.id: message for message in messages if message.file}
+        return [serialize_message(message) for message in messages]
+
+    async def download(self, chat_id: str, message_id: int, out: HashingFile) -> bool:
+        """Download a message's media into out; False if the message or its media is gone"""
+        message = self.media_messages.get(chat_id, {}).get(message_id)
+        if message is None:
+            message = await self.call("get_messages", self.entities[chat_id], ids=message_id)
+        if message is None or not message.file:
+            return False
+
+        async def download_once():
+            out.reset()
+            return await self.client.download_media(message, file=out)
+
+        return await self.run(download_once) is not None
+
+
+def serialize_message(msg) -> Dict:
+    """The core fields of a message as GET /api/messages/{chat_id} returns them"""
+    data = {
+        "id": msg.id,
+        "text": msg.text or "",
+        "date": msg.date.isoformat() if msg.date else None,
+        "sender_id": msg.sender_id,
+        "is_out": msg.out,
+        "is_reply": msg.is_reply,
+        "reply_to_msg_id": msg.reply_to.reply_to_msg_id if msg.reply_to else None,
+        "has_media": bool(msg.media),
+    }
+    if msg.media:
+        data["media_type"] = type(msg.media).__name__
+        data["media_message_id"] = msg.id
+        if msg.file:
+            data["mime_type"] = msg.file.mime_type or ""
+            data["file_name"] = msg.file.name
+        if msg.file and (msg.photo or msg.document):
+            data["media_id"] = f"{'photo' if msg.photo else 'document'}:{(msg.photo or msg.document).id}"
+            data["file_size"] = msg.file.size
+    return data
+
+
+def copy_response(response, out: HashingFile):
+    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+        out.write(chunk)
+
+
+class MediaFetcher:
+    """Downloads message media into the shared store, within the size limit and the run's byte budget"""
+
+    def __init__(self, source, store: MediaStore):
+        self.source = source
+        self.store = store
+        self.semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+        self.in_flight: Dict[str, asyncio.Task] = {}  # media ID -> download task, shared by chats with the same file
+        self.reserved = 0  # Bytes of downloads in progress
+        self.downloaded_bytes = 0
+        self.downloaded = 0
+        self.reused = 0
+        self.budget_exhausted = False
+
+    @staticmethod
+    def wanted(message: Dict) -> bool:
+        return bool(message.get("media_id")) and (message.get("file_size") or 0) <= MEDIA_MAX_SIZE
+
+    async def _download(self, chat_id: str, message: Dict) -> Optional[Dict]:
+        size = message.get("file_size") or 0
+        if MEDIA_BUDGET and self.downloaded_bytes + self.reserved + size > MEDIA_BUDGET:
+            if not self.budget_exhausted:
+                self.budget_exhausted = True
+                print(f"⚠️  Media budget of {MEDIA_BUDGET / 1024 / 1024:g} MB reached; "
+                      f"remaining files are downloaded on the next run")
+            raise MediaBudgetExceeded()
+
+        self.reserved += size
+        try:
+            async with self.semaphore:
+                download = await asyncio.to_thread(self.store.open_temp)
+                try:
+                    if not await self.source.download(chat_id, message["id"], download):
+                        await asyncio.to_thread(download.discard)
+                        return None
+                    entry = await asyncio.to_thread(self.store.add, download, message["media_id"])
+                except BaseException:
+                    await asyncio.to_thread(download.discard)
+                    raise
+        finally:
+            self.reserved -= size
+        self.downloaded += 1
+        self.downloaded_bytes += entry["size"]
+        return entry
+
+    async def fetch(self, chat_id: str, message: Dict) -> Optional[Dict]:
+        """The stored object for a message's media, downloaded unless already stored; None if it's gone"""
+        media_id = message["media_id"]
+        entry = self.store.lookup(media_id)
+        if entry:
+            self.reused += 1
+            return entry
+
+        task = self.in_flight.get(media_id)
+        if task is None:
+            task = self.in_flight[media_id] = asyncio.create_task(self._download(chat_id, message))
+            task.add_done_callback(lambda _: self.in_flight.pop(media_id, None))
+        else:
+            self.reused += 1
+        return await task
+
+    async def attach(self, chat_id: str, messages: List[Dict], chat_state: Dict):
+        """Download the media of messages and add references to their records before they are written"""
+        pending = set(chat_state.get("media_pending", []))
+
+        async def attach_one(message: Dict):
+            try:
+                entry = await self.fetch(chat_id, message)
+            except MediaBudgetExceeded:
+                pending.add(message["id"])
+                return
+            except Exception as e:
+                print(f"  ✗ Media of message {message['id']} in chat {chat_id}: {e}")
+                pending.add(message["id"])
+                return
+            pending.discard(message["id"])
+            if entry:
+                message["media_ref"] = {
+                    "sha256": entry["sha256"],
+                    "size": entry["size"],
+                    "path": os.path.relpath(self.store.object_path(entry["sha256"]), BACKUP_DIR),
+                }
+
+        await asyncio.gather(*(attach_one(message) for message in messages if self.wanted(message)))
+        if pending:
+            chat_state["media_pending"] = sorted(pending)
+        else:
+            chat_state.pop("media_pending", None)
+
+
+class Progress:
+    """Overall and per-chat progress with an ETA"""
+
+    def __init__(self, chats: List[Dict], state: Dict):
+        self.total_chats = len(chats)
+        self.done_chats = 0
+        self.failed_chats = 0
+        self.fetched = 0
+        # Message IDs are only roughly sequential outside channels, so this is an upper bound
+        self.expected = sum(
+            max(0, int(chat.get("last_message_id") or 0) - state["chats"].get(str(chat.get("id")), {}).get("last_id", 0))
+            for chat in chats
+        )
+        self.started = time.monotonic()
+
+    def eta(self) -> str:
+        elapsed = time.monotonic() - self.started
+        if not self.fetched or not elapsed:
+            return "unknown"
+        seconds = max(0, self.expected - self.fetched) / (self.fetched / elapsed)
+        if seconds >= 3600:
+            return f"{int(seconds // 3600)}h{int(seconds % 3600 // 60):02d}m"
+        return f"{int(seconds // 60)}m{int(seconds % 60):02d}s"
+
+    def chat_finished(self, name: str, count: int, seconds: float, error: Optional[Exception] = None):
+        self.done_chats += 1
+        prefix = f"[{self.done_chats}/{self.total_chats}]"
+        if error:
+            self.failed_chats += 1
+            print(f"{prefix} ✗ {name}: {error}")
+        elif count:
+            print(f"{prefix} ✓ {name}: {count} new messages in {seconds:.1f}s")
+        else:
+            print(f"{prefix} {name}: no new messages")
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.fetched / elapsed if elapsed else 0
+        print(f"⏳ {self.done_chats}/{self.total_chats} chats, {self.fetched:,}/~{self.expected:,} messages, "
+              f"{rate:,.0f} msg/s, ETA {self.eta()}")
 
 
 def get_headers():
@@ -26,105 +467,227 @@ def get_headers():
     return headers
 
 
-def get_chats():
-    """Get list of all chats"""
+def load_state() -> Dict:
+    """Load per-chat backup progress"""
     try:
-        response = requests.get(f"{API_URL}/api/chats?limit=1000", headers=get_headers(), timeout=30)
-        if response.status_code == 200:
-            return response.json().get("chats", [])
-        return []
-    except Exception as e:
-        print(f"Error getting chats: {e}")
-        return []
-
-
-def get_all_messages(chat_id: str, limit: int = 100):
-    """Get all messages from a chat (with pagination)"""
-    all_messages = []
-    offset_id = 0
-
-    while True:
-        try:
-            response = requests.get(
-                f"{API_URL}/api/messages/{chat_id}?limit={limit}&offset_id={offset_id}",
-                headers=get_headers(),
-                timeout=30
-            )
-            if response.status_code != 200:
-                break
-
-            messages = response.json().get("messages", [])
-            if not messages:
-                break
-
-            all_messages.extend(messages)
-
-            # Update offset for next batch
-            if len(messages) < limit:
-                break
-            offset_id = messages[-1].get("id", 0)
-
-        except Exception as e:
-            print(f"Error getting messages: {e}")
-            break
-
-    return all_messages
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"chats": {}}
 
 
-def backup_chat(chat: Dict):
-    """Backup all messages from a chat"""
+def save_state(state: Dict):
+    """Atomically save per-chat backup progress"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    tmp_path = f"{STATE_FILE}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, STATE_FILE)
+
+
+def chat_backup_path(chat: Dict, chat_state: Dict) -> str:
+    """Backup stream of a chat; the file name is fixed on the first run so renames don't split it"""
+    if "file" not in chat_state:
+        chat_id = str(chat.get("id"))
+        chat_name = chat.get("name", f"chat_{chat_id}")
+        # Sanitize filename
+        safe_name = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in chat_name)
+        extension = "zst" if BACKUP_CODEC == "zstd" else "gz"
+        chat_state["file"] = f"{safe_name}_{chat_id}.ndjson.{extension}"
+    return os.path.join(BACKUP_DIR, chat_state["file"])
+
+
+async def backup_edits(source, chat: Dict, chat_state: Dict, writer: BackupWriter):
+    """Record edits and deletions of backed-up messages since the last run"""
     chat_id = str(chat.get("id"))
     chat_name = chat.get("name", f"chat_{chat_id}")
+    last_id = chat_state.get("last_id", 0)
+    token = chat_state.get("changes_token")
 
-    # Sanitize filename
-    safe_name = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in chat_name)
-
-    print(f"Backing up chat: {chat_name} ({chat_id})")
-
-    messages = get_all_messages(chat_id)
-
-    if not messages:
-        print(f"  No messages found")
+    if token is None:
+        # Start tracking before fetching, so edits made during this run are seen next time
+        chat_state["changes_token"] = (await source.changes(chat_id))["next"]
         return
 
-    # Create backup data
-    backup_data = {
-        "chat": chat,
-        "backup_date": datetime.now().isoformat(),
-        "message_count": len(messages),
-        "messages": messages
-    }
+    try:
+        changes = await source.changes(chat_id, token)
+    except ChangeLogGap as e:
+        print(f"  ⚠️  {chat_name}: edits since the last run are unknown ({e}); tracking them from now on")
+        chat_state["changes_token"] = (await source.changes(chat_id))["next"]
+        return
 
-    # Save to file
+    # Newer IDs are fetched by the incremental pass anyway
+    edited_ids = sorted(message_id for message_id in changes["edited"] if message_id <= last_id)
+    deleted_ids = sorted(message_id for message_id in changes["deleted"] if message_id <= last_id)
+    if edited_ids or deleted_ids:
+        edited = 0
+        for start in range(0, len(edited_ids), PAGE_SIZE):
+            messages = await source.messages_by_id(chat_id, edited_ids[start:start + PAGE_SIZE])
+            await asyncio.to_thread(writer.write_many, messages)
+            edited += len(messages)
+        await asyncio.to_thread(writer.write_many, [{"id": message_id, "deleted": True} for message_id in deleted_ids])
+        await asyncio.to_thread(writer.flush)
+        print(f"  ✓ {chat_name}: recorded {edited} edited and {len(deleted_ids)} deleted messages")
+    chat_state["changes_token"] = changes["next"]
+
+
+async def retry_media(source, chat: Dict, chat_state: Dict, writer: BackupWriter, media: MediaFetcher):
+    """Download media skipped by earlier runs and append the updated records"""
+    chat_id = str(chat.get("id"))
+    pending = chat_state["media_pending"]
+    retried = 0
+    for start in range(0, len(pending), PAGE_SIZE):
+        if media.budget_exhausted:
+            break
+        chunk = pending[start:start + PAGE_SIZE]
+        messages = await source.messages_by_id(chat_id, chunk)
+        # Deleted messages and ones without media anymore are no longer pending
+        found = {message["id"] for message in messages if media.wanted(message)}
+        chat_state["media_pending"] = [message_id for message_id in chat_state["media_pending"]
+                                       if message_id not in chunk or message_id in found]
+        await media.attach(chat_id, messages, chat_state)
+        updated = [message for message in messages if "media_ref" in message]
+        await asyncio.to_thread(writer.write_many, updated)
+        retried += len(updated)
+    await asyncio.to_thread(writer.flush)
+    if retried:
+        print(f"  ✓ {chat.get('name', f'chat_{chat_id}')}: downloaded media of {retried} earlier messages")
+
+
+async def backup_chat(source, chat: Dict, state: Dict, progress: Progress,
+                      media: Optional[MediaFetcher] = None) -> int:
+    """Back up the messages of a chat that are newer than its last checkpoint; return how many"""
+    chat_id = str(chat.get("id"))
+    chat_name = chat.get("name", f"chat_{chat_id}")
+    chat_state = state["chats"].setdefault(chat_id, {"last_id": 0})
+    chat_state["name"] = chat_name
+    path = chat_backup_path(chat, chat_state)
+    total = 0
+
+    async def checkpoint():
+        await asyncio.to_thread(writer.flush)
+        chat_state["last_id"] = max(chat_state["last_id"], writer.last_id)
+        chat_state["updated"] = datetime.now().isoformat()
+        if media:
+            # Records written so far may reference new objects; keep the index in step with them
+            await asyncio.to_thread(media.store.save)
+        save_state(state)
+
+    # Closing the writer on an error keeps everything fetched so far; the next run continues after it
+    writer = await asyncio.to_thread(BackupWriter, path, BACKUP_CODEC, {"chat_id": chat_id, "chat_name": chat_name})
+    try:
+        # Frames written after the last saved checkpoint survive a crash; don't fetch them again
+        chat_state["last_id"] = max(chat_state["last_id"], writer.last_id)
+        if source.supports_changes:
+            await backup_edits(source, chat, chat_state, writer)
+        if media and chat_state.get("media_pending"):
+            await retry_media(source, chat, chat_state, writer, media)
+
+        pages = 0
+        after_id = chat_state["last_id"]
+        while True:
+            page = await source.page(chat_id, after_id)
+            if not page:
+                break
+            if media:
+                await media.attach(chat_id, page, chat_state)
+            await asyncio.to_thread(writer.write_many, page)
+            total += len(page)
+            progress.fetched += len(page)
+            pages += 1
+            if pages % CHECKPOINT_PAGES == 0:
+                await checkpoint()
+            if len(page) < PAGE_SIZE:
+                break
+            after_id = page[-1]["id"]
+        await checkpoint()
+    finally:
+        await asyncio.to_thread(writer.close)
+    return total
+
+
+async def run(direct: bool, with_media: bool) -> int:
+    """Back up every chat, BACKUP_CONCURRENCY at a time; return the number of failed chats"""
+    limiter = FloodLimiter(BACKUP_RATE)
+    source = DirectSource(limiter) if direct else ApiSource(limiter)
+    await source.start()
     os.makedirs(BACKUP_DIR, exist_ok=True)
-    filename = f"{BACKUP_DIR}/{safe_name}_{chat_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    media = None
+    if with_media:
+        store = MediaStore(MEDIA_DIR)
+        store.clean_temp()
+        media = MediaFetcher(source, store)
+
+    try:
+        state = load_state()
+        chats = await source.chats()
+        progress = Progress(chats, state)
+        print(f"Found {len(chats)} chats to backup (~{progress.expected:,} new messages)")
+        print()
 
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(backup_data, f, indent=2, ensure_ascii=False)
+        semaphore = asyncio.Semaphore(BACKUP_CONCURRENCY)
+
+        async def backup_one(chat: Dict):
+            async with semaphore:
+                name = chat.get("name", chat.get("id"))
+                started = time.monotonic()
+                try:
+                    count = await backup_chat(source, chat, state, progress, media)
+                    progress.chat_finished(name, count, time.monotonic() - started)
+                except Exception as e:
+                    # Progress up to the last checkpoint is kept; the next run continues from there
+                    progress.chat_finished(name, 0, time.monotonic() - started, error=e)
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                progress.report()
+
+        reporter = asyncio.create_task(report_progress())
+        try:
+            await asyncio.gather(*(backup_one(chat) for chat in chats))
+        finally:
+            reporter.cancel()
 
-    print(f"  ✓ Backed up {len(messages)} messages to {filename}")
+        print()
+        progress.report()
+        if media:
+            pending = sum(len(chat_state.get("media_pending", [])) for chat_state in state["chats"].values())
+            print(f"📎 Media: {media.downloaded} files downloaded ({media.downloaded_bytes / 1024 / 1024:,.1f} MB), "
+                  f"{media.reused} already stored, {pending} left for the next run")
+        return progress.failed_chats
+    finally:
+        await source.close()
 
 
 def main():
     """Main backup function"""
+    direct = "--direct" in sys.argv[1:]
+    with_media = BACKUP_MEDIA or "--media" in sys.argv[1:]
+
     print("💾 Message Backup Started")
-    print(f"API URL: {API_URL}")
+    print(f"Source: {'Telethon (direct)' if direct else f'API {API_URL}'}")
     print(f"Backup Directory: {BACKUP_DIR}")
+    print(f"Concurrency: {BACKUP_CONCURRENCY} chats, {BACKUP_RATE:g} requests/s")
+    if with_media:
+        budget = f"{MEDIA_BUDGET / 1024 / 1024:g} MB budget" if MEDIA_BUDGET else "no budget"
+        print(f"Media: {MEDIA_DIR}, {MEDIA_CONCURRENCY} downloads at a time, "
+              f"up to {MEDIA_MAX_SIZE / 1024 / 1024:g} MB per file, {budget}")
     print("-" * 50)
 
-    chats = get_chats()
-    print(f"Found {len(chats)} chats to backup")
-    print()
-
-    for i, chat in enumerate(chats, 1):
-        print(f"[{i}/{len(chats)}] ", end="")
-        try:
-            backup_chat(chat)
-        except Exception as e:
-            print(f"  ✗ Error: {e}")
-        print()
+    try:
+        failed = asyncio.run(run(direct, with_media))
+    except KeyboardInterrupt:
+        print("\n\n👋 Backup interrupted; run again to resume")
+        return
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        return
 
-    print("✅ Backup Complete!")
+    if failed:
+        print(f"⚠️  Backup finished with {failed} failed chats; run again to resume them")
+    else:
+        print("✅ Backup Complete!")
 
 
 if __name__ == "__main__":
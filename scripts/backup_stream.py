@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Backup Stream
+Streaming, compressed NDJSON storage for message backups.
+
+A backup file is a sequence of independently compressed frames (zstd when the
+zstandard package is installed, gzip otherwise). Each frame holds one message
+record per line, so `zstdcat` / `zcat` on the file print every record. After
+the frames comes a footer that the same tools skip: an index frame listing the
+offset, length, message ID range and date range of every frame, then a small
+fixed-size locator frame pointing at the index. Readers load only the footer
+and the frames a lookup needs.
+
+Records are written straight into the compressor, so memory use is bounded by
+one frame's compression state however long the chat is. Opening an existing
+file for writing strips its footer and appends new frames after the old ones;
+a file whose footer is missing because a run was interrupted is repaired by
+scanning its frames and dropping a trailing partial one.
+
+Later records for a message ID supersede earlier ones (edits are appended as
+new versions; deletions as {"id": ..., "deleted": true}).
+
+Usage: python backup_stream.py <file> [message_id]
+"""
+
+import json
+import os
+import struct
+import sys
+import zlib
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_MAGIC = b"TGBKIDX1"
+ZSTD_FRAME_MAGIC = b"\x28\xb5\x2f\xfd"
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_LOCATOR_SIZE = 24
+GZIP_LOCATOR_SIZE = 42
+SCAN_CHUNK_SIZE = 1 << 20
+DEFAULT_CODEC = "zstd" if zstandard else "gzip"
+
+
+def _zstd_skippable(payload: bytes) -> bytes:
+    """A zstd skippable frame; decoders ignore its payload"""
+    return struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, len(payload)) + payload
+
+
+def _gzip_empty_member(extra: bytes = b"", comment: bytes = b"") -> bytes:
+    """A gzip member with no content, carrying data in its FEXTRA or FCOMMENT header field"""
+    flags = (0x04 if extra else 0) | (0x10 if comment else 0)
+    header = GZIP_MAGIC + bytes([8, flags]) + b"\x00\x00\x00\x00\x00\xff"
+    if extra:
+        header += struct.pack("<H", len(extra)) + extra
+    if comment:
+        header += comment + b"\x00"
+    return header + b"\x03\x00" + struct.pack("<II", 0, 0)  # Empty final deflate block, CRC32, size
+
+
+def _locator(codec: str, index_offset: int) -> bytes:
+    payload = INDEX_MAGIC + struct.pack("<Q", index_offset)
+    if codec == "zstd":
+        return _zstd_skippable(payload)
+    return _gzip_empty_member(extra=b"TB" + struct.pack("<H", len(payload)) + payload)
+
+
+def _index_frame(codec: str, index: Dict) -> bytes:
+    payload = json.dumps(index, separators=(",", ":")).encode("utf-8")
+    if codec == "zstd":
+        return _zstd_skippable(payload)
+    return _gzip_empty_member(comment=payload)
+
+
+def _detect_codec(head: bytes) -> str:
+    if head.startswith(ZSTD_FRAME_MAGIC) or head[:4] == struct.pack("<I", ZSTD_SKIPPABLE_MAGIC):
+        return "zstd"
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    raise ValueError("not a backup stream")
+
+
+def _decompressor(codec: str):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd backups (pip install zstandard)")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(wbits=31)
+
+
+def _read_footer(f, size: int) -> Optional[Dict]:
+    """Return the index of a finished file, or None when it has no valid footer"""
+    for codec, locator_size, start in (("zstd", ZSTD_LOCATOR_SIZE, 8), ("gzip", GZIP_LOCATOR_SIZE, 16)):
+        if size < locator_size:
+            continue
+        f.seek(size - locator_size)
+        locator = f.read(locator_size)
+        if locator[start:start + 8] != INDEX_MAGIC:
+            continue
+        index_offset = struct.unpack("<Q", locator[start + 8:start + 16])[0]
+        f.seek(index_offset)
+        frame = f.read(size - locator_size - index_offset)
+        try:
+            if codec == "zstd":
+                payload = frame[8:]
+            else:
+                payload = frame[10:frame.index(b"\x00", 10)]
+            index = json.loads(payload)
+        except ValueError:
+            return None
+        index["index_offset"] = index_offset
+        return index
+    return None
+
+
+def _scan_frames(f, codec: str) -> List[Dict]:
+    """Rebuild the frame index of a file without a footer, stopping at the first incomplete frame"""
+    frames = []
+    offset = 0
+    while True:
+        f.seek(offset)
+        if f.read(4) in (b"", struct.pack("<I", ZSTD_SKIPPABLE_MAGIC)):
+            break  # End of file, or a footer left by an interrupted rewrite
+        f.seek(offset)
+
+        decompressor = _decompressor(codec)
+        content = []
+        fed = 0
+        try:
+            while not decompressor.eof:
+                chunk = f.read(SCAN_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fed += len(chunk)
+                content.append(decompressor.decompress(chunk))
+        except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)):
+            break
+        if not decompressor.eof:
+            break
+
+        length = fed - len(decompressor.unused_data)
+        records = [json.loads(line) for line in b"".join(content).splitlines() if line.strip()]
+        if records:
+            frame = {"offset": offset, "length": length}
+            frame.update(_frame_summary(records))
+            frames.append(frame)
+        offset += length
+    return frames
+
+
+def _frame_summary(records: List[Dict]) -> Dict:
+    ids = [record["id"] for record in records]
+    dates = [record["date"] for record in records if record.get("date")]
+    return {
+        "count": len(records),
+        "min_id": min(ids),
+        "max_id": max(ids),
+        "min_date": min(dates) if dates else None,
+        "max_date": max(dates) if dates else None,
+    }
+
+
+class BackupWriter:
+    """Append message records to a backup stream, one compressed frame per flush"""
+
+    def __init__(self, path: str, codec: Optional[str] = None, metadata: Optional[Dict] = None):
+        self.path = path
+        self.frames: List[Dict] = []
+        self.metadata = metadata or {}
+        self.file = open(path, "a+b")
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+
+        if size:
+            self.file.seek(0)
+            self.codec = _detect_codec(self.file.read(4))
+            index = _read_footer(self.file, size)
+            if index is not None:
+                self.frames = index["frames"]
+                self.metadata = {**index.get("metadata", {}), **self.metadata}
+                end = index["index_offset"]
+            else:
+                self.frames = _scan_frames(self.file, self.codec)
+                end = self.frames[-1]["offset"] + self.frames[-1]["length"] if self.frames else 0
+            self.file.truncate(end)
+        else:
+            self.codec = codec or DEFAULT_CODEC
+        if self.codec == "zstd" and zstandard is None:
+            raise RuntimeError("zstandard is required to append to zstd backups (pip install zstandard)")
+
+        self.file.seek(0, os.SEEK_END)
+        self.compressor = None
+        self.frame_start = 0
+        self.frame_summary = None
+
+    @property
+    def last_id(self) -> int:
+        """Highest message ID in the file"""
+        return max((frame["max_id"] for frame in self.frames), default=0)
+
+    def _summarize(self, record: Dict):
+        summary = self.frame_summary
+        date = record.get("date")
+        if summary is None:
+            self.frame_summary = {"count": 1, "min_id": record["id"], "max_id": record["id"],
+                                  "min_date": date, "max_date": date}
+            return
+        summary["count"] += 1
+        summary["min_id"] = min(summary["min_id"], record["id"])
+        summary["max_id"] = max(summary["max_id"], record["id"])
+        if date:
+            summary["min_date"] = min(summary["min_date"] or date, date)
+            summary["max_date"] = max(summary["max_date"] or date, date)
+
+    def write(self, record: Dict):
+        """Append one record to the current frame"""
+        if self.compressor is None:
+            self.frame_start = self.file.tell()
+            if self.codec == "zstd":
+                self.compressor = zstandard.ZstdCompressor(level=10).compressobj()
+            else:
+                self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        self.file.write(self.compressor.compress(line.encode("utf-8")))
+        self._summarize(record)
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        """End the current frame and make it durable"""
+        if self.compressor is None:
+            return
+        self.file.write(self.compressor.flush())
+        self.compressor = None
+        frame = {"offset": self.frame_start, "length": self.file.tell() - self.frame_start}
+        frame.update(self.frame_summary)
+        self.frames.append(frame)
+        self.frame_summary = None
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """Flush and write the footer"""
+        self.flush()
+        index_offset = self.file.tell()
+        self.file.write(_index_frame(self.codec, {"version": 1, "metadata": self.metadata, "frames": self.frames}))
+        self.file.write(_locator(self.codec, index_offset))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class BackupReader:
+    """Random access to a backup stream through its index"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.codec = _detect_codec(f.read(4))
+            size = os.fstat(f.fileno()).st_size
+            index = _read_footer(f, size)
+            if index is None:
+                index = {"frames": _scan_frames(f, self.codec), "metadata": {}}
+        self.frames: List[Dict] = index["frames"]
+        self.metadata: Dict = index.get("metadata", {})
+
+    def read_frame(self, frame: Dict) -> List[Dict]:
+        """Decompress one frame into its records"""
+        with open(self.path, "rb") as f:
+            f.seek(frame["offset"])
+            data = f.read(frame["length"])
+        content = _decompressor(self.codec).decompress(data)
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    def __iter__(self) -> Iterator[Dict]:
+        """Every record in file order, including superseded versions"""
+        for frame in self.frames:
+            yield from self.read_frame(frame)
+
+    def get(self, message_id: int) -> Optional[Dict]:
+        """The latest version of a message, reading only frames whose ID range covers it"""
+        found = None
+        for frame in self.frames:
+            if frame["min_id"] <= message_id <= frame["max_id"]:
+                for record in self.read_frame(frame):
+                    if record["id"] == message_id:
+                        found = record
+        return None if found is None or found.get("deleted") else found
+
+    def between(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Dict]:
+        """Records dated within [start, end] (ISO 8601 strings), reading only overlapping frames"""
+        for frame in self.frames:
+            if frame["max_date"] is None:
+                continue
+            if (start and frame["max_date"] < start) or (end and frame["min_date"] > end):
+                continue
+            for record in self.read_frame(frame):
+                date = record.get("date")
+                if date and (not start or date >= start) and (not end or date <= end):
+                    yield record
+
+
+def main():
+    """Print a backup file's index summary, or one message"""
+    if len(sys.argv) < 2:
+        print("Usage: python backup_stream.py <file> [message_id]")
+        return
+
+    reader = BackupReader(sys.argv[1])
+    if len(sys.argv) > 2:
+        print(json.dumps(reader.get(int(sys.argv[2])), indent=2, ensure_ascii=False))
+        return
+
+    print(f"📦 {sys.argv[1]} ({reader.codec}, {len(reader.frames)} frames)")
+    for key, value in reader.metadata.items():
+        print(f"  {key}: {value}")
+    total = sum(frame["count"] for frame in reader.frames)
+    if reader.frames:
+        print(f"  records: {total}, IDs {min(f['min_id'] for f in reader.frames)}"
+              f"-{max(f['max_id'] for f in reader.frames)}")
+
+
+if __name__ == "__main__":
+    main()
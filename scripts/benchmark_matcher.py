@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Keyword Matcher Benchmark
+Compares the compiled KeywordMatcher against the original per-keyword loop of
+auto_responder.should_respond for growing rule sets.
+"""
+
+import random
+import sys
+import time
+
+from keyword_matcher import KeywordMatcher
+
+RULE_COUNTS = [5, 100, 1000, 5000]
+MESSAGES = 2000
+
+WORDS = ["hello", "meeting", "tomorrow", "thanks", "photo", "link", "ok", "see", "you", "later",
+         "project", "update", "release", "telegram", "message", "chat", "great", "sounds", "good", "this"]
+
+
+def legacy_should_respond(rules: dict, message_text: str) -> tuple[bool, str]:
+    """The original two-pass substring loop"""
+    if not message_text:
+        return False, ""
+
+    message_lower = message_text.lower().strip()
+    for keyword, response in rules.items():
+        if message_lower == keyword or message_lower.startswith(f"{keyword} "):
+            return True, response
+    for keyword, response in rules.items():
+        if keyword in message_lower:
+            return True, response
+    return False, ""
+
+
+def make_rules(count: int) -> dict:
+    """Build `count` keyword rules that rarely match, plus the default greetings"""
+    random.seed(count)
+    rules = {f"kw{i}{random.choice(WORDS)}": f"response {i}" for i in range(count - 2)}
+    rules.update({"hello": "Hello!", "hi": "Hi there!"})
+    return rules
+
+
+def make_messages() -> list:
+    random.seed(0)
+    return [" ".join(random.choice(WORDS) for _ in range(random.randint(3, 25))) for _ in range(MESSAGES)]
+
+
+def timed(func, messages) -> tuple:
+    """Return (messages per second, number of matches)"""
+    start = time.perf_counter()
+    hits = sum(1 for text in messages if func(text))
+    return len(messages) / (time.perf_counter() - start), hits
+
+
+def main():
+    """Run the benchmark"""
+    print("📊 Keyword Matcher Benchmark")
+    print(f"Python {sys.version.split()[0]}, {MESSAGES} messages per run")
+    print("-" * 70)
+
+    messages = make_messages()
+    for count in RULE_COUNTS:
+        rules = make_rules(count)
+
+        start = time.perf_counter()
+        matcher = KeywordMatcher.from_mapping(rules)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        legacy_rate, legacy_hits = timed(lambda text: legacy_should_respond(rules, text)[0], messages)
+        compiled_rate, compiled_hits = timed(lambda text: matcher.match(text) is not None, messages)
+
+        print(f"\n{count} rules (matcher built in {build_ms:.1f} ms)")
+        print(f"  legacy loop   {legacy_rate:>12,.0f} msg/s  {legacy_hits:>5} matches")
+        print(f"  compiled      {compiled_rate:>12,.0f} msg/s  {compiled_hits:>5} matches  ({compiled_rate / legacy_rate:.1f}x)")
+
+    print("\nThe legacy loop also matches substrings (\"hi\" inside \"this\"), so it reports more matches.")
+    print("\n✅ Benchmark Complete!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Serialization Benchmark
+Compares JSON encoders and content codings for message pages of 50/500/5000
+messages shaped like /api/messages/{chat_id} responses.
+"""
+
+import gzip
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PAGE_SIZES = [50, 500, 5000]
+ROUNDS = 20
+
+WORDS = ["hello", "meeting", "tomorrow", "thanks", "photo", "link", "ok", "see", "you", "later",
+         "project", "update", "release", "telegram", "message", "chat", "great", "sounds", "good", "👍"]
+
+
+def make_message(message_id: int, date: datetime) -> dict:
+    """Build a message dict shaped like the get_messages route output"""
+    text = " ".join(random.choice(WORDS) for _ in range(random.randint(2, 30)))
+    message = {
+        "id": message_id,
+        "text": text,
+        "date": date.isoformat(),
+        "sender_id": random.choice([111111111, 222222222, 333333333]),
+        "is_out": random.random() < 0.3,
+        "is_reply": False,
+        "reply_to_msg_id": None,
+        "has_media": False,
+        "has_link": False
+    }
+    if random.random() < 0.2:
+        message.update({
+            "has_media": True,
+            "media_type": "MessageMediaPhoto",
+            "media_category": "photo",
+            "media_message_id": message_id
+        })
+    return message
+
+
+def make_page(size: int) -> dict:
+    """Build a response page with `size` messages"""
+    random.seed(size)
+    now = datetime(2025, 1, 1, 12, 0, 0)
+    return {"messages": [make_message(100000 - i, now - timedelta(minutes=i)) for i in range(size)]}
+
+
+def encode_stdlib(content) -> bytes:
+    """Encode like starlette's JSONResponse"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def encode_orjson(content) -> bytes:
+    """Encode like FastJSONResponse"""
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+def timed(func, *args) -> tuple:
+    """Return (best time in ms over ROUNDS, result)"""
+    best = float("inf")
+    result = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def main():
+    """Run the benchmark"""
+    print("📊 Serialization Benchmark")
+    print(f"Python {sys.version.split()[0]}, best of {ROUNDS} rounds")
+    print(f"orjson: {'yes' if orjson else 'no'}, brotli: {'yes' if brotli else 'no'}, zstd: {'yes' if zstandard else 'no'}")
+    print("-" * 70)
+
+    encoders = [("json", encode_stdlib)]
+    if orjson:
+        encoders.append(("orjson", encode_orjson))
+
+    codings = [("gzip-6", lambda body: gzip.compress(body, compresslevel=6))]
+    if brotli:
+        codings.append(("br-4", lambda body: brotli.compress(body, quality=4)))
+    if zstandard:
+        codings.append(("zstd-3", lambda body: zstandard.ZstdCompressor(level=3).compress(body)))
+
+    for size in PAGE_SIZES:
+        page = make_page(size)
+        print(f"\n{size} messages")
+
+        body = None
+        for name, encoder in encoders:
+            ms, body = timed(encoder, page)
+            print(f"  encode {name:<8} {ms:8.2f} ms  {len(body):>10,} bytes")
+
+        for name, compress in codings:
+            ms, compressed = timed(compress, body)
+            ratio = len(compressed) / len(body) * 100
+            print(f"  {name:<15} {ms:8.2f} ms  {len(compressed):>10,} bytes ({ratio:.1f}%)")
+
+    print("\n✅ Benchmark Complete!")
+
+
+if __name__ == "__main__":
+    main()
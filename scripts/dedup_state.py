@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Dedup State
+Persistent record of which messages an automation script has already handled.
+
+Each chat has a high-water mark: every message ID at or below it counts as
+handled. Above it, the most recently handled (chat, message) pairs are kept in
+a bounded LRU. When a pair is evicted, its chat's mark is raised to that ID,
+so forgetting an entry never makes its message look new again. Membership
+checks are dict lookups and memory stays at max_recent entries however many
+messages go by (plus those set aside below).
+
+A script that handles messages out of order holds a message while it is
+queued or being retried. The mark must not pass a held ID, so an evicted
+entry above one is set aside, still counted as handled, until the hold is
+released by mark() or release(). Holds are saved too: after a restart the
+held messages come back through the replay, and the mark still can't pass
+them in the meantime.
+
+The state, together with the script's event stream cursor, is written
+atomically to a JSON file. Rewriting the whole file on every event would make
+each event cost O(max_recent) disk I/O, so save() writes at most once every
+save_interval seconds. autosave() flushes the last changes, and so does
+save(force=True) at shutdown. A restart resumes where the last save left off;
+after a crash that is at most save_interval seconds back.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+DEFAULT_MAX_RECENT = 5000
+DEFAULT_SAVE_INTERVAL = 1.0
+
+
+class DedupState:
+    """Per-chat high-water marks plus a bounded LRU of recently handled message IDs"""
+
+    def __init__(self, path: str, max_recent: int = DEFAULT_MAX_RECENT, save_interval: float = DEFAULT_SAVE_INTERVAL):
+        self.path = path
+        self.max_recent = max_recent
+        self.save_interval = save_interval
+        self._cursor: Optional[str] = None
+        self.high_water: Dict[str, int] = {}
+        self.recent: "OrderedDict[Tuple[str, int], None]" = OrderedDict()
+        self.held: Dict[str, Set[int]] = {}  # chat -> IDs still being handled
+        self.deferred: Dict[str, Set[int]] = {}  # chat -> evicted IDs the mark can't cover yet
+        self.dirty = False
+        self.last_saved = 0.0
+        self.load()
+
+    @property
+    def cursor(self) -> Optional[str]:
+        return self._cursor
+
+    @cursor.setter
+    def cursor(self, cursor: Optional[str]):
+        if cursor != self._cursor:
+            self._cursor = cursor
+            self.dirty = True
+
+    def load(self):
+        """Load the saved state; a missing or unreadable file starts empty"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        self._cursor = saved.get("cursor")
+        self.high_water = {str(chat): int(message_id) for chat, message_id in saved.get("high_water", {}).items()}
+        self.held = {str(chat): set(map(int, message_ids)) for chat, message_ids in saved.get("held", {}).items()}
+        self.deferred = {str(chat): set(map(int, message_ids)) for chat, message_ids in saved.get("deferred", {}).items()}
+        for chat, message_ids in saved.get("recent", {}).items():
+            for message_id in message_ids:
+                self.recent[(str(chat), int(message_id))] = None
+        # Older entries come first in the file; the limit may have been lowered since
+        while len(self.recent) > self.max_recent:
+            self._evict()
+
+    def save(self, force: bool = False):
+        """Atomically write the state if it changed, at most once per save_interval unless forced"""
+        if not self.dirty or (not force and time.monotonic() - self.last_saved < self.save_interval):
+            return
+        recent: Dict[str, list] = {}
+        for chat, message_id in self.recent:
+            recent.setdefault(chat, []).append(message_id)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "cursor": self._cursor, "high_water": self.high_water, "recent": recent,
+                "held": {chat: sorted(message_ids) for chat, message_ids in self.held.items()},
+                "deferred": {chat: sorted(message_ids) for chat, message_ids in self.deferred.items()},
+            }, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        self.last_saved = time.monotonic()
+
+    async def autosave(self):
+        """Write changes that save() held back; run as a task alongside the event loop"""
+        while True:
+            await asyncio.sleep(self.save_interval)
+            self.save()
+
+    def seen(self, chat_id, message_id: int) -> bool:
+        """Check whether a message was already handled"""
+        chat = str(chat_id)
+        return (message_id <= self.high_water.get(chat, 0) or (chat, message_id) in self.recent
+                or message_id in self.deferred.get(chat, ()))
+
+    def hold(self, chat_id, message_id: int):
+        """Keep the mark below a message that is queued or awaiting a retry, until mark() or release()"""
+        held = self.held.setdefault(str(chat_id), set())
+        if message_id not in held:
+            held.add(message_id)
+            self.dirty = True
+
+    def release(self, chat_id, message_id: int):
+        """Drop a hold without recording the message as handled"""
+        chat = str(chat_id)
+        held = self.held.get(chat)
+        if held is None or message_id not in held:
+            return
+        held.discard(message_id)
+        self.dirty = True
+        if not held:
+            del self.held[chat]
+        deferred = self.deferred.get(chat)
+        if deferred:
+            limit = min(held) if held else None
+            settled = {deferred_id for deferred_id in deferred if limit is None or deferred_id < limit}
+            if settled:
+                self.advance(chat, max(settled))
+                deferred -= settled
+                if not deferred:
+                    del self.deferred[chat]
+
+    def release_all(self, keep: Iterable[Tuple] = ()):
+        """Drop every hold except the (chat, message ID) pairs in keep, e.g. when no replay will follow"""
+        keep = {(str(chat), message_id) for chat, message_id in keep}
+        for chat, held in list(self.held.items()):
+            for message_id in list(held):
+                if (chat, message_id) not in keep:
+                    self.release(chat, message_id)
+
+    def mark(self, chat_id, message_id: int):
+        """Record a handled message, releasing its hold"""
+        chat = str(chat_id)
+        self.release(chat, message_id)
+        if message_id <= self.high_water.get(chat, 0):
+            return
+        key = (chat, message_id)
+        self.recent[key] = None
+        self.recent.move_to_end(key)
+        self.dirty = True
+        if len(self.recent) > self.max_recent:
+            self._evict()
+
+    def advance(self, chat_id, message_id: int):
+        """Record that every message up to message_id in a chat was handled"""
+        chat = str(chat_id)
+        if message_id > self.high_water.get(chat, 0):
+            self.high_water[chat] = message_id
+            self.dirty = True
+
+    def _evict(self):
+        (chat, message_id), _ = self.recent.popitem(last=False)
+        held = self.held.get(chat)
+        if held and min(held) < message_id:
+            self.deferred.setdefault(chat, set()).add(message_id)
+        else:
+            self.advance(chat, message_id)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Keyword Matcher
+Compiled multi-pattern matcher for auto-responder rules.
+
+Keyword rules are whole-word, case-insensitive phrases ("hi" matches "Hi there"
+but not "this"). All phrases are indexed once in a dict keyed by their word
+tuple; matching tokenizes the message a single time and looks up every n-gram
+up to the longest phrase, so the cost depends on the message length, not on
+the number of rules.
+
+Scripts written without spaces between words (Chinese, Japanese, Thai, ...)
+are tokenized one character per token, so their keywords match anywhere in the
+text, like a substring search.
+
+Regex rules are combined into one non-capturing alternation, compiled once.
+Capture groups around the alternatives would stop re from optimizing the
+alternation, so the combined search only finds the next position where some
+rule matches. At those positions only, each remaining rule is tried with an
+anchored match; then the scan moves on one character. A message that no regex
+rule matches costs one search over the text. Patterns that can't share one
+alternation are searched one by one: backreferences, conditional group
+references, named groups and inline flags.
+
+Each rule can carry a priority and a set of chat IDs it is limited to. When
+several rules match, the highest priority wins, then the earliest match in
+the message, then the rule defined first.
+"""
+
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Scripts without spaces between words: each character is a token
+UNSPACED_SCRIPTS = "\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+TOKEN_PATTERN = re.compile(rf"[{UNSPACED_SCRIPTS}]|[^\W{UNSPACED_SCRIPTS}]+|[^\w\s]", re.UNICODE)
+# Backreferences, conditional group references, named groups and inline flags don't survive being
+# merged into one alternation: the first two use group numbers that shift, the others must be unique
+UNCOMBINABLE_REGEX = re.compile(r"\\[1-9]|\(\?\(|\(\?P[<=]|\(\?<[^=!]|\(\?[aiLmsux]")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase words and standalone symbols (emoji, punctuation)"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class Rule:
+    """A response rule: keyword phrases and/or a regex, with a priority and optional chat scope"""
+
+    __slots__ = ("rule_id", "response", "keywords", "regex", "priority", "chats", "order")
+
+    def __init__(self, response: str, keywords: Iterable[str] = (), regex: Optional[str] = None,
+                 priority: int = 0, chats: Optional[Iterable] = None, rule_id: Optional[str] = None):
+        self.rule_id = rule_id
+        self.response = response
+        self.keywords = list(keywords)
+        self.regex = re.compile(regex, re.IGNORECASE) if regex else None
+        self.priority = priority
+        self.chats = {str(chat) for chat in chats} if chats else None
+        self.order = 0
+
+    def applies_to(self, chat_id) -> bool:
+        return self.chats is None or (chat_id is not None and str(chat_id) in self.chats)
+
+    def __repr__(self):
+        return f"Rule({self.rule_id or self.keywords or self.regex.pattern!r}, priority={self.priority})"
+
+
+class KeywordMatcher:
+    """Match messages against many rules with one pass over the message"""
+
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules = list(rules)
+        self.phrases: Dict[Tuple[str, ...], List[Rule]] = {}
+        self.first_words = set()  # Lets matching skip tokens that can't start any phrase
+        self.regex_rules: List[Rule] = []  # Searched one by one
+        self.combined_rules: List[Rule] = []
+        self.combined_regex = None
+        self.max_phrase_length = 0
+
+        for order, rule in enumerate(self.rules):
+            rule.order = order
+            for keyword in rule.keywords:
+                phrase = tuple(tokenize(keyword))
+                if not phrase:
+                    continue
+                self.phrases.setdefault(phrase, []).append(rule)
+                self.first_words.add(phrase[0])
+                self.max_phrase_length = max(self.max_phrase_length, len(phrase))
+            if rule.regex:
+                if UNCOMBINABLE_REGEX.search(rule.regex.pattern):
+                    self.regex_rules.append(rule)
+                else:
+                    self.combined_rules.append(rule)
+
+        if self.combined_rules:
+            try:
+                self.combined_regex = re.compile(
+                    "|".join(f"(?:{rule.regex.pattern})" for rule in self.combined_rules),
+                    re.IGNORECASE
+                )
+            except re.error:
+                self.regex_rules.extend(self.combined_rules)
+                self.combined_rules = []
+
+    @classmethod
+    def from_mapping(cls, mapping: Dict[str, str]) -> "KeywordMatcher":
+        """Build from a {keyword: response} dict, earlier keywords taking precedence"""
+        return cls(Rule(response, keywords=[keyword], rule_id=keyword) for keyword, response in mapping.items())
+
+    def matches(self, text: str, chat_id=None) -> List[Tuple[Rule, int]]:
+        """Return (rule, position) for every rule matching the text in this chat, best first"""
+        if not text:
+            return []
+
+        found: Dict[int, Tuple[Rule, int]] = {}
+        tokens = tokenize(text)
+        for start in range(len(tokens)):
+            if tokens[start] not in self.first_words:
+                continue
+            for length in range(1, min(self.max_phrase_length, len(tokens) - start) + 1):
+                for rule in self.phrases.get(tuple(tokens[start:start + length]), ()):
+                    if rule.order not in found and rule.applies_to(chat_id):
+                        found[rule.order] = (rule, start)
+
+        for rule in self.regex_rules:
+            if rule.order not in found and rule.applies_to(chat_id):
+                match = rule.regex.search(text)
+                if match:
+                    # Express the position in tokens so it ranks alongside keyword matches
+                    found[rule.order] = (rule, len(tokenize(text[:match.start()])))
+        if self.combined_regex is not None:
+            self._match_combined(text, chat_id, found)
+
+        return sorted(found.values(), key=lambda item: (-item[0].priority, item[1], item[0].order))
+
+    def _match_combined(self, text: str, chat_id, found: Dict[int, Tuple[Rule, int]]):
+        """Add the combined regex rules matching the text, each at its leftmost match"""
+        candidates = [rule for rule in self.combined_rules if rule.order not in found and rule.applies_to(chat_id)]
+        position = 0
+        while candidates and position <= len(text):
+            match = self.combined_regex.search(text, position)
+            if match is None:
+                break
+            start = match.start()
+            remaining = []
+            for rule in candidates:
+                if rule.regex.match(text, start):
+                    found[rule.order] = (rule, len(tokenize(text[:start])))
+                else:
+                    remaining.append(rule)
+            candidates = remaining
+            position = start + 1
+
+    def match(self, text: str, chat_id=None) -> Optional[Rule]:
+        """Return the best matching rule, or None"""
+        matches = self.matches(text, chat_id)
+        return matches[0][0] if matches else None
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Media Store
+Content-addressed storage for downloaded media files.
+
+Every file is stored once, under the SHA-256 of its content:
+objects/ab/abcdef... for a hash starting with "ab". A file that appears in
+several chats, or is downloaded again by a later run, ends up as the same
+object. Downloads are written to tmp/ while being hashed and are renamed into
+place only when complete, so an interrupted download never leaves a partial
+object behind.
+
+Telegram gives each photo and document a stable ID, the same in every chat it
+is forwarded to. media_index.json maps these IDs to hashes, so a file that is
+already stored is recognized without downloading it again. The index is only
+a shortcut: an entry whose object is missing is ignored.
+
+Usage: python media_store.py <store_dir>   # Check every object against its hash
+"""
+
+import hashlib
+import json
+import os
+import sys
+import uuid
+from typing import Dict, Optional
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class HashingFile:
+    """A temporary file that hashes everything written to it"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def reset(self):
+        """Discard what was written, e.g. before retrying a download"""
+        self.file.seek(0)
+        self.file.truncate()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class MediaStore:
+    """Files stored once by content hash, plus an index from Telegram media IDs to hashes"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.index_path = os.path.join(root, "media_index.json")
+        self.index: Dict[str, Dict] = {}
+        self.dirty = False
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+        self.load()
+
+    def load(self):
+        """Load the media ID index; a missing or unreadable file starts empty"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def save(self):
+        """Atomically write the media ID index if it changed"""
+        if not self.dirty:
+            return
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.root, "objects", sha256[:2], sha256)
+
+    def lookup(self, media_id: str) -> Optional[Dict]:
+        """The stored object ({"sha256", "size"}) for a media ID, if it is still present"""
+        entry = self.index.get(media_id)
+        if entry and os.path.exists(self.object_path(entry["sha256"])):
+            return entry
+        return None
+
+    def open_temp(self) -> HashingFile:
+        """A file to download into; pass it to add() when complete"""
+        return HashingFile(os.path.join(self.root, "tmp", f"{uuid.uuid4().hex}.part"))
+
+    def add(self, download: HashingFile, media_id: Optional[str] = None) -> Dict:
+        """Move a completed download into the store, or drop it if its content is already stored"""
+        download.close()
+        entry = {"sha256": download.sha256.hexdigest(), "size": download.size}
+        path = self.object_path(entry["sha256"])
+        if os.path.exists(path):
+            os.remove(download.path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(download.path, path)
+        if media_id:
+            self.index[media_id] = entry
+            self.dirty = True
+        return entry
+
+    def clean_temp(self):
+        """Remove downloads left behind by an interrupted run"""
+        tmp_dir = os.path.join(self.root, "tmp")
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+
+    def verify(self) -> int:
+        """Check every object against its hash; return the number of corrupt ones"""
+        corrupt = 0
+        objects_dir = os.path.join(self.root, "objects")
+        for prefix in sorted(os.listdir(objects_dir)):
+            for name in sorted(os.listdir(os.path.join(objects_dir, prefix))):
+                sha256 = hashlib.sha256()
+                with open(os.path.join(objects_dir, prefix, name), "rb") as f:
+                    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                        sha256.update(chunk)
+                if sha256.hexdigest() != name:
+                    corrupt += 1
+                    print(f"✗ {prefix}/{name} is corrupt")
+        return corrupt
+
+
+def main():
+    """Verify a media store"""
+    if len(sys.argv) < 2:
+        print("Usage: python media_store.py <store_dir>")
+        return
+
+    store = MediaStore(sys.argv[1])
+    corrupt = store.verify()
+    print(f"📦 {sys.argv[1]}: {len(store.index)} indexed media IDs, {corrupt} corrupt objects")
+
+
+if __name__ == "__main__":
+    main()
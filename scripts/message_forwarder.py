@@ -2,21 +2,58 @@
 """
 Message Forwarder Script
 Automatically forwards messages from one chat to another based on rules.
+Runs the forward actions of the rules in RULES_FILE (see rule_engine.py);
+without a rules file, FORWARDING_RULES and the FILTER_* lists below are used.
+
+Listens to the /ws event stream instead of polling the source chats. Messages
+from a source chat that arrive within FORWARD_BATCH_WINDOW seconds are sent to
+each target with a single forward call, so albums (messages sharing a
+grouped_id) stay together; a batch is held open while its album is still
+arriving. Targets are forwarded to concurrently, and a 429 from the API pauses
+every target for the Retry-After time Telegram asked for.
+
+The stream cursor and the forwarded messages (see dedup_state.py) are saved
+in STATE_FILE. The saved cursor never moves past a batch that hasn't been sent
+yet, and replayed messages already forwarded are skipped, so a restart neither
+loses nor repeats forwards.
+
+A message whose forward to a target failed stays unmarked and keeps the saved
+cursor before it. Queued and failed messages are held in the dedup state, so
+evicting newer forwarded messages can't raise the chat's mark past them. RETRY_FAILED_AFTER seconds later the forwarder reconnects,
+and the replay forwards it again, to the failed targets only. After
+MAX_FORWARD_ATTEMPTS tries it gives up on the message.
 """
 
-import requests
-import time
+import asyncio
 import json
 import os
+import time
 from typing import Dict, List, Optional
+
+import requests
+import websockets
 from dotenv import load_dotenv
 
+from dedup_state import DedupState
+from rule_engine import RuleEngine, legacy_rules
+
 load_dotenv()
 
 API_URL = os.getenv("API_URL", "http://localhost:8001")
+WS_URL = os.getenv("WS_URL", API_URL.replace("http", "ws", 1) + "/ws")
 API_KEY = os.getenv("API_KEY", None)
-
-# Forwarding rules: source_chat_id -> [target_chat_ids]
+RULES_FILE = os.getenv("RULES_FILE", "rules.json")
+STATE_FILE = os.getenv("FORWARDER_STATE_FILE", "message_forwarder_state.json")
+BATCH_WINDOW = float(os.getenv("FORWARD_BATCH_WINDOW", "1.0"))  # Seconds to collect messages per source
+MAX_BATCH_DELAY = 10.0  # Upper bound on holding a batch open for a still-arriving album
+MAX_FORWARD_IDS = 100  # Telegram's limit per forward call
+TARGET_CONCURRENCY = int(os.getenv("FORWARD_CONCURRENCY", "4"))
+MAX_RETRIES = 3
+MAX_RECONNECT_DELAY = 60
+RETRY_FAILED_AFTER = 60  # Seconds before reconnecting to replay messages whose forward failed
+MAX_FORWARD_ATTEMPTS = 3
+
+# Forwarding rules used when there is no rules file: source_chat_id -> [target_chat_ids]
 FORWARDING_RULES = {
     # Example: Forward messages from chat "123456" to chats "789012" and "345678"
     # "123456": ["789012", "345678"],
@@ -26,8 +63,48 @@ FORWARDING_RULES = {
 FILTER_KEYWORDS = []  # Only forward if message contains these keywords (empty = forward all)
 FILTER_SENDERS = []   # Only forward from these sender IDs (empty = forward from all)
 
-# Track processed messages
-processed_messages = set()
+# The auto-responder runs the reply, tag and webhook actions of the same rules
+rule_engine = RuleEngine(RULES_FILE, fallback=legacy_rules(
+    forwarding_rules=FORWARDING_RULES, filter_keywords=FILTER_KEYWORDS, filter_senders=FILTER_SENDERS
+))
+
+
+class Batch:
+    """Messages from one source chat waiting to be forwarded, grouped by target"""
+
+    def __init__(self, source_chat_id: str, resume_cursor: Optional[str]):
+        self.source_chat_id = source_chat_id
+        self.resume_cursor = resume_cursor  # Stream position to resume from if the batch is never sent
+        self.targets: Dict[str, List[int]] = {}
+        self.opened_at = time.monotonic()
+        self.last_added_at = self.opened_at
+        self.last_grouped_id = None
+
+    def add(self, message_id: int, grouped_id, targets: List[str]):
+        for target_chat_id in targets:
+            ids = self.targets.setdefault(str(target_chat_id), [])
+            if message_id not in ids:
+                ids.append(message_id)
+        self.last_added_at = time.monotonic()
+        self.last_grouped_id = grouped_id
+
+    def message_ids(self) -> set:
+        return {message_id for ids in self.targets.values() for message_id in ids}
+
+
+# Forwarding state
+dedup = DedupState(STATE_FILE)
+state = {"cursor": None}  # Latest stream position seen
+pending_batches: Dict[str, Batch] = {}
+sending_batches = set()
+queued_messages = set()  # (source, message ID) in pending or sending batches; marked in dedup once sent
+# (source, message ID) -> resume cursor, targets still to forward to, attempts; unmarked until forwarded
+failed_messages: Dict[tuple, dict] = {}
+failure_state = {"since": None}  # Monotonic time of the oldest failure not yet retried
+flush_tasks = set()
+flood_state = {"until": 0.0}  # Monotonic time until which no forward call is made
+reconnect_state = {"delay": 1}  # Seconds to wait before the next reconnect; reset once events are handled
+target_semaphore = asyncio.Semaphore(TARGET_CONCURRENCY)
 
 
 def get_headers():
@@ -38,24 +115,19 @@ def get_headers():
     return headers
 
 
-def get_messages(chat_id: str, limit: int = 10):
-    """Get recent messages from a chat"""
-    try:
-        response = requests.get(
-            f"{API_URL}/api/messages/{chat_id}?limit={limit}",
-            headers=get_headers(),
-            timeout=10
-        )
-        if response.status_code == 200:
-            return response.json().get("messages", [])
-        return []
-    except Exception as e:
-        print(f"Error getting messages: {e}")
-        return []
+def save_state():
+    """Save the cursor of the oldest unsent batch (or the latest event) with the forwarded messages"""
+    cursor = state["cursor"]
+    if pending_batches or sending_batches or failed_messages:
+        unsent = [batch.resume_cursor for batch in [*pending_batches.values(), *sending_batches]]
+        unsent += [failure["cursor"] for failure in failed_messages.values()]
+        cursor = None if None in unsent else min(unsent, key=lambda c: int(c.rsplit(":", 1)[1]))
+    dedup.cursor = cursor
+    dedup.save()
 
 
 def forward_message(from_chat_id: str, to_chat_id: str, message_ids: List[int]):
-    """Forward messages from one chat to another"""
+    """Forward messages from one chat to another; return (success, seconds to wait before retrying)"""
     try:
         response = requests.post(
             f"{API_URL}/api/messages/forward",
@@ -65,98 +137,204 @@ def forward_message(from_chat_id: str, to_chat_id: str, message_ids: List[int]):
                 "to_chat_id": to_chat_id,
                 "message_ids": message_ids
             },
-            timeout=10
+            timeout=30
         )
-        return response.status_code == 200
+        if response.status_code == 429:
+            return False, int(response.headers.get("Retry-After", "5"))
+        return response.status_code == 200, None
     except Exception as e:
         print(f"Error forwarding message: {e}")
-        return False
-
-
-def should_forward(message: Dict) -> bool:
-    """Check if message should be forwarded based on filters"""
-    # Check sender filter
-    if FILTER_SENDERS:
-        sender_id = message.get("sender_id")
-        if sender_id and str(sender_id) not in FILTER_SENDERS:
-            return False
-
-    # Check keyword filter
-    if FILTER_KEYWORDS:
-        message_text = message.get("text", "").lower()
-        if not any(keyword.lower() in message_text for keyword in FILTER_KEYWORDS):
-            return False
-
-    return True
-
-
-def process_forwarding_rules():
-    """Process all forwarding rules"""
-    for source_chat_id, target_chat_ids in FORWARDING_RULES.items():
-        if not target_chat_ids:
-            continue
+        return False, None
+
+
+async def forward_to_target(source_chat_id: str, target_chat_id: str, message_ids: List[int]) -> List[int]:
+    """Forward a batch to one target in chunks, waiting out flood waits; return the IDs that failed"""
+    failed = []
+    async with target_semaphore:
+        for start in range(0, len(message_ids), MAX_FORWARD_IDS):
+            chunk = message_ids[start:start + MAX_FORWARD_IDS]
+            for attempt in range(MAX_RETRIES):
+                pause = flood_state["until"] - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+
+                ok, retry_after = await asyncio.to_thread(forward_message, source_chat_id, target_chat_id, chunk)
+                if ok:
+                    print(f"✓ Forwarded {len(chunk)} message(s) from {source_chat_id} to {target_chat_id}")
+                    break
+                if retry_after is None:
+                    print(f"✗ Failed to forward {chunk} from {source_chat_id} to {target_chat_id}")
+                    failed.extend(chunk)
+                    break
+                # FloodWait applies to the whole account, so hold back every target
+                print(f"⏳ Flood wait: pausing forwards for {retry_after}s")
+                flood_state["until"] = max(flood_state["until"], time.monotonic() + retry_after)
+            else:
+                print(f"✗ Giving up on {chunk} from {source_chat_id} to {target_chat_id} after {MAX_RETRIES} flood waits")
+                failed.extend(chunk)
+    return failed
+
+
+async def flush_batch(source_chat_id: str):
+    """Wait for the batch window to close, then forward the batch to all its targets"""
+    batch = pending_batches[source_chat_id]
+    while True:
+        now = time.monotonic()
+        deadline = batch.opened_at + BATCH_WINDOW
+        if batch.last_grouped_id is not None:
+            # An album may still be arriving; keep the batch open while its parts keep coming
+            deadline = min(max(deadline, batch.last_added_at + BATCH_WINDOW), batch.opened_at + MAX_BATCH_DELAY)
+        if now >= deadline:
+            break
+        await asyncio.sleep(deadline - now)
 
-        messages = get_messages(source_chat_id, limit=10)
+    # New messages from this source start a new batch from here on
+    del pending_batches[source_chat_id]
+    sending_batches.add(batch)
+    try:
+        results = await asyncio.gather(*(
+            forward_to_target(source_chat_id, target_chat_id, sorted(ids))
+            for target_chat_id, ids in batch.targets.items()
+        ))
+    finally:
+        sending_batches.discard(batch)
+
+    failed_targets: Dict[int, set] = {}
+    for target_chat_id, failed_ids in zip(batch.targets, results):
+        for message_id in failed_ids:
+            failed_targets.setdefault(message_id, set()).add(target_chat_id)
+
+    for message_id in batch.message_ids():
+        key = (source_chat_id, message_id)
+        queued_messages.discard(key)
+        attempts = failed_messages.pop(key, {}).get("attempts", 0) + 1
+        if message_id not in failed_targets:
+            dedup.mark(source_chat_id, message_id)
+        elif attempts >= MAX_FORWARD_ATTEMPTS:
+            print(f"✗ Giving up on message {message_id} from {source_chat_id} after {attempts} attempts")
+            dedup.mark(source_chat_id, message_id)
+        else:
+            # Keep the saved cursor before it so the replay retries the failed targets
+            failed_messages[key] = {"cursor": batch.resume_cursor, "targets": failed_targets[message_id],
+                                    "attempts": attempts}
+            failure_state["since"] = failure_state["since"] or time.monotonic()
+    save_state()
+
+
+def handle_new_message(event: dict, resume_cursor: Optional[str]):
+    """Add a new message to its source chat's batch if a rule forwards it"""
+    source_chat_id = event.get("chat_id")
+    msg = event.get("message", {})
+    msg_id = msg.get("id")
+    if not msg_id or dedup.seen(source_chat_id, msg_id) or (source_chat_id, msg_id) in queued_messages:
+        return
 
-        for msg in messages:
-            msg_id = msg.get("id")
-            msg_key = f"{source_chat_id}_{msg_id}"
+    targets = [
+        target_chat_id
+        for rule, action in rule_engine.actions_for(source_chat_id, msg, ["forward"])
+        for target_chat_id in action["to"]
+    ]
+    failure = failed_messages.get((source_chat_id, msg_id))
+    if failure:
+        # A retry: the other targets already have it
+        targets = [target_chat_id for target_chat_id in targets if str(target_chat_id) in failure["targets"]]
+    if not targets:
+        # Held before a restart, maybe, but the rules no longer forward it
+        dedup.release(source_chat_id, msg_id)
+        return
 
-            # Skip if already processed
-            if msg_key in processed_messages:
+    batch = pending_batches.get(source_chat_id)
+    if batch is None:
+        batch = pending_batches[source_chat_id] = Batch(source_chat_id, resume_cursor)
+        task = asyncio.create_task(flush_batch(source_chat_id))
+        flush_tasks.add(task)
+        task.add_done_callback(flush_tasks.discard)
+    batch.add(msg_id, msg.get("grouped_id"), targets)
+    queued_messages.add((source_chat_id, msg_id))
+    # Batches finish out of order; don't let newer messages push the dedup mark past this one
+    dedup.hold(source_chat_id, msg_id)
+
+
+async def consume_events():
+    """Connect to the event stream, resuming after the saved cursor, and handle events until disconnected"""
+    cursor = state["cursor"] = dedup.cursor
+    failure_state["since"] = None
+    url = f"{WS_URL}?since={cursor}" if cursor else WS_URL
+    async with websockets.connect(url) as ws:
+        print(f"✓ Connected to {WS_URL}" + (f" (resuming after {cursor})" if cursor else ""))
+        async for raw in ws:
+            if failure_state["since"] and time.monotonic() - failure_state["since"] >= RETRY_FAILED_AFTER:
+                print(f"↻ Reconnecting to retry {len(failed_messages)} failed forwards")
+                return
+            event = json.loads(raw)
+            event_type = event.get("type")
+
+            if event_type == "connected":
+                if state["cursor"] is None:
+                    state["cursor"] = event["cursor"]
+                    save_state()
                 continue
-
-            # Skip outgoing messages
-            if msg.get("is_out"):
-                processed_messages.add(msg_key)
+            if event_type == "resync_required":
+                # Events were dropped from the server's replay buffer; continue from now
+                print(f"⚠️  Missed events ({event.get('reason')}), continuing from the current position")
+                if failed_messages:
+                    print(f"⚠️  {len(failed_messages)} failed forwards can no longer be replayed")
+                    failed_messages.clear()
+                # Failed messages, and those held before a restart, won't come back through a replay
+                dedup.release_all(keep=queued_messages)
+                state["cursor"] = event["cursor"]
+                save_state()
                 continue
+            if "cursor" not in event:
+                continue  # ping / echo
+
+            if event_type == "new_message":
+                handle_new_message(event, state["cursor"])
+            state["cursor"] = event["cursor"]
+            save_state()
+            # Events are flowing again; the next disconnect starts the backoff over
+            reconnect_state["delay"] = 1
 
-            # Check if should forward
-            if not should_forward(msg):
-                processed_messages.add(msg_key)
-                continue
 
-            # Forward to all target chats
-            for target_chat_id in target_chat_ids:
-                print(f"Forwarding message {msg_id} from {source_chat_id} to {target_chat_id}")
-                if forward_message(source_chat_id, target_chat_id, [msg_id]):
-                    print(f"✓ Forwarded successfully")
-                else:
-                    print(f"✗ Failed to forward")
+async def run():
+    """Consume the event stream forever, reconnecting with backoff"""
+    autosave = asyncio.create_task(dedup.autosave())
+    try:
+        while True:
+            try:
+                await consume_events()
+                reconnect_state["delay"] = 1
+            except (OSError, websockets.WebSocketException) as e:
+                print(f"Connection lost: {e}; reconnecting in {reconnect_state['delay']}s")
+            await asyncio.sleep(reconnect_state["delay"])
+            reconnect_state["delay"] = min(reconnect_state["delay"] * 2, MAX_RECONNECT_DELAY)
+    finally:
+        autosave.cancel()
+        dedup.save(force=True)
+
 
-            processed_messages.add(msg_key)
+def has_forward_rules() -> bool:
+    """Check whether any rule has a forward action"""
+    return any(action["type"] == "forward" for rule in rule_engine.ruleset.rules for action in rule.actions)
 
 
 def main():
     """Main loop"""
     print("📨 Message Forwarder Started")
-    print(f"API URL: {API_URL}")
-    print(f"Forwarding Rules: {len(FORWARDING_RULES)}")
-    print(f"Filter Keywords: {FILTER_KEYWORDS or 'None (forward all)'}")
-    print(f"Filter Senders: {FILTER_SENDERS or 'None (forward from all)'}")
+    print(f"Event stream: {WS_URL}")
+    print(f"Rules: {len(rule_engine.ruleset.rules)} from {rule_engine.ruleset.source}")
+    print(f"Batch window: {BATCH_WINDOW}s, {TARGET_CONCURRENCY} concurrent targets")
     print("-" * 50)
 
-    if not FORWARDING_RULES:
+    if not has_forward_rules():
         print("⚠️  No forwarding rules configured!")
-        print("Edit FORWARDING_RULES in this script to add rules.")
+        print(f"Add rules with a forward action to {RULES_FILE}, or edit FORWARDING_RULES in this script.")
         return
 
-    while True:
-        try:
-            process_forwarding_rules()
-
-            # Clean up old processed messages
-            if len(processed_messages) > 1000:
-                processed_messages.clear()
-
-            time.sleep(5)  # Check every 5 seconds
-
-        except KeyboardInterrupt:
-            print("\n\n👋 Message Forwarder Stopped")
-            break
-        except Exception as e:
-            print(f"Error in main loop: {e}")
-            time.sleep(5)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("\n\n👋 Message Forwarder Stopped")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Rule Engine
+Declarative message rules shared by auto_responder.py and message_forwarder.py.
+
+Rules live in a JSON file (see rules.example.json):
+
+    {"rules": [
+        {"id": "greeting", "priority": 10, "stop": true,
+         "when": {"chats": ["123456"], "keywords": ["hello", "hi"]},
+         "actions": [{"type": "reply", "text": "Hi there!"}]}
+    ]}
+
+Conditions (all optional, all must hold):
+    chats     chat IDs the rule is limited to
+    senders   sender IDs the rule is limited to; null in the list also admits
+              messages without a sender (channel posts, anonymous admins)
+    keywords  whole-word phrases, any of which must appear in the text
+    regex     case-insensitive pattern searched in the text; a rule with both
+              keywords and regex needs a keyword and a regex match
+    media     true / false for has_media, or a list of media categories ("photo", "video", ...)
+    incoming  true (default) for incoming messages only, false for outgoing only, null for both
+
+Actions: reply (text), forward (to: [chat IDs]), tag (tags: [...]), webhook (url).
+
+Rules are compiled into hash indexes on chat and sender ID, so a message is
+only checked against the rules that can apply to its chat and sender; text
+conditions of those rules are matched with one KeywordMatcher pass. Matching
+rules run from the highest priority down, then in file order; a rule with
+"stop": true ends evaluation once it matches.
+
+The file is re-read when its modification time changes. A new rule set is
+compiled completely before it replaces the old one in a single assignment,
+so a message is always evaluated against one whole rule set, and a file that
+fails to parse leaves the previous rules in place.
+"""
+
+import json
+import os
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from keyword_matcher import KeywordMatcher, Rule as KeywordRule
+
+ACTION_TYPES = {
+    "reply": ("text",),
+    "forward": ("to",),
+    "tag": ("tags",),
+    "webhook": ("url",),
+}
+CONDITION_KEYS = {"chats", "senders", "keywords", "regex", "media", "incoming"}
+NO_SENDER = ""  # Index key for messages without a sender; never a real sender ID
+RELOAD_CHECK_INTERVAL = 1.0  # Seconds between modification time checks
+
+
+class MessageRule:
+    """A compiled rule: conditions on a message and the actions to run when it matches"""
+
+    __slots__ = ("rule_id", "priority", "stop", "chats", "senders", "keywords", "regex", "media", "incoming",
+                 "actions", "order")
+
+    def __init__(self, spec: Dict, order: int):
+        unknown = set(spec) - {"id", "priority", "stop", "when", "actions"}
+        if unknown:
+            raise ValueError(f"unknown rule fields {sorted(unknown)}")
+        when = spec.get("when") or {}
+        unknown = set(when) - CONDITION_KEYS
+        if unknown:
+            raise ValueError(f"unknown conditions {sorted(unknown)}")
+
+        self.order = order
+        self.rule_id = str(spec.get("id") or f"rule-{order + 1}")
+        self.priority = int(spec.get("priority", 0))
+        self.stop = bool(spec.get("stop", False))
+        self.chats = {str(chat) for chat in when["chats"]} if when.get("chats") else None
+        self.senders = ({NO_SENDER if sender is None else str(sender) for sender in when["senders"]}
+                        if when.get("senders") else None)
+        self.keywords = list(when.get("keywords") or [])
+        self.regex = when.get("regex")
+        if self.regex:
+            re.compile(self.regex)
+        self.media = when.get("media")
+        if isinstance(self.media, list):
+            self.media = set(self.media)
+        self.incoming = when.get("incoming", True)
+
+        self.actions = []
+        for action in spec.get("actions") or []:
+            fields = ACTION_TYPES.get(action.get("type"))
+            if fields is None:
+                raise ValueError(f"unknown action type {action.get('type')!r}")
+            missing = [field for field in fields if not action.get(field)]
+            if missing:
+                raise ValueError(f"{action['type']} action is missing {', '.join(missing)}")
+            self.actions.append(action)
+        if not self.actions:
+            raise ValueError("rule has no actions")
+
+    @property
+    def has_text_condition(self) -> bool:
+        return bool(self.keywords or self.regex)
+
+    def matches_text(self, text_matches: set) -> bool:
+        """Check the text conditions against the (order, condition) IDs the matcher found"""
+        return ((not self.keywords or (self.order, "keywords") in text_matches)
+                and (not self.regex or (self.order, "regex") in text_matches))
+
+    def matches_message(self, message: Dict) -> bool:
+        """Check the conditions that don't need the text"""
+        if self.incoming is not None and bool(message.get("is_out")) == bool(self.incoming):
+            return False
+        if self.media is None:
+            return True
+        if isinstance(self.media, set):
+            return message.get("media_category") in self.media
+        return bool(message.get("has_media")) == bool(self.media)
+
+    def __repr__(self):
+        return f"MessageRule({self.rule_id!r}, priority={self.priority})"
+
+
+class RuleSet:
+    """An immutable, indexed set of rules"""
+
+    def __init__(self, specs: Iterable[Dict], source: str = "built-in"):
+        self.source = source
+        self.rules: List[MessageRule] = []
+        for order, spec in enumerate(specs):
+            try:
+                self.rules.append(MessageRule(spec, order))
+            except (TypeError, ValueError, re.error) as e:
+                raise ValueError(f"rule {spec.get('id') or order + 1}: {e}") from None
+
+        # chat ID -> rules limited to it; None -> rules for every chat. Same for senders.
+        self.by_chat: Dict[Optional[str], List[MessageRule]] = {}
+        self.by_sender: Dict[Optional[str], set] = {}
+        for rule in self.rules:
+            for chat in rule.chats or (None,):
+                self.by_chat.setdefault(chat, []).append(rule)
+            for sender in rule.senders or (None,):
+                self.by_sender.setdefault(sender, set()).add(rule.order)
+
+        # Text conditions of all rules in one matcher. Keywords and regex are separate matcher
+        # rules, IDs (rule order, condition), because the matcher accepts either one.
+        text_rules = []
+        for rule in self.rules:
+            if rule.keywords:
+                text_rules.append(KeywordRule(None, keywords=rule.keywords, rule_id=(rule.order, "keywords")))
+            if rule.regex:
+                text_rules.append(KeywordRule(None, regex=rule.regex, rule_id=(rule.order, "regex")))
+        self.text_matcher = KeywordMatcher(text_rules)
+
+    def evaluate(self, chat_id, message: Dict) -> List[MessageRule]:
+        """Return the rules matching a message, in execution order"""
+        chat_rules = self.by_chat.get(str(chat_id), []) + self.by_chat.get(None, [])
+        if not chat_rules:
+            return []
+
+        sender_id = message.get("sender_id")
+        senders = self.by_sender.get(None, set()) | self.by_sender.get(
+            NO_SENDER if sender_id is None else str(sender_id), set())
+
+        candidates = [rule for rule in chat_rules if rule.order in senders and rule.matches_message(message)]
+        if any(rule.has_text_condition for rule in candidates):
+            text_matches = {keyword_rule.rule_id for keyword_rule, _ in self.text_matcher.matches(message.get("text") or "")}
+            candidates = [rule for rule in candidates if rule.matches_text(text_matches)]
+
+        matched = []
+        for rule in sorted(candidates, key=lambda rule: (-rule.priority, rule.order)):
+            matched.append(rule)
+            if rule.stop:
+                break
+        return matched
+
+
+class RuleEngine:
+    """Rules loaded from a JSON file and reloaded when it changes, with built-in fallback rules"""
+
+    def __init__(self, path: str, fallback: Optional[List[Dict]] = None):
+        self.path = path
+        self.fallback = fallback or []
+        self.file_stamp: Optional[Tuple[int, int]] = None
+        self.next_check = 0.0
+        self.ruleset = RuleSet(self.fallback)
+        self.refresh(force=True)
+        if self.file_stamp is None:
+            print(f"ℹ️  No rules file at {path}; using {len(self.ruleset.rules)} built-in rules")
+
+    def refresh(self, force: bool = False) -> bool:
+        """Reload the rules file if it changed; return True when new rules were installed"""
+        now = time.monotonic()
+        if not force and now < self.next_check:
+            return False
+        self.next_check = now + RELOAD_CHECK_INTERVAL
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False  # Keep whatever is loaded; the file may be mid-replace
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.file_stamp:
+            return False
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            ruleset = RuleSet(data.get("rules", []) if isinstance(data, dict) else data, source=self.path)
+        except (OSError, ValueError, AttributeError) as e:
+            if self.file_stamp is None and force:
+                raise ValueError(f"invalid rules file {self.path}: {e}") from None
+            print(f"⚠️  Not reloading {self.path}: {e}")
+            self.file_stamp = stamp  # Don't retry until the file changes again
+            return False
+
+        self.ruleset = ruleset
+        self.file_stamp = stamp
+        print(f"✓ Loaded {len(ruleset.rules)} rules from {self.path}")
+        return True
+
+    def evaluate(self, chat_id, message: Dict) -> List[MessageRule]:
+        """Return the rules matching a message, picking up file changes first"""
+        self.refresh()
+        return self.ruleset.evaluate(chat_id, message)
+
+    def actions_for(self, chat_id, message: Dict, action_types: Iterable[str]) -> List[Tuple[MessageRule, Dict]]:
+        """Return (rule, action) for the matching actions of the given types, in execution order"""
+        wanted = set(action_types)
+        return [(rule, action) for rule in self.evaluate(chat_id, message)
+                for action in rule.actions if action["type"] in wanted]
+
+
+def legacy_rules(response_rules: Optional[Dict[str, str]] = None,
+                 forwarding_rules: Optional[Dict[str, List[str]]] = None,
+                 filter_keywords: Iterable[str] = (),
+                 filter_senders: Iterable[str] = ()) -> List[Dict]:
+    """Convert the old RESPONSE_RULES / FORWARDING_RULES / FILTER_* constants into rule specs"""
+    specs = []
+    for keyword, response in (response_rules or {}).items():
+        # Only the first matching keyword used to be answered
+        specs.append({"id": f"reply:{keyword}", "priority": 0, "stop": True,
+                      "when": {"keywords": [keyword]},
+                      "actions": [{"type": "reply", "text": response}]})
+
+    filter_keywords, filter_senders = list(filter_keywords), list(filter_senders)
+    for source_chat_id, target_chat_ids in (forwarding_rules or {}).items():
+        if not target_chat_ids:
+            continue
+        when = {"chats": [source_chat_id]}
+        if filter_keywords:
+            # The old filter was a substring check, not whole words
+            when["regex"] = "|".join(re.escape(keyword) for keyword in filter_keywords)
+        if filter_senders:
+            # ... and let messages without a sender through
+            when["senders"] = filter_senders + [None]
+        # Forwarding ran independently of replies, so these rules get a higher priority than any stop rule
+        specs.append({"id": f"forward:{source_chat_id}", "priority": 1, "when": when,
+                      "actions": [{"type": "forward", "to": list(target_chat_ids)}]})
+    return specs
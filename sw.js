@@ -1,47 +1,71 @@
 // Service Worker for Telegram Web App PWA
-// Version is updated automatically - change this to force cache update
-const VERSION = '2025.12.07.2346';
-const CACHE_NAME = `telegram-web-app-v${VERSION}`;
-const RUNTIME_CACHE = `telegram-runtime-v${VERSION}`;
+// VERSION is a hash of the asset contents, written by update_version.py - do not edit by hand
+const VERSION = 'f0bde5daad20';
+const CACHE_NAME = 'telegram-web-app-static';
+const RUNTIME_CACHE = 'telegram-runtime';
+const ASSET_MANIFEST_URL = '/asset-manifest.json';
+const ASSET_HASH_HEADER = 'X-Asset-Hash';
 
-// Assets to cache on install
+// Fallback list when asset-manifest.json has not been built
 const STATIC_ASSETS = [
   '/',
-  '/index.html',
   '/manifest.json',
   '/icon-192.png',
   '/icon-512.png'
 ];
 
-// Install event - cache static assets
+// Load the asset manifest: { "/path": { "hash": "...", "url": "/assets/name.hash.ext" } }
+async function loadAssetManifest() {
+  try {
+    const response = await fetch(ASSET_MANIFEST_URL, { cache: 'no-store' });
+    if (response.ok) {
+      const manifest = await response.json();
+      return manifest.assets || {};
+    }
+  } catch (err) {
+    console.warn('Service Worker: Asset manifest unavailable:', err);
+  }
+  const assets = {};
+  STATIC_ASSETS.forEach(url => { assets[url] = { hash: null, url: url }; });
+  return assets;
+}
+
+// Cache one asset under its canonical path, skipping it if the cached hash is unchanged
+async function precacheAsset(cache, path, asset) {
+  if (asset.hash) {
+    const cached = await cache.match(path);
+    if (cached && cached.headers.get(ASSET_HASH_HEADER) === asset.hash) {
+      return;
+    }
+  }
+
+  const response = await fetch(asset.url, { cache: asset.hash ? 'default' : 'no-store' });
+  if (!response.ok) {
+    throw new Error(`HTTP ${response.status}`);
+  }
+
+  const headers = new Headers(response.headers);
+  if (asset.hash) {
+    headers.set(ASSET_HASH_HEADER, asset.hash);
+  }
+  const body = await response.blob();
+  await cache.put(path, new Response(body, { status: 200, statusText: 'OK', headers }));
+  console.log('Service Worker: Cached', path, asset.hash || '');
+}
+
+// Install event - cache only the static assets whose content changed
 self.addEventListener('install', (event) => {
   console.log('Service Worker: Installing version', VERSION);
   event.waitUntil(
-    caches.open(CACHE_NAME)
-      .then((cache) => {
-        console.log('Service Worker: Caching static assets');
-        // Use cache.addAll with error handling - don't fail if some assets can't be cached
+    Promise.all([loadAssetManifest(), caches.open(CACHE_NAME)])
+      .then(([assets, cache]) => {
+        // Don't fail the install if some assets can't be cached
         return Promise.allSettled(
-          STATIC_ASSETS.map(url => {
-            // Only cache same-origin URLs
-            try {
-              const urlObj = new URL(url, self.location.origin);
-              if (urlObj.protocol === 'chrome-extension:' ||
-                  urlObj.protocol === 'chrome:' ||
-                  urlObj.protocol === 'moz-extension:' ||
-                  urlObj.protocol === 'safari-extension:') {
-                console.warn(`Skipping unsupported URL scheme: ${url}`);
-                return Promise.resolve();
-              }
-              return cache.add(url).catch(err => {
-                console.warn(`Failed to cache ${url}:`, err);
-                // Don't throw - continue with other assets
-              });
-            } catch (err) {
-              console.warn(`Invalid URL ${url}:`, err);
-              return Promise.resolve();
-            }
-          })
+          Object.entries(assets).map(([path, asset]) =>
+            precacheAsset(cache, path, asset).catch(err => {
+              console.warn(`Failed to cache ${path}:`, err);
+            })
+          )
         );
       })
       .then(() => {
@@ -56,20 +80,33 @@ self.addEventListener('install', (event) => {
   );
 });
 
-// Activate event - clean up old caches
+// Activate event - drop caches from old versioning schemes and assets no longer listed
 self.addEventListener('activate', (event) => {
   console.log('Service Worker: Activating version', VERSION);
   event.waitUntil(
     caches.keys().then((cacheNames) => {
       return Promise.all(
         cacheNames.map((cacheName) => {
-          // Delete all caches that don't match current version
-          if (!cacheName.includes(`v${VERSION}`)) {
+          if (cacheName !== CACHE_NAME && cacheName !== RUNTIME_CACHE) {
             console.log('Service Worker: Deleting old cache:', cacheName);
             return caches.delete(cacheName);
           }
         })
       );
+    }).then(() => {
+      return Promise.all([loadAssetManifest(), caches.open(CACHE_NAME)]);
+    }).then(([assets, cache]) => {
+      return cache.keys().then((requests) => {
+        return Promise.all(
+          requests.map((request) => {
+            const path = new URL(request.url).pathname;
+            if (!(path in assets)) {
+              console.log('Service Worker: Removing stale asset:', path);
+              return cache.delete(request);
+            }
+          })
+        );
+      });
     }).then(() => {
       // Take control of all clients immediately
       return self.clients.claim();
@@ -174,7 +211,9 @@ self.addEventListener('fetch', (event) => {
           // Only cache if response is valid and from same origin
           if (response && response.status === 200 && response.type === 'basic') {
             const responseToCache = response.clone();
-            caches.open(CACHE_NAME).then((cache) => {
+            // Runtime copies go to RUNTIME_CACHE: overwriting the precached entry would drop
+            // its X-Asset-Hash, and the next install would refetch an unchanged page
+            caches.open(RUNTIME_CACHE).then((cache) => {
               try {
                 cache.put(request, responseToCache).catch(err => {
                   console.warn('Failed to cache HTML:', err);
@@ -189,8 +228,10 @@ self.addEventListener('fetch', (event) => {
           return response;
         })
         .catch(() => {
-          // Fallback to cache if network fails
-          return caches.match(request);
+          // Fallback to cache if network fails, preferring the copy from the last visit
+          return caches.open(RUNTIME_CACHE)
+            .then((cache) => cache.match(request))
+            .then((cachedResponse) => cachedResponse || caches.match(request));
         })
     );
     return;
@@ -0,0 +1,131 @@
+"""
+Backup Stream tests
+Runs offline against scripts/backup_stream.py; no server needed
+"""
+
+import gzip
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import backup_stream  # noqa: E402
+from backup_stream import BackupReader, BackupWriter  # noqa: E402
+
+CODECS = ["gzip"] + (["zstd"] if backup_stream.zstandard else [])
+
+
+def record(message_id, day=1, **fields):
+    return {"id": message_id, "date": f"2024-01-{day:02d}T12:00:00+00:00", "text": f"message {message_id}", **fields}
+
+
+def write_frames(path, codec, frames, close=True):
+    """Write each list of records as one frame; without close the footer is left out, as after a crash"""
+    writer = BackupWriter(path, codec=codec, metadata={"chat_id": 1})
+    for records in frames:
+        writer.write_many(records)
+        writer.flush()
+    if close:
+        writer.close()
+    else:
+        writer.file.close()
+
+
+def new_path(codec):
+    return os.path.join(tempfile.mkdtemp(), f"backup.ndjson.{'zst' if codec == 'zstd' else 'gz'}")
+
+
+def test_footer_index_and_lookups():
+    for codec in CODECS:
+        path = new_path(codec)
+        write_frames(path, codec, [
+            [record(1, day=1), record(2, day=1)],
+            [record(3, day=5), record(2, day=5, text="edited")],
+            [record(4, day=9), {"id": 3, "deleted": True}],
+        ])
+        reader = BackupReader(path)
+        assert reader.codec == codec
+        assert reader.metadata == {"chat_id": 1}
+        assert [(f["min_id"], f["max_id"], f["count"]) for f in reader.frames] == [(1, 2, 2), (2, 3, 2), (3, 4, 2)]
+        assert reader.get(2)["text"] == "edited"
+        assert reader.get(3) is None
+        assert reader.get(99) is None
+        assert [r["id"] for r in reader.between("2024-01-04", "2024-01-06")] == [3, 2]
+        assert len(list(reader)) == 6
+
+
+def test_standard_tools_read_every_record():
+    path = new_path("gzip")
+    write_frames(path, "gzip", [[record(1)], [record(2)]])
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        assert len(f.read().splitlines()) == 2
+
+
+def test_reopen_appends_after_footer():
+    for codec in CODECS:
+        path = new_path(codec)
+        write_frames(path, codec, [[record(1), record(2)]])
+        writer = BackupWriter(path)
+        assert writer.codec == codec and writer.last_id == 2
+        writer.write(record(3))
+        writer.close()
+
+        reader = BackupReader(path)
+        assert [f["max_id"] for f in reader.frames] == [2, 3]
+        assert [r["id"] for r in reader] == [1, 2, 3]
+
+
+def test_missing_footer_is_rebuilt_and_partial_frame_dropped():
+    for codec in CODECS:
+        path = new_path(codec)
+        write_frames(path, codec, [[record(1), record(2)], [record(3)]], close=False)
+        complete = os.path.getsize(path)
+        # An interrupted run leaves half a frame behind
+        writer = BackupWriter(path)
+        writer.write(record(4, text="x" * 5000))
+        writer.file.write(writer.compressor.flush()[:20])
+        writer.file.close()
+        assert os.path.getsize(path) > complete
+
+        reader = BackupReader(path)
+        assert [r["id"] for r in reader] == [1, 2, 3]
+
+        writer = BackupWriter(path)
+        assert writer.last_id == 3
+        assert os.path.getsize(path) == complete
+        writer.write(record(4))
+        writer.close()
+        assert [r["id"] for r in BackupReader(path)] == [1, 2, 3, 4]
+
+
+def test_interrupted_footer_rewrite_is_repaired():
+    for codec in CODECS:
+        path = new_path(codec)
+        write_frames(path, codec, [[record(1)], [record(2)]])
+        # Cut the file inside the footer, as if close() was interrupted
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 5)
+        writer = BackupWriter(path)
+        assert [f["max_id"] for f in writer.frames] == [1, 2]
+        writer.close()
+        assert BackupReader(path).get(2)["id"] == 2
+
+
+def main():
+    tests = [test_footer_index_and_lookups, test_standard_tools_read_every_record, test_reopen_appends_after_footer,
+             test_missing_footer_is_rebuilt_and_partial_frame_dropped, test_interrupted_footer_rewrite_is_repaired]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS: {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ FAIL: {test.__name__} {e}")
+    print(f"\n📊 {len(tests) - failed}/{len(tests)} passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
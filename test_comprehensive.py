@@ -7,9 +7,11 @@ import requests
 import json
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional
 
 BASE_URL = "http://localhost:8001"
+LOOP_BLOCK_THRESHOLD = "0.01"  # Histogram bucket (seconds) no event loop step may exceed
 TEST_RESULTS = {
     "passed": [],
     "failed": [],
@@ -249,6 +251,49 @@ def test_websocket_endpoint():
     # This is expected behavior - WebSocket works in browser
     log_test("WebSocket Endpoint", True, "Endpoint exists (requires WebSocket protocol, tested in browser)")
 
+def get_loop_lag_buckets() -> Dict[str, float]:
+    """Read cumulative event loop lag bucket counts from /metrics"""
+    response = requests.get(f"{BASE_URL}/metrics", timeout=5)
+    buckets = {}
+    for line in response.text.splitlines():
+        if line.startswith("event_loop_lag_seconds_bucket"):
+            bound = line.split('le="')[1].split('"')[0]
+            buckets[bound] = float(line.rsplit(" ", 1)[1])
+    return buckets
+
+def test_event_loop_not_blocked(chat_id: Optional[str] = None):
+    """Hit routes concurrently and check that no step blocked the server's event loop"""
+    paths = ["/", "/manifest.json", "/sw.js", "/api/status", "/api/chats?limit=10", "/api/account", "/api/contacts"]
+    if chat_id:
+        paths += [f"/api/chats/{chat_id}", f"/api/messages/{chat_id}?limit=20"]
+
+    def fetch(path):
+        return requests.get(f"{BASE_URL}{path}", timeout=30)
+
+    try:
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            # Warm up first so one-time imports and thread pool startup aren't counted
+            list(pool.map(fetch, paths * 2))
+            time.sleep(0.5)
+            before = get_loop_lag_buckets()
+            list(pool.map(fetch, paths * 10))
+        time.sleep(0.5)  # Let the lag monitor tick after the burst
+        after = get_loop_lag_buckets()
+
+        total = after.get("+Inf", 0) - before.get("+Inf", 0)
+        within = after.get(LOOP_BLOCK_THRESHOLD, 0) - before.get(LOOP_BLOCK_THRESHOLD, 0)
+        if total == 0:
+            log_test("Event Loop Blocking", False, "No event loop lag samples recorded")
+            return False
+        if total > within:
+            log_test("Event Loop Blocking", False, f"{int(total - within)} of {int(total)} samples lagged more than {LOOP_BLOCK_THRESHOLD}s")
+            return False
+        log_test("Event Loop Blocking", True, f"{int(total)} samples, none above {LOOP_BLOCK_THRESHOLD}s")
+        return True
+    except Exception as e:
+        log_test("Event Loop Blocking", False, str(e))
+        return False
+
 def main():
     """Run comprehensive test suite"""
     print("=" * 70)
@@ -325,6 +370,10 @@ def main():
     # WebSocket
     test_websocket_endpoint()
 
+    # Event loop responsiveness under concurrent load
+    print("\n⏱️  Testing Event Loop Blocking...")
+    test_event_loop_not_blocked(str(chats[0].get("id", "")) if chats else None)
+
     # Summary
     print("\n" + "=" * 70)
     print("📊 Test Summary")
@@ -0,0 +1,125 @@
+"""
+Dedup State tests
+Runs offline against scripts/dedup_state.py; no server needed
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+from dedup_state import DedupState  # noqa: E402
+
+
+def new_state(max_recent=3, path=None):
+    return DedupState(path or os.path.join(tempfile.mkdtemp(), "state.json"), max_recent=max_recent)
+
+
+def test_eviction_raises_high_water_and_keeps_messages_seen():
+    state = new_state()
+    for message_id in range(1, 6):
+        state.mark("chat", message_id)
+    assert len(state.recent) == 3
+    assert state.high_water == {"chat": 2}
+    assert all(state.seen("chat", message_id) for message_id in range(1, 6))
+    assert not state.seen("chat", 6)
+    assert not state.seen("other", 1)
+
+
+def test_eviction_does_not_pass_held_message():
+    state = new_state()
+    state.hold("chat", 10)
+    for message_id in range(11, 20):
+        state.hold("chat", message_id)
+        state.mark("chat", message_id)
+    assert not state.seen("chat", 10)
+    assert all(state.seen("chat", message_id) for message_id in range(11, 20))
+    assert state.high_water.get("chat", 0) < 10
+
+    # Marking the held message lets the mark catch up with everything set aside
+    state.mark("chat", 10)
+    assert state.high_water == {"chat": 16}
+    assert not state.deferred and not state.held
+    assert all(state.seen("chat", message_id) for message_id in range(10, 20))
+
+
+def test_release_without_mark_folds_deferred_into_mark():
+    state = new_state(max_recent=1)
+    state.hold("chat", 5)
+    state.hold("chat", 8)
+    for message_id in (6, 7, 9, 10):
+        state.mark("chat", message_id)
+    assert state.high_water.get("chat", 0) < 5
+    state.release("chat", 5)
+    # 8 is still held, so only what lies below it is covered
+    assert state.high_water == {"chat": 7}
+    assert not state.seen("chat", 8) and state.seen("chat", 9)
+    state.release_all()
+    assert state.high_water == {"chat": 9} and state.seen("chat", 10)
+
+
+def test_holds_survive_restart():
+    path = os.path.join(tempfile.mkdtemp(), "state.json")
+    state = new_state(path=path)
+    state.cursor = "stream:42"
+    state.hold("chat", 10)
+    for message_id in range(11, 20):
+        state.mark("chat", message_id)
+    state.save(force=True)
+
+    restored = new_state(path=path)
+    assert restored.cursor == "stream:42"
+    assert not restored.seen("chat", 10)
+    assert all(restored.seen("chat", message_id) for message_id in range(11, 20))
+    restored.mark("chat", 10)
+    assert restored.seen("chat", 10) and restored.high_water == {"chat": 16}
+
+
+def test_saves_are_debounced():
+    state = new_state()
+    state.save_interval = 3600
+    state.mark("chat", 1)
+    state.save()
+    with open(state.path, encoding="utf-8") as f:
+        assert json.load(f)["recent"] == {"chat": [1]}
+
+    state.mark("chat", 2)
+    state.save()
+    with open(state.path, encoding="utf-8") as f:
+        assert json.load(f)["recent"] == {"chat": [1]}
+    assert state.dirty
+
+    state.save(force=True)
+    with open(state.path, encoding="utf-8") as f:
+        assert json.load(f)["recent"] == {"chat": [1, 2]}
+    assert not state.dirty
+
+
+def test_unreadable_file_starts_empty():
+    path = os.path.join(tempfile.mkdtemp(), "state.json")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{not json")
+    state = new_state(path=path)
+    assert state.cursor is None and not state.seen("chat", 1)
+
+
+def main():
+    tests = [test_eviction_raises_high_water_and_keeps_messages_seen, test_eviction_does_not_pass_held_message,
+             test_release_without_mark_folds_deferred_into_mark, test_holds_survive_restart,
+             test_saves_are_debounced, test_unreadable_file_starts_empty]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS: {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ FAIL: {test.__name__} {e}")
+    print(f"\n📊 {len(tests) - failed}/{len(tests)} passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+FloodWait metrics tests for InstrumentedTelegramClient
+Runs offline against a fake MTProto sender; no server or Telegram login needed
+"""
+
+import asyncio
+import sys
+
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.help import GetConfigRequest
+
+import app
+
+
+class FakeSender:
+    """Answers each send with the next queued error, then with a result"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.sent = 0
+
+    def send(self, request, ordered=False):
+        self.sent += 1
+        future = asyncio.get_running_loop().create_future()
+        if self.errors:
+            future.set_exception(self.errors.pop(0))
+        else:
+            future.set_result("ok")
+        return future
+
+
+def run_call(errors, flood_sleep_threshold=60):
+    """Run one GetConfigRequest through the client; return (result or error, sender, sleeps)"""
+    sleeps = []
+    real_sleep = asyncio.sleep
+    client = app.InstrumentedTelegramClient(None, 1, "hash", flood_sleep_threshold=flood_sleep_threshold)
+
+    async def fake_sleep(seconds, *args, **kwargs):
+        # Move Telethon's remembered flood-wait deadlines back as if the time had passed
+        sleeps.append(seconds)
+        for constructor_id in client._flood_waited_requests:
+            client._flood_waited_requests[constructor_id] -= seconds
+        await real_sleep(0)
+
+    async def call():
+        sender = FakeSender(errors)
+        asyncio.sleep = fake_sleep
+        try:
+            return await client._call(sender, GetConfigRequest()), sender
+        except FloodWaitError as e:
+            return e, sender
+        finally:
+            asyncio.sleep = real_sleep
+
+    result, sender = asyncio.run(call())
+    return result, sender, sleeps
+
+
+def flood_waits(method="GetConfigRequest"):
+    return app.flood_waits_total.values[(method,)], app.flood_wait_seconds_total.values[(method,)]
+
+
+def test_short_flood_wait_is_counted_and_retried():
+    waits, seconds = flood_waits()
+    result, sender, sleeps = run_call([FloodWaitError(request=None, capture=5)])
+    assert result == "ok"
+    assert sender.sent == 2
+    assert sleeps == [5]
+    assert flood_waits() == (waits + 1, seconds + 5)
+
+
+def test_long_flood_wait_is_counted_and_raised():
+    waits, seconds = flood_waits()
+    result, sender, sleeps = run_call([FloodWaitError(request=None, capture=120)])
+    assert isinstance(result, FloodWaitError)
+    assert sender.sent == 1
+    assert sleeps == []
+    assert flood_waits() == (waits + 1, seconds + 120)
+
+
+def test_threshold_is_kept_out_of_telethon():
+    client = app.InstrumentedTelegramClient(None, 1, "hash", flood_sleep_threshold=30)
+    assert client.flood_sleep_threshold == 0
+    assert client.flood_retry_threshold == 30
+    client.flood_sleep_threshold = None
+    assert client.flood_retry_threshold == 0
+
+
+def main():
+    tests = [test_short_flood_wait_is_counted_and_retried, test_long_flood_wait_is_counted_and_raised,
+             test_threshold_is_kept_out_of_telethon]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS: {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ FAIL: {test.__name__} {e}")
+    print(f"\n📊 {len(tests) - failed}/{len(tests)} passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Keyword Matcher tests
+Runs offline against scripts/keyword_matcher.py; no server needed
+"""
+
+import os
+import random
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+from keyword_matcher import KeywordMatcher, Rule, tokenize  # noqa: E402
+
+WORDS = ["order", "invoice", "hello", "ticket", "abc", "xyz", "12345", "99", "a-b", "refund", "ok"]
+PATTERNS = [
+    r"\d{5}", r"inv(oice)?", r"ab+c", r"^hello", r"ok$", r"(\w)\1", r"(?i:REFUND)", r"(?P<word>tick)et",
+    r"(a)?-(?(1)b|c)", r"x(?=yz)", r"(?<=x)yz", r"\bord", r"refund|ticket", r"a.b", r"9{2}\b",
+]
+
+
+def test_keywords_match_whole_words():
+    matcher = KeywordMatcher.from_mapping({"hi": "Hi!", "good morning": "Morning!"})
+    assert matcher.match("this is it") is None
+    assert matcher.match("Hi there").response == "Hi!"
+    assert matcher.match("well, GOOD   morning!").response == "Morning!"
+    assert matcher.match("good evening, morning") is None
+
+
+def test_unspaced_scripts_match_inside_words():
+    assert tokenize("他说你好吗") == ["他", "说", "你", "好", "吗"]
+    matcher = KeywordMatcher.from_mapping({"你好": "hello", "สวัสดี": "hello"})
+    assert matcher.match("他说你好吗") is not None
+    assert matcher.match("ผมว่าสวัสดีครับ") is not None
+    assert matcher.match("你们好") is None
+
+
+def test_combined_regex_matches_like_separate_searches():
+    rules = [Rule(pattern, regex=pattern, rule_id=pattern) for pattern in PATTERNS]
+    matcher = KeywordMatcher(rules)
+    assert matcher.combined_rules and matcher.regex_rules
+    uncombined = {rule.rule_id for rule in matcher.regex_rules}
+    # Backreferences, conditionals and named groups can't share the alternation
+    assert {r"(\w)\1", r"(a)?-(?(1)b|c)", r"(?P<word>tick)et"} <= uncombined
+
+    random.seed(42)
+    for _ in range(2000):
+        text = " ".join(random.choice(WORDS) for _ in range(random.randint(0, 8)))
+        expected = {}
+        for rule in rules:
+            match = re.search(rule.regex.pattern, text, re.IGNORECASE)
+            if match:
+                expected[rule.rule_id] = len(tokenize(text[:match.start()]))
+        found = {rule.rule_id: position for rule, position in matcher.matches(text)}
+        assert found == expected, text
+
+
+def test_priority_then_position_then_order():
+    matcher = KeywordMatcher([
+        Rule("late", keywords=["world"]),
+        Rule("early", keywords=["hello"]),
+        Rule("same position, defined later", regex=r"hel+o"),
+        Rule("urgent", keywords=["world"], priority=5),
+    ])
+    assert [rule.response for rule, _ in matcher.matches("hello world")] == [
+        "urgent", "early", "same position, defined later", "late"]
+
+
+def test_chat_scope():
+    matcher = KeywordMatcher([Rule("scoped", keywords=["hello"], chats=[123]), Rule("global", keywords=["hello"])])
+    assert [rule.response for rule, _ in matcher.matches("hello", chat_id="123")] == ["scoped", "global"]
+    assert [rule.response for rule, _ in matcher.matches("hello", chat_id=456)] == ["global"]
+    assert [rule.response for rule, _ in matcher.matches("hello")] == ["global"]
+
+
+def main():
+    tests = [test_keywords_match_whole_words, test_unspaced_scripts_match_inside_words,
+             test_combined_regex_matches_like_separate_searches, test_priority_then_position_then_order,
+             test_chat_scope]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS: {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ FAIL: {test.__name__} {e}")
+    print(f"\n📊 {len(tests) - failed}/{len(tests)} passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
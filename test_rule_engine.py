@@ -0,0 +1,125 @@
+"""
+Rule Engine tests
+Runs offline against scripts/rule_engine.py; no server needed
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+from rule_engine import RuleEngine, RuleSet, legacy_rules  # noqa: E402
+
+REPLY = [{"type": "reply", "text": "ok"}]
+
+
+def rule(rule_id, when=None, **fields):
+    return {"id": rule_id, "when": when or {}, "actions": REPLY, **fields}
+
+
+def matched(ruleset, text="", chat_id=1, **message):
+    message.setdefault("sender_id", 7)
+    return [rule.rule_id for rule in ruleset.evaluate(chat_id, {"text": text, **message})]
+
+
+def test_keywords_and_regex_must_both_match():
+    rules = RuleSet([rule("both", {"keywords": ["invoice"], "regex": r"\d{5}"})])
+    assert matched(rules, "invoice please") == []
+    assert matched(rules, "order 12345") == []
+    assert matched(rules, "invoice 12345") == ["both"]
+
+
+def test_priority_order_and_stop():
+    rules = RuleSet([
+        rule("low"),
+        rule("high", priority=5),
+        rule("stopper", {"keywords": ["stop"]}, stop=True),
+        rule("after stopper"),
+    ])
+    assert matched(rules, "go") == ["high", "low", "after stopper"]
+    # Same priority runs in file order, so the stop rule cuts off only what comes after it
+    assert matched(rules, "please stop") == ["high", "low", "stopper"]
+
+
+def test_chat_sender_and_message_conditions():
+    rules = RuleSet([
+        rule("chat", {"chats": ["1"]}),
+        rule("sender", {"senders": [8]}),
+        rule("no sender ok", {"senders": [8, None]}),
+        rule("photos", {"media": ["photo"]}),
+        rule("outgoing", {"incoming": False}),
+    ])
+    assert matched(rules) == ["chat"]
+    assert matched(rules, chat_id=2, sender_id=8) == ["sender", "no sender ok"]
+    assert matched(rules, chat_id=2, sender_id=None) == ["no sender ok"]
+    assert matched(rules, chat_id=2, media_category="photo") == ["photos"]
+    assert matched(rules, chat_id=2, is_out=True) == ["outgoing"]
+
+
+def test_invalid_rules_are_rejected():
+    for spec in ({"id": "x", "actions": []},
+                 {"id": "x", "when": {"sender": [1]}, "actions": REPLY},
+                 {"id": "x", "when": {"regex": "("}, "actions": REPLY},
+                 {"id": "x", "actions": [{"type": "reply"}]}):
+        try:
+            RuleSet([spec])
+        except ValueError:
+            continue
+        raise AssertionError(f"accepted {spec}")
+
+
+def test_legacy_rules_keep_old_semantics():
+    rules = RuleSet(legacy_rules(
+        response_rules={"hi": "Hi!", "help": "Help!"},
+        forwarding_rules={"1": ["2"]}, filter_keywords=["urgent", "a.b"], filter_senders=["7"],
+    ))
+    # Replies are whole-word and only the first matching keyword answers
+    assert matched(rules, "this", chat_id=3) == []
+    assert matched(rules, "hi, help", chat_id=3) == ["reply:hi"]
+    # Forward filters match substrings and let messages without a sender through
+    assert matched(rules, "URGENTLY", chat_id=1) == ["forward:1"]
+    assert matched(rules, "a.b", chat_id=1, sender_id=None) == ["forward:1"]
+    assert matched(rules, "axb", chat_id=1) == []
+    assert matched(rules, "urgent", chat_id=1, sender_id=8) == []
+    # Forwarding still happens when a stop rule replies
+    assert matched(rules, "hi, urgent", chat_id=1) == ["forward:1", "reply:hi"]
+
+
+def test_reload_keeps_rules_when_file_breaks():
+    path = os.path.join(tempfile.mkdtemp(), "rules.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"rules": [rule("first", {"keywords": ["a"]})]}, f)
+    engine = RuleEngine(path)
+    assert [r.rule_id for r in engine.evaluate(1, {"text": "a", "sender_id": 7})] == ["first"]
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"rules": [')
+    assert not engine.refresh(force=True)
+    assert [r.rule_id for r in engine.ruleset.rules] == ["first"]
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"rules": [rule("second", {"keywords": ["a"]}), rule("third", {"keywords": ["a"]})]}, f)
+    assert engine.refresh(force=True)
+    assert [r.rule_id for r in engine.evaluate(1, {"text": "a", "sender_id": 7})] == ["second", "third"]
+
+
+def main():
+    tests = [test_keywords_and_regex_must_both_match, test_priority_order_and_stop,
+             test_chat_sender_and_message_conditions, test_invalid_rules_are_rejected,
+             test_legacy_rules_keep_old_semantics, test_reload_keeps_rules_when_file_breaks]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS: {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ FAIL: {test.__name__} {e}")
+    print(f"\n📊 {len(tests) - failed}/{len(tests)} passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,89 @@
 #!/usr/bin/env python3
 """
-Script to update PWA version across all files
-Run this script whenever you make changes to ensure PWA updates automatically
+Build step for PWA asset versioning
+Computes content hashes for the static assets, writes asset-manifest.json with
+hashed URLs (served with Cache-Control: immutable) and stamps sw.js so the
+service worker re-downloads only the assets whose content changed.
+Run this script whenever you change index.html, manifest.json, sw.js or the icons.
 """
 
-import re
+import hashlib
+import json
 import os
-from datetime import datetime
+import re
+
+ASSET_MANIFEST_FILE = "asset-manifest.json"
+SERVICE_WORKER_FILE = "sw.js"
+
+# Assets precached by the service worker: URL -> file
+PRECACHE_ASSETS = {
+    "/": "index.html",
+    "/manifest.json": "manifest.json",
+    "/icon-192.png": "icon-192.png",
+    "/icon-512.png": "icon-512.png",
+}
+
+HASH_LENGTH = 12
+
+
+def content_hash(path: str) -> str:
+    """Hash a file's content"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+
+
+def hashed_url(path: str, digest: str) -> str:
+    """Build the immutable URL for a file, e.g. /assets/icon-192.3f2a9c1b7d4e.png"""
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return f"/assets/{stem}.{digest}{ext}"
+
 
 def update_version():
-    # Generate new version based on timestamp
-    version = datetime.now().strftime("%Y.%m.%d.%H%M")
-    # Or use a simpler versioning scheme
-    # version = "2.0.2"  # Increment manually
+    assets = {}
+    for url, path in PRECACHE_ASSETS.items():
+        if not os.path.exists(path):
+            print(f"⚠️  Skipping missing asset: {path}")
+            continue
+        digest = content_hash(path)
+        assets[url] = {"file": path, "hash": digest, "url": hashed_url(path, digest)}
+        print(f"✓ {path}: {digest}")
 
-    print(f"Updating PWA version to: {version}")
+    # The version changes whenever any precached asset changes
+    fingerprint = "\n".join(f"{url}:{asset['hash']}" for url, asset in sorted(assets.items()))
+    version = hashlib.sha256(fingerprint.encode()).hexdigest()[:HASH_LENGTH]
 
-    # Update sw.js
-    sw_file = "sw.js"
-    if os.path.exists(sw_file):
-        with open(sw_file, 'r', encoding='utf-8') as f:
+    # Stamp sw.js so browsers see a byte-different service worker and install it
+    if os.path.exists(SERVICE_WORKER_FILE):
+        with open(SERVICE_WORKER_FILE, 'r', encoding='utf-8') as f:
             content = f.read()
 
-        # Update VERSION constant
         content = re.sub(
             r"const VERSION = '[^']+';",
             f"const VERSION = '{version}';",
             content
         )
 
-        with open(sw_file, 'w', encoding='utf-8') as f:
+        with open(SERVICE_WORKER_FILE, 'w', encoding='utf-8') as f:
             f.write(content)
-        print(f"✓ Updated {sw_file}")
+        print(f"✓ Updated {SERVICE_WORKER_FILE}")
 
-    # Update manifest.json
-    manifest_file = "manifest.json"
-    if os.path.exists(manifest_file):
-        with open(manifest_file, 'r', encoding='utf-8') as f:
-            content = f.read()
+    manifest = {
+        "version": version,
+        "assets": assets,
+        "service_worker": {
+            "file": SERVICE_WORKER_FILE,
+            "hash": content_hash(SERVICE_WORKER_FILE) if os.path.exists(SERVICE_WORKER_FILE) else None
+        }
+    }
 
-        # Update version field
-        content = re.sub(
-            r'"version": "[^"]+"',
-            f'"version": "{version}"',
-            content
-        )
+    with open(ASSET_MANIFEST_FILE, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    print(f"✓ Wrote {ASSET_MANIFEST_FILE}")
 
-        # Update start_url with version query
-        content = re.sub(
-            r'"start_url": "/\?v=[^"]+"',
-            f'"start_url": "/?v={version}"',
-            content
-        )
-
-        with open(manifest_file, 'w', encoding='utf-8') as f:
-            f.write(content)
-        print(f"✓ Updated {manifest_file}")
+    print(f"\n✅ Asset version {version}")
+    print("Clients will re-download only the assets whose content changed.")
 
-    print(f"\n✅ Version updated to {version}")
-    print("The PWA will automatically update for users on next page load!")
 
 if __name__ == "__main__":
     update_version()